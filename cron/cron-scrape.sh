@@ -6,9 +6,9 @@
   cd scrapers || exit 1
   echo $(date) "START"
   echo "*** wiki"
-  bash scrape_wiki.sh 
+  python scrape_wiki.py
   echo "*** readme"
-  bash scrape_readme.sh 
+  python scrape_readme.py
   echo "*** rt"
   python scrape_rt.py
   echo $(date) "STOP"
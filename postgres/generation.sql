@@ -0,0 +1,84 @@
+-- SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+--
+-- SPDX-License-Identifier: AGPL-3.0-or-later
+
+-- Migrate a ragdata table partitioned by tag (see postgres/partition.sql, run that one
+-- first for a flat table) to the generations of postgres/init.sql: the table with all
+-- its partitions becomes generation 1, the active one (see rag/generation.py), embedded
+-- with the model Stuart used before the generations (its chunk lengths are recorded by
+-- the next load).
+--
+-- Run once, with the loaders and workers stopped:
+--
+--   psql -U rag ragdb -f generation.sql
+--
+-- Then run postgres/ragfile.sql, to get to the layout of postgres/init.sql.
+--
+-- The indexes of postgres/quantization.sql (and an HNSW index on embedding, if you
+-- created one) are kept on generation 1: run their CREATE INDEX on ragdata again
+-- afterwards, Postgres then attaches them instead of building them again, and
+-- creates them on the next generations.
+
+BEGIN;
+
+-- replaced by the primary key and unique constraint of the new ragdata, with the generation
+ALTER TABLE ragdata DROP CONSTRAINT ragdata_pkey;
+ALTER TABLE ragdata DROP CONSTRAINT ragdata_tag_file_name_start_pos_end_pos_key;
+
+ALTER TABLE ragdata RENAME TO ragdata_g1;
+ALTER INDEX IF EXISTS ragdata_embedding_halfvec_ix RENAME TO ragdata_g1_embedding_halfvec_ix;
+ALTER INDEX IF EXISTS ragdata_embedding_bit_ix RENAME TO ragdata_g1_embedding_bit_ix;
+ALTER INDEX IF EXISTS ragdata_embedding_hnsw_ix RENAME TO ragdata_g1_embedding_hnsw_ix;
+
+-- ragdata_<tag> becomes ragdata_g1_<tag> (and ragdata_default ragdata_g1_default)
+DO $$
+DECLARE
+    r record;
+BEGIN
+    FOR r IN SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+             WHERE i.inhparent = 'ragdata_g1'::regclass LOOP
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', r.relname, 'ragdata_g1_' || substr(r.relname, 9));
+    END LOOP;
+END $$;
+
+ALTER TABLE ragdata_g1 ADD COLUMN generation integer not null default 1;
+
+CREATE TABLE ragdata (
+    id          bigint not null default nextval('ragdata_id_seq'),
+    tag         text not null,
+    file_name   text not null,
+    start_pos   bigint,
+    end_pos     bigint,
+    ts          timestamp with time zone default now() not null,
+    file_body   text not null,
+    embedding   vector(1024) not null,
+    generation  integer not null,
+    primary key(id, generation, tag),
+    unique(generation, tag, file_name, start_pos, end_pos)
+) PARTITION BY LIST (generation);
+
+ALTER SEQUENCE ragdata_id_seq OWNED BY ragdata.id;
+
+ALTER TABLE ragdata ATTACH PARTITION ragdata_g1 FOR VALUES IN (1);
+
+CREATE TABLE raggeneration (
+    generation  integer not null,
+    description text not null default '',
+    embedding_model text not null,
+    embedding_model_revision text not null,
+    chunk_len   integer,
+    overlap_len integer,
+    created     timestamp with time zone default now() not null,
+    activated   timestamp with time zone,
+    active      boolean not null default false,
+    primary key(generation)
+);
+
+CREATE UNIQUE INDEX raggeneration_active_ix ON raggeneration (active) WHERE active;
+
+INSERT INTO raggeneration (generation, description, embedding_model, embedding_model_revision, activated, active)
+VALUES (1, 'initial', 'BAAI/bge-m3', '5a212480c9a75bb651bcb894978ed409e4c47b82', now(), true);
+
+COMMIT;
+
+ANALYZE ragdata;
@@ -4,15 +4,74 @@
 
 CREATE EXTENSION IF NOT EXISTS vector;
 
+-- the chunks: spans (start_pos to end_pos, in characters) of a file in ragfile, with the
+-- SHA-256 of their text and its embedding;
+-- partitioned by generation (ragdata_g<generation>), then by tag (ragdata_g<generation>_<tag>);
+-- the partitions of the tags are created by rag/libstore.py with the first file of the tag
+-- (see postgres/partition.sql, postgres/generation.sql and postgres/ragfile.sql to migrate a
+-- table created before)
 CREATE TABLE IF NOT EXISTS ragdata (
     id          bigserial,
     tag         text not null,
-    file_name   text not null,
+    file_id     bigint not null,
     start_pos   bigint,
     end_pos     bigint,
     ts          timestamp with time zone default now() not null,
-    file_body   text not null,
+    hash        bytea not null,
     embedding   vector(1024) not null,
-    primary key(id),
-    unique(tag, file_name, start_pos, end_pos)
+    generation  integer not null,
+    primary key(id, generation, tag),
+    unique(generation, tag, file_id, start_pos, end_pos)
+) PARTITION BY LIST (generation);
+
+-- to reuse the embedding of a text already loaded
+CREATE INDEX IF NOT EXISTS ragdata_hash_ix ON ragdata (hash);
+
+-- the texts of the files, each once; partitioned like ragdata (ragfile_g<generation>_<tag>)
+CREATE TABLE IF NOT EXISTS ragfile (
+    id          bigserial,
+    tag         text not null,
+    file_name   text not null,
+    ts          timestamp with time zone default now() not null,
+    body        text not null,
+    generation  integer not null,
+    primary key(id, generation, tag),
+    unique(generation, tag, file_name)
+) PARTITION BY LIST (generation);
+
+-- generations of the corpus, the active one is searched (see rag/generation.py); each
+-- with the embedding model it is embedded with and the chunk lengths it is chunked with
+-- (recorded by its first load)
+CREATE TABLE IF NOT EXISTS raggeneration (
+    generation  integer not null,
+    description text not null default '',
+    embedding_model text not null,
+    embedding_model_revision text not null,
+    chunk_len   integer,
+    overlap_len integer,
+    created     timestamp with time zone default now() not null,
+    activated   timestamp with time zone,
+    active      boolean not null default false,
+    primary key(generation)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS raggeneration_active_ix ON raggeneration (active) WHERE active;
+
+INSERT INTO raggeneration (generation, description, embedding_model, embedding_model_revision, activated, active)
+VALUES (1, 'initial', 'BAAI/bge-m3', '5a212480c9a75bb651bcb894978ed409e4c47b82', now(), true)
+ON CONFLICT (generation) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS ragdata_g1 PARTITION OF ragdata FOR VALUES IN (1) PARTITION BY LIST (tag);
+
+CREATE TABLE IF NOT EXISTS ragdata_g1_default PARTITION OF ragdata_g1 DEFAULT;
+
+CREATE TABLE IF NOT EXISTS ragfile_g1 PARTITION OF ragfile FOR VALUES IN (1) PARTITION BY LIST (tag);
+
+CREATE TABLE IF NOT EXISTS ragfile_g1_default PARTITION OF ragfile_g1 DEFAULT;
+
+-- position of rag_dir() in the change journal, per tag (see rag/librag.py)
+CREATE TABLE IF NOT EXISTS ragcheckpoint (
+    name        text not null,
+    position    bigint not null,
+    primary key(name)
 );
@@ -0,0 +1,62 @@
+-- SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+--
+-- SPDX-License-Identifier: AGPL-3.0-or-later
+
+-- Migrate a flat ragdata table (created before the partitioning, see postgres/init.sql)
+-- to a table list-partitioned by tag, with one partition named ragdata_<tag> per tag.
+--
+-- Run once, with the loaders and workers stopped:
+--
+--   psql -U rag ragdb -f partition.sql
+--
+-- Then run postgres/generation.sql and postgres/ragfile.sql, to get to the layout of
+-- postgres/init.sql.
+--
+-- The indexes of postgres/quantization.sql (and an HNSW index on embedding, if you
+-- created one) are dropped with the flat table: create them again afterwards, on
+-- ragdata, and Postgres creates them on each partition.
+
+BEGIN;
+
+ALTER TABLE ragdata RENAME TO ragdata_flat;
+ALTER TABLE ragdata_flat RENAME CONSTRAINT ragdata_pkey TO ragdata_flat_pkey;
+ALTER TABLE ragdata_flat RENAME CONSTRAINT ragdata_tag_file_name_start_pos_end_pos_key TO ragdata_flat_key;
+ALTER SEQUENCE ragdata_id_seq RENAME TO ragdata_flat_id_seq;
+DROP INDEX IF EXISTS ragdata_embedding_halfvec_ix;
+DROP INDEX IF EXISTS ragdata_embedding_bit_ix;
+DROP INDEX IF EXISTS ragdata_embedding_hnsw_ix;
+
+CREATE TABLE ragdata (
+    id          bigserial,
+    tag         text not null,
+    file_name   text not null,
+    start_pos   bigint,
+    end_pos     bigint,
+    ts          timestamp with time zone default now() not null,
+    file_body   text not null,
+    embedding   vector(1024) not null,
+    primary key(id, tag),
+    unique(tag, file_name, start_pos, end_pos)
+) PARTITION BY LIST (tag);
+
+CREATE TABLE ragdata_default PARTITION OF ragdata DEFAULT;
+
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOR t IN SELECT DISTINCT tag FROM ragdata_flat LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF ragdata FOR VALUES IN (%L)', 'ragdata_' || t, t);
+    END LOOP;
+END $$;
+
+INSERT INTO ragdata (id, tag, file_name, start_pos, end_pos, ts, file_body, embedding)
+SELECT id, tag, file_name, start_pos, end_pos, ts, file_body, embedding FROM ragdata_flat;
+
+SELECT setval(pg_get_serial_sequence('ragdata', 'id'), (SELECT coalesce(max(id), 0) + 1 FROM ragdata), false);
+
+DROP TABLE ragdata_flat;
+
+COMMIT;
+
+ANALYZE ragdata;
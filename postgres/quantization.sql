@@ -0,0 +1,17 @@
+-- SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+--
+-- SPDX-License-Identifier: AGPL-3.0-or-later
+
+-- Optional indexes for the two-stage search (see "quantization" in rag/config_rag.json).
+-- The full-precision vectors stay in ragdata.embedding for the exact rerank, the indexes
+-- hold the compact copies the coarse stage searches on. Create the one matching the
+-- configured quantization (requires pgvector >= 0.7). ragdata is partitioned by generation
+-- and tag, so Postgres creates each index on every partition, including the ones created later.
+
+-- "quantization": "halfvec" (2 KiB per vector instead of 4 KiB)
+CREATE INDEX IF NOT EXISTS ragdata_embedding_halfvec_ix ON ragdata
+USING hnsw ((embedding::halfvec(1024)) halfvec_cosine_ops);
+
+-- "quantization": "binary" (128 bytes per vector instead of 4 KiB)
+CREATE INDEX IF NOT EXISTS ragdata_embedding_bit_ix ON ragdata
+USING hnsw ((binary_quantize(embedding)::bit(1024)) bit_hamming_ops);
@@ -0,0 +1,113 @@
+-- SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+--
+-- SPDX-License-Identifier: AGPL-3.0-or-later
+
+-- Migrate a ragdata table with the chunk texts in file_body (see postgres/generation.sql,
+-- run that one first for a table without generations) to the layout of postgres/init.sql:
+-- the text of each file is kept once in ragfile, the chunks in ragdata are spans of it
+-- (file_id, start_pos, end_pos) with the SHA-256 of their text (see rag/libstore.py).
+--
+-- The file texts are put together from the chunks: each chunk adds its text after the
+-- end of the chunks before it (the overlap is only taken once).
+--
+-- Before the chunk texts are dropped, the script checks that the span of each chunk in
+-- its file text is the chunk text and that its hash is the SHA-256 of that span; if not,
+-- it stops with an error and changes nothing (e.g. if the overlapping parts of the chunks
+-- of a file differ, or if the database encoding is not UTF8: substr() then counts bytes,
+-- the positions are characters). Try it on a copy of the database first.
+--
+-- Run once, with the loaders and workers stopped:
+--
+--   psql -U rag ragdb -f ragfile.sql
+--
+-- The indexes of postgres/quantization.sql (and an HNSW index on embedding, if you
+-- created one) are kept. ragdata is rewritten at the end (VACUUM FULL), to give back
+-- the space of the chunk texts: this needs the space of a copy of ragdata while it runs.
+
+\set ON_ERROR_STOP on
+
+BEGIN;
+
+CREATE TABLE ragfile (
+    id          bigserial,
+    tag         text not null,
+    file_name   text not null,
+    ts          timestamp with time zone default now() not null,
+    body        text not null,
+    generation  integer not null,
+    primary key(id, generation, tag),
+    unique(generation, tag, file_name)
+) PARTITION BY LIST (generation);
+
+-- ragfile_g<generation> and ragfile_g<generation>_<tag> for each ragdata_g<generation>
+-- and ragdata_g<generation>_<tag>
+DO $$
+DECLARE
+    g record;
+    t record;
+BEGIN
+    FOR g IN SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+             FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+             WHERE i.inhparent = 'ragdata'::regclass LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF ragfile %s PARTITION BY LIST (tag)',
+                       'ragfile' || substr(g.relname, 8), g.bound);
+        FOR t IN SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+                 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                 WHERE i.inhparent = g.relname::regclass LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I %s',
+                           'ragfile' || substr(t.relname, 8), 'ragfile' || substr(g.relname, 8), t.bound);
+        END LOOP;
+    END LOOP;
+END $$;
+
+INSERT INTO ragfile (tag, file_name, body, generation)
+SELECT tag, file_name,
+       string_agg(CASE WHEN start_pos >= prev_end THEN repeat(' ', (start_pos - prev_end)::integer) || file_body
+                       ELSE substr(file_body, (prev_end - start_pos)::integer + 1) END,
+                  '' ORDER BY start_pos, end_pos),
+       generation
+FROM (SELECT tag, file_name, start_pos, end_pos, file_body, generation,
+             coalesce(max(end_pos) OVER (PARTITION BY generation, tag, file_name ORDER BY start_pos, end_pos
+                                         ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS prev_end
+      FROM ragdata) c
+GROUP BY generation, tag, file_name;
+
+ALTER TABLE ragdata ADD COLUMN file_id bigint;
+ALTER TABLE ragdata ADD COLUMN hash bytea;
+
+UPDATE ragdata d SET file_id = f.id, hash = sha256(convert_to(d.file_body, 'UTF8'))
+FROM ragfile f
+WHERE f.generation = d.generation AND f.tag = d.tag AND f.file_name = d.file_name;
+
+DO $$
+DECLARE
+    r record;
+BEGIN
+    SELECT count(1) OVER () AS n, d.generation, d.tag, d.file_name, d.start_pos, d.end_pos INTO r
+    FROM ragdata d LEFT JOIN ragfile f ON f.id = d.file_id AND f.generation = d.generation AND f.tag = d.tag
+    WHERE substr(f.body, d.start_pos::integer + 1, (d.end_pos - d.start_pos)::integer) IS DISTINCT FROM d.file_body
+       OR sha256(convert_to(substr(f.body, d.start_pos::integer + 1, (d.end_pos - d.start_pos)::integer), 'UTF8'))
+          IS DISTINCT FROM d.hash
+    ORDER BY d.generation, d.tag, d.file_name, d.start_pos
+    LIMIT 1;
+    IF FOUND THEN
+        RAISE EXCEPTION 'ragfile.sql: % chunks are not the span of their file text (e.g. generation %, tag %, file %, % to %), nothing changed',
+            r.n, r.generation, r.tag, r.file_name, r.start_pos, r.end_pos;
+    END IF;
+END $$;
+
+ALTER TABLE ragdata ALTER COLUMN file_id SET NOT NULL;
+ALTER TABLE ragdata ALTER COLUMN hash SET NOT NULL;
+ALTER TABLE ragdata DROP CONSTRAINT ragdata_generation_tag_file_name_start_pos_end_pos_key;
+ALTER TABLE ragdata ADD UNIQUE (generation, tag, file_id, start_pos, end_pos);
+ALTER TABLE ragdata DROP COLUMN file_name;
+ALTER TABLE ragdata DROP COLUMN file_body;
+
+CREATE INDEX ragdata_hash_ix ON ragdata (hash);
+
+COMMIT;
+
+VACUUM FULL ragdata;
+
+ANALYZE ragdata;
+ANALYZE ragfile;
@@ -8,21 +8,39 @@
 # except it communicates with the web backend instead with the user directly.
 #
 # See query.py for details about the interaction with the LLM.
+#
+# At startup, the embedding model is loaded and warmed up before any job is
+# claimed. Meanwhile, the heartbeat sent to the web backend reports the worker
+# as not ready, so the web frontend shows it as unavailable.
+#
+# The worker runs up to "capacity" jobs at the same time (in 'backend.json',
+# default 1), one per thread. Its heartbeat reports its id, the jobs in flight,
+# the capacity and the readiness to the web backend, which keeps them in memory
+# and only hands out jobs to workers with a free slot.
 # ------------------------------------------------------------------------------
 
 import time
 import sys
+import os
 import re
+import socket
 import requests
 import json
+import threading
 from datetime import datetime
 
+time_started = time.time()
+
 
 from librag import *
-from libpg import *
+from libstore import *
+from libllm import *
+from libprompt import *
 
 
 def log(msg: str):
+    if capacity > 1:
+        msg = "[%s] %s" % (threading.current_thread().name, msg)
     print(str(datetime.now()) + " " + msg)
 
 
@@ -38,206 +56,249 @@ except FileNotFoundError:
 
 stuart_web_endpoint = parameters["endpoint"]
 preshared_secret = parameters["preshared_secret"]
+capacity = int(parameters.get("capacity", 1))
+worker_id = parameters.get("worker_id", "%s-%d" % (socket.gethostname(), os.getpid()))
 
-try:
-    file = open("secrets_llm_endpoint.json", "r")
-    llm_service_endpoint = json.load(file)
-    file.close()
-except FileNotFoundError:
-    print("ERROR: cannot open file: secrets_llm_endpoint.json.")
-    sys.exit(1)
-
+rag_config = get_rag_config()
 
-# --- main loop ---
+llm_router = get_llm_router(rag_config)
 
-while True:
 
-    # --- poll for a new job to process ---
+# --- heartbeat ---
 
-    log("polling for new job...")
+# set once the model is loaded and warmed up
+worker_ready = False
 
-    connection_timeout = 2.0
+# jobs claimed and not finished yet
+in_flight = 0
+in_flight_lock = threading.Lock()
 
-    claim = {}
 
+def send_heartbeats():
+    connection_timeout = 2.0
     while True:
-
         try:
-            response = requests.get(stuart_web_endpoint + "/claim_job?secret=" + preshared_secret)
-        except requests.exceptions.ConnectionError:
-            log("sleep %.0f s after ConnectionError" % connection_timeout)
+            requests.post(stuart_web_endpoint + "/heartbeat", timeout=5.0,
+                          data={"secret": preshared_secret, "worker_id": worker_id, "in_flight": in_flight,
+                                "capacity": capacity, "ready": "1" if worker_ready else "0"})
+        except requests.exceptions.RequestException:
             time.sleep(connection_timeout)
             if connection_timeout < 32:
                 connection_timeout *= 2
             continue
-
         connection_timeout = 2.0
+        time.sleep(2.5)
 
-        if response.text.strip() == "{}":
-            time.sleep(1.0)
-            continue
 
-        try:
-            claim = json.loads(response.text)
-        except:
-            log("cannot parse JSON response from claim_job")
-            time.sleep(5.0)
-            continue
-        break
+threading.Thread(target=send_heartbeats, daemon=True).start()
 
-    conversation = json.loads(claim.get("conversation"))
-    conversation_llm = json.loads(claim.get("conversation_llm"))
-    source = json.loads(claim.get("source"))
-    unique_id = claim.get("uuid")
 
-    log("claimed new job uuid = %s" % unique_id )
+# --- startup: load and warm up the embedding model ---
 
-    if not (len(conversation_llm) == 0 and len(conversation) == 1) and not (len(conversation_llm) > 1 and len(conversation_llm) == len(conversation)):
-        log("inconsistent length of conversation arrays (%d, %d) - skipping" % (len(conversation_llm), len(conversation)))
-        continue
+log("loading embedding model...")
+t0 = time.time()
+load_active_embedding_model(rag_config)
+t1 = time.time()
+warm_up_embedding_model(capacity)
+t2 = time.time()
+worker_ready = True
+log("ready: time to ready %.3fs (startup %.3fs, model load %.3fs, warm-up %.3fs)" %
+    (t2 - time_started, t0 - time_started, t1 - t0, t2 - t1))
+log("worker %s, capacity %d" % (worker_id, capacity))
 
-    question = conversation[len(conversation) - 1]
 
-    # --- search ---
+# --- job loop, run by 'capacity' threads ---
 
-    # use the first top_n results out of top_max retrieved
-    # the default is top_n = 1, top_max = 5
+def process_jobs():
 
-    top_n = 1
-    top_max = 5
+    global in_flight
 
-    cursor = open_cursor()
-    if len(conversation_llm) == 0:
-        log("first question - searching...")
-        res = search(cursor, top_max, question)
-    else:
-        log("follow-up question - searching...")
-        res = search(cursor, top_max, conversation[len(conversation) - 2] + "\n" + question)
+    store = None
 
-    top_max = min(len(res), top_max)
-    top_n = min(len(res), top_n, top_max)
+    while True:
 
-    log("")
-    log("embedding vector search - top %d chunks:" % top_max)
-    log("distance   tag  offset  file_name")
-    log("--------   ---  ------  ---------")
-    for i in range(0, top_max):
-        if i < top_n:
-            mark = " <-- will be added to context"
-        else:
-            mark = ""
-        log("%.5f %6s %7d  %s%s" % (res[i]["distance"], res[i]["tag"], res[i]["start_pos"], res[i]["file_name"], mark))
+        # --- poll for a new job to process ---
 
-    log("")
+        log("polling for new job...")
 
-    # --- LLM input ---
+        connection_timeout = 2.0
 
-    if len(res) > 0:
+        claim = {}
+
+        while True:
+
+            try:
+                response = requests.get(stuart_web_endpoint + "/claim_job",
+                                        params={"secret": preshared_secret, "worker_id": worker_id})
+            except requests.exceptions.ConnectionError:
+                log("sleep %.0f s after ConnectionError" % connection_timeout)
+                time.sleep(connection_timeout)
+                if connection_timeout < 32:
+                    connection_timeout *= 2
+                continue
+
+            connection_timeout = 2.0
+
+            if response.text.strip() == "{}":
+                time.sleep(1.0)
+                continue
+
+            try:
+                claim = json.loads(response.text)
+            except:
+                log("cannot parse JSON response from claim_job")
+                time.sleep(5.0)
+                continue
+            break
+
+        with in_flight_lock:
+            in_flight += 1
+        join_query_batch()
+
+        conversation = json.loads(claim.get("conversation"))
+        conversation_llm = json.loads(claim.get("conversation_llm"))
+        source = json.loads(claim.get("source"))
+        unique_id = claim.get("uuid")
+
+        log("claimed new job uuid = %s" % unique_id )
+
+        if not (len(conversation_llm) == 0 and len(conversation) == 1) and not (len(conversation_llm) > 1 and len(conversation_llm) == len(conversation)):
+            log("inconsistent length of conversation arrays (%d, %d) - skipping" % (len(conversation_llm), len(conversation)))
+            leave_query_batch()
+            with in_flight_lock:
+                in_flight -= 1
+            continue
 
-        context = ""
-        source_str = "Source: "
-        for i in range(0, top_n):
-            context = context + res[i]["file_body"]
-            source_str = source_str + "Source: document %s (tag: %s) at offset %d chars." % (res[0]["file_name"], res[0]["tag"], res[0]["start_pos"])
+        question = conversation[len(conversation) - 1]
 
-        source.append(source_str)
+        # --- search ---
 
-    else:
+        # retrieve the top_max chunks, then pack as many of them as fit into the
+        # token budget into the context (see build_context() in 'librag.py')
 
-        context = ""
-        log("zero results from DB, using empty context")
+        top_max = rag_config["search_top_max"]
+        context_token_budget = rag_config["context_token_budget"]
 
-    if len(conversation_llm) == 0:
+        store = keep_store(store, rag_config)
+        if len(conversation_llm) == 0:
+            log("first question - searching...")
+            res = search(store, top_max, question)
+        else:
+            log("follow-up question - searching...")
+            res = search(store, top_max, conversation[len(conversation) - 2] + "\n" + question)
+        leave_query_batch()
 
-        # first iteration
+        top_max = min(len(res), top_max)
 
-        log("first question - inferring...")
+        segments = build_context(res, context_token_budget)
+        packed = set()
+        for seg in segments:
+            packed.update(seg["hits"])
 
-        prompt = (
-f"""
-Answer the question using only the context provided below. Respond in the same language as the question.
-If the answer cannot be fully derived from the context, simply say \"I don't know\".
+        log("")
+        log("embedding vector search - top %d chunks (generation %s):" % (top_max, store.generation))
+        log("distance   tag  offset  file_name")
+        log("--------   ---  ------  ---------")
+        for i in range(0, top_max):
+            if i in packed:
+                mark = " <-- will be added to context"
+            else:
+                mark = ""
+            log("%.5f %6s %7d  %s%s" % (res[i]["distance"], res[i]["tag"], res[i]["start_pos"], res[i]["file_name"], mark))
 
----
-Question:
-{question}
+        log("")
 
----
-Context:
-{context}
-""")
+        # --- LLM input ---
 
-        conversation_llm = [
-                  {"role": "system", "content": "You are an assistant who answers questions."},
-                  {"role": "user",   "content": prompt}
-        ]
+        if len(segments) > 0:
 
-    else:
+            context = format_context(segments)
+            log("context: %d segments from %d chunks, ~%d tokens" % (len(segments), len(packed), estimate_tokens(context)))
+            source_str = "Source: " + ", ".join(["document %s (tag: %s) at offset %d chars" %
+                                                 (seg["file_name"], seg["tag"], seg["start_pos"]) for seg in segments]) + "."
 
-        # follow-up iteration
+            source.append(source_str)
 
-        log("follow-up question - inferring...")
+        else:
 
-        prompt = (
-f"""
-Answer the follow-up question based on the context of this conversation. Respond in the same language as the question.
-If the answer cannot be fully derived from the context, simply say \"I don't know\".
+            context = ""
+            log("zero results from DB, using empty context")
 
----
-Question:
-{question}
+        # the conversation so far is sent unchanged and the new question with its
+        # context goes last, so the LLM server can reuse the KV cache of the previous
+        # call (see 'libprompt.py')
 
----
-Here is additional context.
-If it is not relevant, ignore it. Otherwise, use it to refine your answer:
-{context}
-""")
+        if len(conversation_llm) == 0:
+            log("first question - inferring...")
+        else:
+            log("follow-up question - inferring...")
 
-        conversation_llm.append({"role": "user", "content": prompt})
+        conversation_llm = prompt_messages(conversation_llm, question, context)
 
-    # --- LLM output ---
+        # --- LLM output ---
 
-    t0 = time.time()
+        t0 = time.time()
 
-    try:
+        endpoint_name = "-"
+        usage = "no usage reported"
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + llm_service_endpoint.get("api_key")
-        }
-        data = {
-            "model": llm_service_endpoint.get("model"),
-            "messages": conversation_llm
+        try:
+
+            result = llm_router.chat(conversation_llm)
+            answer = prompt_answer(result["choices"][0].get("message"))
+            endpoint_name = result["endpoint"]
+            usage = prompt_usage(result)
+
+        except LlmError as e:
+
+            log("LLM error: %s" % e)
+            if not e.retryable:
+                answer = prompt_answer_content("[LLM exception, context length might be exceeded, "
+                                               "please start a new session]")
+            else:
+                answer = prompt_answer_content("[LLM service unavailable, please try again later]")
+
+        t1 = time.time()
+
+        conversation_llm.append(answer)
+        conversation.append(answer["content"])
+
+        log("LLM output in %6.3fs (%s), %s" % (t1-t0, endpoint_name, usage))
+        log("")
+
+        post_data = {
+            "secret": preshared_secret,
+            "uuid": unique_id,
+            "conversation_llm": json.dumps(conversation_llm),
+            "conversation": json.dumps(conversation),
+            "source": json.dumps(source),
+            "worker_id": worker_id
         }
-        response = requests.post(llm_service_endpoint.get("endpoint"), headers=headers, json=data)
-        result = response.json()
-        answer = result["choices"][0].get("message").get("content")
+        response = requests.post(stuart_web_endpoint + "/finish_job", data=post_data)
+        log("post results: %d %s" % (response.status_code, response.text))
 
-    except Exception as e:
+        with in_flight_lock:
+            in_flight -= 1
 
-        answer = "[LLM exception, context length might be exceeded, please start a new session]"
 
-    t1 = time.time()
+        log("--------------------------------------------------------------------------")
+        print(conversation_llm)
+        log("--------------------------------------------------------------------------")
+        print(conversation)
+        log("--------------------------------------------------------------------------")
 
-    conversation_llm.append({"role": "assistant", "content": answer})
-    conversation.append(answer)
 
-    log("LLM output in %6.3fs" % (t1-t0))
-    log("")
+def exit_on_exception(args):
+    # as with a single job loop, an unexpected error ends the worker (and its
+    # service manager restarts it) instead of leaving it with a thread less
+    sys.__excepthook__(args.exc_type, args.exc_value, args.exc_traceback)
+    os._exit(1)
 
-    post_data = {
-        "secret": preshared_secret,
-        "uuid": unique_id,
-        "conversation_llm": json.dumps(conversation_llm),
-        "conversation": json.dumps(conversation),
-        "source": json.dumps(source)
-    }
-    response = requests.post(stuart_web_endpoint + "/finish_job", data=post_data)
-    log("post results: %d %s" % (response.status_code, response.text))
 
+threading.excepthook = exit_on_exception
 
-    log("--------------------------------------------------------------------------")
-    print(conversation_llm)
-    log("--------------------------------------------------------------------------")
-    print(conversation)
-    log("--------------------------------------------------------------------------")
+threads = [threading.Thread(target=process_jobs, name="job-%d" % (i + 1)) for i in range(0, capacity)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
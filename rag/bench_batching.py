@@ -0,0 +1,90 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Compare embedding the queries of concurrent jobs one by one with the
+# micro-batching of 'libbatch.py'.
+#
+# For 1, 2, 4 and 8 concurrent callers (as jobs of a worker with that "capacity"),
+# each embedding its queries in a loop, prints the throughput (queries per second)
+# and the latency seen by a caller (average and p95), without batching (each
+# caller calls model.encode(), as search() did before) and with batching for a
+# few settings of the maximum wait.
+#
+# Uses the embedding backend configured in 'config_rag.json' (see
+# get_embedding_model() in 'librag.py').
+# ------------------------------------------------------------------------------
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from librag import *
+from libbatch import *
+
+
+queries = [
+    "What does gulp do?",
+    "How do you install it?",
+    "Wie heisst der blaue Elefant?",
+    "Che nome ha il robot che deve proteggere la colonia spaziale?",
+    "Name the planets in the solar system!",
+    "What's the name of the cat?"
+]
+queries_per_caller = 24
+callers_list = [1, 2, 4, 8]
+max_batch = 8
+wait_ms_list = [2.0, 5.0, 10.0]
+
+
+def run_callers(encoder: any, callers: int) -> (float, List[float]):
+    # returns the wall time and the latency of each query
+
+    def caller(c: int) -> List[float]:
+        # each caller is a job about to search, as long as it runs (see join() in 'libbatch.py')
+        if isinstance(encoder, EmbeddingBatcher):
+            encoder.join()
+        latencies = []
+        for i in range(0, queries_per_caller):
+            t0 = time.time()
+            encoder.encode(queries[(c + i) % len(queries)])
+            latencies.append(time.time() - t0)
+        if isinstance(encoder, EmbeddingBatcher):
+            encoder.leave()
+        return latencies
+
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        results = list(executor.map(caller, range(0, callers)))
+    t1 = time.time()
+    return t1 - t0, [latency for latencies in results for latency in latencies]
+
+
+def report(name: str, callers: int, seconds: float, latencies: List[float], mean_batch: any) -> None:
+    print("%-16s %7d %10.1f %10.1f %10.1f %10s" %
+          (name, callers, len(latencies) / seconds, 1000 * np.mean(latencies), 1000 * np.percentile(latencies, 95),
+           "-" if mean_batch is None else "%.2f" % mean_batch))
+
+
+def main() -> None:
+    config = get_rag_config()
+    print("embedding backend %s, %d queries per caller" % (config["embedding_backend"], queries_per_caller))
+    model = get_embedding_model()
+    warm_up_embedding_model()
+    batchers = {wait_ms: EmbeddingBatcher(model, max_batch, wait_ms / 1000.0) for wait_ms in wait_ms_list}
+
+    print("%-16s %7s %10s %10s %10s %10s" % ("encoder", "callers", "queries/s", "avg ms", "p95 ms", "avg batch"))
+    for callers in callers_list:
+        seconds, latencies = run_callers(model, callers)
+        report("unbatched", callers, seconds, latencies, None)
+        for wait_ms, batcher in batchers.items():
+            before = batcher.status()
+            seconds, latencies = run_callers(batcher, callers)
+            after = batcher.status()
+            report("batch %g ms" % wait_ms, callers, seconds, latencies,
+                   (after["queries"] - before["queries"]) / (after["batches"] - before["batches"]))
+
+
+main()
@@ -0,0 +1,84 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Compare the embedding backends (see get_embedding_model() in 'librag.py'):
+# PyTorch, ONNX Runtime and ONNX Runtime with int8 weights.
+#
+# For each backend, prints the query latency (single short strings, as embedded
+# by search() on every request), the throughput on chunks of the example documents
+# (as embedded by rag_dir()) and the cosine similarity of the vectors to the PyTorch
+# reference.
+#
+# Needs the packages from 'requirements-onnx.txt'. Exports the ONNX models into
+# "onnx_model_dir" from 'config_rag.json' if they are not there yet.
+# ------------------------------------------------------------------------------
+
+import time
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from librag import *
+from libonnx import *
+
+
+queries = [
+    "What does gulp do?",
+    "How do you install it?",
+    "Wie heisst der blaue Elefant?",
+    "Che nome ha il robot che deve proteggere la colonia spaziale?",
+    "Name the planets in the solar system!",
+    "What's the name of the cat?"
+]
+repeat = 5
+
+
+def load_chunks(dirname: str) -> List[str]:
+    strings = []
+    for file_name in sorted(os.listdir(dirname)):
+        file = open("%s/%s" % (dirname, file_name), "r")
+        body = file.read()
+        file.close()
+        for chunk in chunk_text(body, 2000, 200, 2500):
+            strings.append(body[chunk["start"]:chunk["end"]])
+    return strings
+
+
+def bench(name: str, model: any, chunks: List[str], reference: np.ndarray) -> None:
+    model.encode(queries[0])  # warm-up
+    latencies = []
+    for i in range(0, repeat):
+        for query in queries:
+            t0 = time.time()
+            model.encode(query)
+            latencies.append(time.time() - t0)
+    t0 = time.time()
+    vectors = model.encode(chunks, batch_size=8)
+    t1 = time.time()
+    cosine = cosine_similarities(vectors, reference)
+    print("%-12s %10.1f %10.1f %12.2f %10.5f %10.5f" %
+          (name, 1000 * np.mean(latencies), 1000 * np.percentile(latencies, 95), len(chunks) / (t1 - t0),
+           cosine.min(), cosine.mean()))
+
+
+def main() -> None:
+    config = get_rag_config()
+    chunks = load_chunks("../data_example")
+    print("%d queries x %d, %d chunks of up to 2500 chars" % (len(queries), repeat, len(chunks)))
+
+    torch_model = SentenceTransformer("BAAI/bge-m3", revision="5a212480c9a75bb651bcb894978ed409e4c47b82")
+    reference = torch_model.encode(chunks, batch_size=8)
+
+    print("%-12s %10s %10s %12s %10s %10s" % ("backend", "avg ms", "p95 ms", "chunks/s", "min cos", "avg cos"))
+    bench("torch", torch_model, chunks, reference)
+    del torch_model
+    for quantize in [False, True]:
+        model = OnnxEmbeddingModel(config["onnx_model_dir"], "BAAI/bge-m3", "5a212480c9a75bb651bcb894978ed409e4c47b82",
+                                   quantize, 0.0)
+        bench("onnx-int8" if quantize else "onnx", model, chunks, reference)
+        del model
+
+
+main()
@@ -0,0 +1,115 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Exercise the LLM router (see 'libllm.py') against local stub servers that speak
+# the OpenAI chat completion API.
+#
+# Two endpoints, "fast" (50 ms per completion) and "slow" (300 ms), go through a
+# few phases: both healthy, "fast" answering HTTP 500, "fast" hanging beyond the
+# read timeout, "fast" healthy again. For each phase, prints how many calls went
+# to each endpoint, how many failed and the p50/p95 latency seen by the caller.
+#
+# Needs no LLM, no model and no database:
+#
+#   python bench_llm.py
+# ------------------------------------------------------------------------------
+
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+from librag import *
+from libllm import *
+
+
+ports = {"fast": 8771, "slow": 8772}
+calls_per_phase = 200
+concurrency = 4
+
+# behaviour of the stub endpoints: latency in seconds and mode "ok", "error" or "hang"
+stubs = {"fast": {"latency": 0.05, "mode": "ok"}, "slow": {"latency": 0.3, "mode": "ok"}}
+
+
+def make_handler(name: str):
+
+    class StubHandler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            stub = stubs[name]
+            if stub["mode"] == "hang":
+                time.sleep(5.0)
+            time.sleep(stub["latency"])
+            if stub["mode"] == "error":
+                body = b'{"error": "internal error"}'
+                self.send_response(500)
+            else:
+                body = json.dumps({"choices": [{"message": {"role": "assistant", "content": "Hello from %s" % name}}],
+                                   "model": request["model"],
+                                   "usage": {"prompt_tokens": 10, "completion_tokens": 3}}).encode("utf-8")
+                self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            try:
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # the router gave up waiting (read timeout)
+                pass
+
+    return StubHandler
+
+
+def call(router: LlmRouter) -> (str, float):
+    t0 = time.time()
+    try:
+        endpoint = router.chat([{"role": "user", "content": "Hi!"}])["endpoint"]
+    except LlmError:
+        endpoint = "failed"
+    return endpoint, time.time() - t0
+
+
+def run_phase(router: LlmRouter, title: str) -> None:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda i: call(router), range(0, calls_per_phase)))
+    latencies = sorted([seconds for endpoint, seconds in results])
+    counts = {name: len([1 for endpoint, seconds in results if endpoint == name]) for name in list(ports) + ["failed"]}
+    print("%-22s %6d %6d %7d %9.0f %9.0f   %s" %
+          (title, counts["fast"], counts["slow"], counts["failed"],
+           1000 * latencies[len(latencies) // 2], 1000 * latencies[int(len(latencies) * 0.95)],
+           ", ".join(["%s %s" % (status["name"], status["state"]) for status in router.status()])))
+
+
+def main() -> None:
+    for name, port in ports.items():
+        server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(name))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    config = get_rag_config()
+    config.update({"llm_read_timeout_sec": 1.0, "llm_retry_backoff_sec": 0.05, "llm_breaker_open_sec": 2.0})
+    router = LlmRouter([{"name": name, "endpoint": "http://127.0.0.1:%d/v1/chat/completions" % port,
+                         "model": "stub"} for name, port in ports.items()], config)
+
+    print("%d calls per phase, %d at a time" % (calls_per_phase, concurrency))
+    print("%-22s %6s %6s %7s %9s %9s   %s" % ("phase", "fast", "slow", "failed", "p50 ms", "p95 ms", "breakers after"))
+    run_phase(router, "both healthy")
+    stubs["fast"]["mode"] = "error"
+    run_phase(router, "fast: HTTP 500")
+    stubs["fast"]["mode"] = "hang"
+    time.sleep(config["llm_breaker_open_sec"])
+    run_phase(router, "fast: hangs")
+    stubs["fast"]["mode"] = "ok"
+    time.sleep(config["llm_breaker_open_sec"])
+    run_phase(router, "fast: recovered")
+
+
+main()
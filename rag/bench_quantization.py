@@ -0,0 +1,119 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Benchmark the quantization options of the local vector store (see 'libstore.py'):
+# memory and disk per chunk and search latency against recall@10, with the exact
+# float32 search as reference.
+#
+# Usage:
+#
+#   python bench_quantization.py             # synthetic clustered vectors
+#   python bench_quantization.py DIRECTORY   # vectors from an existing local store
+#
+# The stores are built in a temporary directory that is removed at the end.
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+from libstore import *
+
+
+num_vectors = 20000
+num_clusters = 200
+num_queries = 200
+dim = 1024
+top = 10
+
+
+def load_vectors() -> np.ndarray:
+    if len(sys.argv) > 1:
+        store = LocalStore(sys.argv[1], "float32", "none", 0)
+        if store.matrix is None:
+            print("ERROR: no vectors in local store '%s'." % sys.argv[1])
+            sys.exit(1)
+        return np.asarray(store.matrix, dtype=np.float32)
+    rng = np.random.default_rng(42)
+    centers = rng.normal(size=(num_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, num_clusters, num_vectors)
+    return centers[labels] + 0.8 * rng.normal(size=(num_vectors, dim)).astype(np.float32)
+
+
+def build_store(dirname: str, vectors: np.ndarray, dtype: str) -> None:
+    store = LocalStore(dirname, dtype, "none", 0)
+    for i in range(0, len(vectors), 10):
+        # files of 10 chunks, one line each
+        lines = ["chunk %d\n" % j for j in range(i, min(i + 10, len(vectors)))]
+        store.add_file("bench", "file-%d" % (i // 10), "".join(lines))
+        pos = 0
+        for j in range(0, len(lines)):
+            store.add_chunk("bench", "file-%d" % (i // 10), pos, pos + len(lines[j]), vectors[i + j])
+            pos += len(lines[j])
+    store.commit()
+    store.close()
+
+
+def disk_bytes(dirname: str, quantization: str) -> int:
+    names = ["embeddings.bin"]
+    if quantization == "binary":
+        names.append("bits.bin")
+    return sum([os.path.getsize("%s/%s" % (dirname, name)) for name in names])
+
+
+def run(dirname: str, dtype: str, quantization: str, candidates: int,
+        queries: np.ndarray, reference: List[set]) -> None:
+    store = LocalStore(dirname, dtype, quantization, candidates)
+    latencies = []
+    hits = 0
+    for i in range(0, len(queries)):
+        t0 = time.time()
+        res = store.search(queries[i], top)
+        latencies.append(time.time() - t0)
+        hits += len(reference[i] & set([r["file_body"] for r in res]))
+    n = len(store.chunks)
+    memory = n * dim * np.dtype(dtype).itemsize
+    if quantization == "binary":
+        # the coarse stage scans the bits only, the full vectors of the candidates are paged in
+        memory = n * dim // 8 + candidates * dim * np.dtype(dtype).itemsize
+    label = "%s %s" % (dtype, quantization)
+    if quantization != "none":
+        label += " (%d cand.)" % candidates
+    print("%-30s %10.1f %10.1f %8.2f %8.2f %8.3f" %
+          (label, memory / 1024 / 1024, disk_bytes(dirname, quantization) / n,
+           1000 * np.mean(latencies), 1000 * np.percentile(latencies, 95), hits / (len(queries) * top)))
+
+
+def main() -> None:
+    vectors = load_vectors()
+    rng = np.random.default_rng(7)
+    picks = rng.integers(0, len(vectors), num_queries)
+    queries = vectors[picks] + 0.5 * rng.normal(size=(num_queries, vectors.shape[1])).astype(np.float32)
+    print("%d vectors, %d queries, recall@%d against exact float32 search" % (len(vectors), num_queries, top))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        stores = {}
+        for dtype in ["float32", "float16"]:
+            stores[dtype] = "%s/%s" % (tmp, dtype)
+            build_store(stores[dtype], vectors, dtype)
+
+        exact = LocalStore(stores["float32"], "float32", "none", 0)
+        reference = [set([r["file_body"] for r in exact.search(q, top)]) for q in queries]
+
+        print("%-30s %10s %10s %8s %8s %8s" % ("store", "scan MiB", "disk B/vec", "avg ms", "p95 ms", "recall"))
+        run(stores["float32"], "float32", "none", 0, queries, reference)
+        run(stores["float16"], "float16", "none", 0, queries, reference)
+        for candidates in [50, 100, 200, 400]:
+            run(stores["float16"], "float16", "binary", candidates, queries, reference)
+    finally:
+        shutil.rmtree(tmp)
+
+
+main()
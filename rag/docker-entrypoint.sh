@@ -1,6 +1,6 @@
 #!/bin/sh
 # Generates the JSON config files expected by the RAG Python scripts from environment variables,
-# then executes the container command. All variables except LLM_API_KEY are required:
+# then executes the container command. All variables except LLM_API_KEY and WORKER_CAPACITY are required:
 # the container will exit immediately with "unbound variable" if any of them are missing.
 set -eu
 
@@ -29,7 +29,8 @@ EOF
 cat > /usr/src/app/backend.json <<EOF
 {
   "endpoint": "${STUART_WEB_ENDPOINT}",
-  "preshared_secret": "${PRESHARED_SECRET}"
+  "preshared_secret": "${PRESHARED_SECRET}",
+  "capacity": ${WORKER_CAPACITY-1}
 }
 EOF
 
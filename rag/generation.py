@@ -0,0 +1,98 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Manage the generations of the corpus (see 'libstore.py').
+#
+# To change the chunking in 'load.py' (or the embedding model) without taking the
+# search down while everything is loaded again:
+#
+#   python generation.py create "chunk_len 3000"    # prints the new generation, e.g. 2
+#   python load.py 2                                # load into it, the chatbot keeps
+#                                                   # searching the active generation
+#   python generation.py switch 2                   # the next questions search generation 2
+#   python generation.py rollback                   # back to the generation active before
+#   python generation.py drop 1                     # once generation 1 is not needed anymore
+#
+# Without arguments, lists the generations with their number of chunks, embedding
+# model and chunk lengths.
+#
+# A new generation is embedded with "embedding_model" and "embedding_model_revision"
+# in 'config_rag.json' (for another model, change these first), its first load records
+# the chunk lengths of 'load.py' and the next loads must use the same.
+#
+# The switch takes effect for each job of 'backend_query.py' that starts afterwards,
+# without a restart; the workers load the embedding model of the generation they search
+# if it is another one (see search() in 'librag.py').
+#
+# 'load.py' without a generation and 'ingest_daemon.py' load into the active one:
+# after the switch, the daemon (or the next run of 'load.py') brings the new
+# generation up to date with the changes made while it was loaded.
+# ------------------------------------------------------------------------------
+
+import sys
+from datetime import datetime
+
+from librag import *
+
+
+def format_time(value: any) -> str:
+    # timestamps are datetimes in Postgres and seconds since the epoch in the local store
+    if not value:
+        return "-"
+    if not isinstance(value, datetime):
+        value = datetime.fromtimestamp(value)
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def usage() -> None:
+    print("usage: python generation.py [create <description> | switch <generation> | rollback | drop <generation>]")
+    sys.exit(1)
+
+
+def format_chunking(entry: Dict[str, any]) -> str:
+    # not known before the first load
+    if entry["chunk_len"] is None:
+        return "-"
+    return "%d/%d" % (entry["chunk_len"], entry["overlap_len"])
+
+
+def print_generations(store: VectorStore) -> None:
+    print("generation  active   chunks  chunk/overlap  created              activated            model"
+          "                        description")
+    for entry in store.list_generations():
+        print("%10d  %6s  %7d  %13s  %-19s  %-19s  %-27s  %s" %
+              (entry["generation"], "*" if entry["active"] else "", entry["chunks"], format_chunking(entry),
+               format_time(entry["created"]), format_time(entry["activated"]),
+               "%s@%s" % (entry["embedding_model"], entry["embedding_model_revision"][:7]), entry["description"]))
+
+
+def main() -> None:
+    config = get_rag_config()
+    store = open_store(config)
+    if len(sys.argv) == 1:
+        print_generations(store)
+    elif sys.argv[1] == "create" and len(sys.argv) == 3:
+        generation = store.create_generation(sys.argv[2], config["embedding_model"], config["embedding_model_revision"])
+        print("created generation %d with model %s (revision %s), load it with 'python load.py %d'" %
+              (generation, config["embedding_model"], config["embedding_model_revision"], generation))
+    elif sys.argv[1] == "switch" and len(sys.argv) == 3:
+        store.switch_generation(int(sys.argv[2]))
+        print("switched to generation %d" % int(sys.argv[2]))
+    elif sys.argv[1] == "rollback" and len(sys.argv) == 2:
+        generation = previous_generation(store)
+        if generation is None:
+            print("ERROR: no generation to roll back to.")
+            sys.exit(1)
+        store.switch_generation(generation)
+        print("rolled back to generation %d" % generation)
+    elif sys.argv[1] == "drop" and len(sys.argv) == 3:
+        store.drop_generation(int(sys.argv[2]))
+        print("dropped generation %d" % int(sys.argv[2]))
+    else:
+        usage()
+    store.close()
+
+
+main()
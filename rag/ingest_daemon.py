@@ -0,0 +1,256 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Long-running alternative to 'load.py': keeps the embedding model loaded, watches
+# the directories given below with inotify and loads new or changed files within
+# seconds.
+#
+# Each directory is registered with watch_dir(), with the same parameters as
+# rag_dir() in 'load.py'. At start, all directories are loaded once (catching up
+# with whatever happened while the daemon was not running). Then, each write,
+# move or deletion of a .txt or .md file schedules its directory; once no event
+# arrived for "ingest_debounce_sec" seconds (or at the latest "ingest_max_delay_sec"
+# seconds after the first event, so that a continuous stream of writes cannot hold
+# it back), rag_dir() runs for the directory. Directories with journal=True are also
+# scheduled when the change journal is written (see 'scrapers/libjournal.py') and
+# only look at the journaled files; the others only look at the files named by the
+# events: new and modified files are (re)loaded, deleted files are removed (the whole
+# directory is only listed at start and when the kernel dropped events).
+#
+# The backlog and the throughput are served as JSON on
+# http://127.0.0.1:<"ingest_status_port">/status (settings in 'config_rag.json').
+#
+# Linux only (inotify). Run it in place of the 'cron-load.sh' cronjob, for example
+# with 'nohup python ingest_daemon.py &' or as a systemd service.
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import json
+import ctypes
+import select
+import struct
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from librag import *
+
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+known_extensions = [".txt", ".md"]
+
+directories = []
+directories_lock = threading.Lock()
+time_started = time.time()
+ready = False
+
+
+def watch_dir(dirname: str, tag: str,
+              chunk_len: int, overlap_len: int, hard_limit: int, journal: bool = False) -> None:
+    directories.append({"dirname": dirname, "tag": tag, "chunk_len": chunk_len, "overlap_len": overlap_len,
+                        "hard_limit": hard_limit, "journal": journal,
+                        # scheduling: time of the first and last event not handled yet, and the
+                        # files they name (file name -> change, None: list the directory)
+                        "first_event": None, "last_event": None, "pending_events": 0, "changed_files": {},
+                        # statistics
+                        "runs": 0, "files": 0, "files_deleted": 0, "chunks": 0, "chunks_reused": 0,
+                        "busy_seconds": 0.0,
+                        "last_run": None, "last_run_seconds": None, "journal_position": None})
+
+
+class Inotify:
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            print("ERROR: Inotify(): inotify_init() failed: %s." % os.strerror(ctypes.get_errno()))
+            sys.exit(1)
+        self.watches = {}
+
+    def add_watch(self, dirname: str, mask: int) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirname), mask)
+        if wd < 0:
+            print("ERROR: Inotify(): cannot watch '%s': %s." % (dirname, os.strerror(ctypes.get_errno())))
+            sys.exit(1)
+        self.watches[wd] = dirname
+
+    def read_events(self, timeout: float) -> List[tuple]:
+        # (directory, mask, file name) of the events arrived within timeout seconds
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        i = 0
+        while i + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, i)
+            name = os.fsdecode(data[i + 16:i + 16 + length].rstrip(b"\0"))
+            events.append((self.watches.get(wd), mask, name))
+            i += 16 + length
+        return events
+
+
+def schedule(directory: Dict[str, any], now: float, name: Optional[str] = None, change: str = "modified") -> None:
+    # a change of the file name in the directory, of an unknown set of files if None
+    if directory["first_event"] is None:
+        directory["first_event"] = now
+    directory["last_event"] = now
+    directory["pending_events"] += 1
+    if name is None:
+        directory["changed_files"] = None
+    elif directory["changed_files"] is not None:
+        directory["changed_files"][name] = change
+
+
+def handle_events(events: List[tuple], journal_dir: str) -> None:
+    now = time.time()
+    with directories_lock:
+        for dirname, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, look at everything
+                for directory in directories:
+                    schedule(directory, now)
+                continue
+            if dirname == journal_dir:
+                if name == os.path.basename(journal_file_name):
+                    for directory in directories:
+                        if directory["journal"]:
+                            schedule(directory, now)
+                continue
+            # skip temporary files, they show up again when moved into place
+            if name.startswith(".") or os.path.splitext(name)[1] not in known_extensions:
+                continue
+            for directory in directories:
+                if directory["dirname"] == dirname:
+                    schedule(directory, now, name, "deleted" if mask & (IN_MOVED_FROM | IN_DELETE) else "modified")
+
+
+def due_directories(config: Dict[str, any]) -> List[tuple]:
+    # (directory, changed files) of the directories to load now
+    now = time.time()
+    due = []
+    with directories_lock:
+        for directory in directories:
+            if directory["last_event"] is None:
+                continue
+            if now - directory["last_event"] >= config["ingest_debounce_sec"] or \
+                    now - directory["first_event"] >= config["ingest_max_delay_sec"]:
+                due.append((directory, directory["changed_files"]))
+                directory["first_event"] = directory["last_event"] = None
+                directory["pending_events"] = 0
+                directory["changed_files"] = {}
+    return due
+
+
+def load_directory(directory: Dict[str, any], changed_files: Optional[Dict[str, str]] = None) -> None:
+    # the changed files are ignored with journal=True, the journal has them
+    t0 = time.time()
+    stats = rag_dir(directory["dirname"], directory["tag"], directory["chunk_len"], directory["overlap_len"],
+                    directory["hard_limit"], journal=directory["journal"], changed_files=changed_files)
+    t1 = time.time()
+    with directories_lock:
+        directory["runs"] += 1
+        directory["files"] += stats["files_new"]
+        directory["files_deleted"] += stats["files_deleted"]
+        directory["chunks"] += stats["chunks"]
+        directory["chunks_reused"] += stats["chunks_reused"]
+        directory["busy_seconds"] += t1 - t0
+        directory["last_run"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t1))
+        directory["last_run_seconds"] = t1 - t0
+        directory["journal_position"] = stats["journal_position"]
+
+
+def get_status() -> Dict[str, any]:
+    journal_end = journal_size()
+    status = {"uptime_seconds": int(time.time() - time_started), "ready": ready, "directories": []}
+    with directories_lock:
+        for directory in directories:
+            backlog = {"pending_events": directory["pending_events"],
+                       "waiting_seconds": time.time() - directory["first_event"]
+                       if directory["first_event"] is not None else 0.0}
+            if directory["journal"] and directory["journal_position"] is not None:
+                backlog["journal_bytes"] = max(journal_end - directory["journal_position"], 0)
+            status["directories"].append({
+                "dirname": directory["dirname"], "tag": directory["tag"], "backlog": backlog,
+                "runs": directory["runs"], "files": directory["files"], "files_deleted": directory["files_deleted"],
+                "chunks": directory["chunks"], "chunks_reused": directory["chunks_reused"],
+                "chunks_per_sec": directory["chunks"] / directory["busy_seconds"]
+                if directory["busy_seconds"] > 0 else None,
+                "last_run": directory["last_run"], "last_run_seconds": directory["last_run_seconds"]})
+    return status
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps(get_status(), indent=1).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main() -> None:
+    global ready
+
+    config = get_rag_config()
+    if len(directories) == 0:
+        print("ERROR: ingest_daemon: no directories to watch.")
+        sys.exit(1)
+
+    server = ThreadingHTTPServer(("127.0.0.1", config["ingest_status_port"]), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # watch before the first load, so that nothing written during it is missed
+    inotify = Inotify()
+    for directory in directories:
+        inotify.add_watch(directory["dirname"], IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE)
+    journal_dir = os.path.dirname(journal_file_name)
+    if any([directory["journal"] for directory in directories]):
+        os.makedirs(journal_dir, exist_ok=True)
+        inotify.add_watch(journal_dir, IN_CLOSE_WRITE | IN_MODIFY)
+
+    t0 = time.time()
+    load_active_embedding_model(config)
+    warm_up_embedding_model()
+    print("INFO: ingest_daemon: model ready in %.1f seconds" % (time.time() - t0))
+    for directory in directories:
+        load_directory(directory)
+    ready = True
+    print("INFO: ingest_daemon: watching %d directories, status on http://127.0.0.1:%d/status" %
+          (len(directories), config["ingest_status_port"]))
+
+    while True:
+        handle_events(inotify.read_events(0.5), journal_dir)
+        for directory, changed_files in due_directories(config):
+            load_directory(directory, changed_files)
+
+
+watch_dir("../data_example", tag="example", chunk_len=5000, overlap_len=500, hard_limit=6000)
+
+# used at NOI Techpark:
+# watch_dir("../data_ghissues", tag="ghissues", chunk_len=5000, overlap_len=500, hard_limit=6000, journal=True)
+# watch_dir("../data_readme",   tag="readme",   chunk_len=5000, overlap_len=500, hard_limit=6000, journal=True)
+# watch_dir("../data_rt",       tag="rt",       chunk_len=5000, overlap_len=500, hard_limit=6000, journal=True)
+# watch_dir("../data_wiki",     tag="wiki",     chunk_len=5000, overlap_len=500, hard_limit=6000, journal=True)
+
+main()
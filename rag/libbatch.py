@@ -0,0 +1,114 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Micro-batching of query embeddings.
+#
+# When a worker runs several jobs at the same time (see "capacity" in
+# 'backend_query.py'), each job embeds its query with its own encode() call, and
+# the calls compete for the same CPU cores. Encoding the queries together, in one
+# forward pass, is cheaper than encoding them one after the other.
+#
+# EmbeddingBatcher runs one thread that owns the model. encode() puts the query
+# into a queue and waits for its future; the thread takes the first query from
+# the queue, collects more for up to "max_wait_sec" or until it has "max_batch",
+# encodes them with one call to model.encode() and sets the results of the futures.
+#
+# The callers that are about to submit a query (the jobs between claim and search)
+# announce themselves with join() and call leave() when they are done: once the
+# queries of all joined callers are in the batch, no other query can arrive and the
+# batch is encoded without waiting any longer. So a query waits at most
+# "max_wait_sec" longer than it would without batching, and not at all if it is the
+# only one. With max_batch 1 the queries are encoded one at a time, without waiting.
+#
+# See 'bench_batching.py' for throughput and latency with and without batching.
+# ------------------------------------------------------------------------------
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Dict
+
+import numpy as np
+
+
+class EmbeddingBatcher:
+
+    def __init__(self, model: any, max_batch: int, max_wait_sec: float):
+        self.model = model
+        self.max_batch = max(int(max_batch), 1)
+        self.max_wait_sec = max_wait_sec
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        # callers between join() and leave()
+        self.callers = 0
+        # statistics: number of batches and of queries encoded
+        self.batches = 0
+        self.queries = 0
+        threading.Thread(target=self.run, name="embedding-batcher", daemon=True).start()
+
+    def submit(self, query_str: str) -> Future:
+        future = Future()
+        self.requests.put((query_str, future))
+        return future
+
+    def encode(self, query_str: str) -> np.ndarray:
+        return self.submit(query_str).result()
+
+    def join(self) -> None:
+        with self.lock:
+            self.callers += 1
+
+    def leave(self) -> None:
+        with self.lock:
+            self.callers -= 1
+        # wake up collect(), the batch may be complete now
+        self.requests.put(None)
+
+    def collect(self) -> List[tuple]:
+        # blocks for the first request, then takes more until the batch is full, it
+        # has the queries of all joined callers or max_wait_sec has passed (None in
+        # the queue is the wake-up of leave())
+        batch = []
+        while len(batch) == 0:
+            request = self.requests.get()
+            if request is not None:
+                batch.append(request)
+        deadline = time.time() + self.max_wait_sec
+        while len(batch) < self.max_batch:
+            with self.lock:
+                callers = self.callers
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0 and len(batch) < callers:
+                    request = self.requests.get(timeout=remaining)
+                else:
+                    request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                batch.append(request)
+        return batch
+
+    def run(self) -> None:
+        while True:
+            batch = self.collect()
+            try:
+                vectors = self.model.encode([query_str for query_str, future in batch], batch_size=len(batch))
+            except Exception as e:
+                for query_str, future in batch:
+                    future.set_exception(e)
+                continue
+            for i, (query_str, future) in enumerate(batch):
+                future.set_result(vectors[i])
+            with self.lock:
+                self.batches += 1
+                self.queries += len(batch)
+
+    def status(self) -> Dict[str, any]:
+        with self.lock:
+            return {"batches": self.batches, "queries": self.queries,
+                    "mean_batch": self.queries / self.batches if self.batches > 0 else None}
+
@@ -0,0 +1,216 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# LLM client: sends chat completions to one or more OpenAI-compatible endpoints.
+#
+# 'secrets_llm_endpoint.json' is either one endpoint or a list of them, e.g. a local
+# Ollama and OpenRouter as fallback:
+#
+#   [
+#     {"name": "ollama", "endpoint": "http://127.0.0.1:11434/v1/chat/completions",
+#      "model": "mistral-small3.2:24b-instruct-2506-q8_0", "api_key": ""},
+#     {"name": "openrouter", "endpoint": "https://openrouter.ai/api/v1/chat/completions",
+#      "model": "mistralai/mistral-small-3.2-24b-instruct", "api_key": "sk-...",
+#      "read_timeout": 60}
+#   ]
+#
+# For each call, LlmRouter.chat() picks the endpoint with the lowest expected cost,
+# its EWMA latency divided by its EWMA success rate (endpoints not measured yet are
+# tried first, in the order of the file). If the call fails (connection error,
+# timeout, HTTP 408, 429 or 5xx, or a response that is not a completion), it waits
+# a jittered, exponentially growing delay and retries on the next best endpoint, up
+# to "llm_retries" times. Other HTTP errors (e.g. 400 for a context that is too
+# long) are not retried, the LlmError raised for them is not "retryable".
+#
+# Each endpoint has a circuit breaker: after "llm_breaker_failures" failures in a
+# row it is skipped for "llm_breaker_open_sec" seconds, then the next call probes it
+# (half-open) and closes the breaker if it succeeds.
+#
+# Connections are kept alive (one requests session per endpoint and thread), and
+# each call has a connect timeout and a read timeout ("llm_connect_timeout_sec" and
+# "llm_read_timeout_sec" in 'config_rag.json', or "connect_timeout" and
+# "read_timeout" of the endpoint).
+# ------------------------------------------------------------------------------
+
+import sys
+import json
+import time
+import random
+import threading
+from typing import List, Dict, Optional
+
+import requests
+
+
+class LlmError(Exception):
+
+    def __init__(self, message: str, status: Optional[int] = None, retryable: bool = True):
+        super().__init__(message)
+        # HTTP status of the last response, None if there was none
+        self.status = status
+        # False for a client error (e.g. the context is too long), which fails again
+        # when retried; True if the endpoints failed or were not available (including
+        # HTTP 408 and 429), so a later call may succeed
+        self.retryable = retryable
+
+
+class LlmEndpoint:
+
+    def __init__(self, parameters: Dict[str, any], index: int, config: Dict[str, any]):
+        self.name = parameters.get("name", "endpoint-%d" % index)
+        self.url = parameters["endpoint"]
+        self.model = parameters.get("model")
+        self.api_key = parameters.get("api_key", "")
+        self.timeout = (float(parameters.get("connect_timeout", config["llm_connect_timeout_sec"])),
+                        float(parameters.get("read_timeout", config["llm_read_timeout_sec"])))
+        self.index = index
+        # statistics, guarded by the lock of the router
+        self.latency = None
+        self.success = 1.0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def cost(self) -> tuple:
+        if self.latency is None:
+            return 0, 0.0, self.index
+        return 1, self.latency / max(self.success, 0.05), self.index
+
+    def state(self, now: float) -> str:
+        if self.open_until == 0.0:
+            return "closed"
+        if now < self.open_until or self.probing:
+            return "open"
+        return "half-open"
+
+
+class LlmRouter:
+
+    def __init__(self, endpoints: List[Dict[str, any]], config: Dict[str, any]):
+        if len(endpoints) == 0:
+            print("ERROR: LlmRouter(): no LLM endpoints configured.")
+            sys.exit(1)
+        self.config = config
+        self.endpoints = [LlmEndpoint(parameters, i, config) for i, parameters in enumerate(endpoints)]
+        self.lock = threading.Lock()
+        self.thread_data = threading.local()
+
+    def session(self, endpoint: LlmEndpoint) -> requests.Session:
+        # one session (and so one pool of keep-alive connections) per endpoint and thread
+        if not hasattr(self.thread_data, "sessions"):
+            self.thread_data.sessions = {}
+        if endpoint.name not in self.thread_data.sessions:
+            self.thread_data.sessions[endpoint.name] = requests.Session()
+        return self.thread_data.sessions[endpoint.name]
+
+    def pick(self, tried: List[LlmEndpoint]) -> Optional[LlmEndpoint]:
+        # the endpoint with the lowest cost whose breaker lets calls through, preferring
+        # the ones not tried yet in this call
+        now = time.time()
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.state(now) != "open"]
+            untried = [endpoint for endpoint in candidates if endpoint not in tried]
+            if len(untried) > 0:
+                candidates = untried
+            if len(candidates) == 0:
+                return None
+            # an endpoint whose breaker is half-open gets its probe call first, otherwise its
+            # success rate (low after the failures) would keep it from ever being picked
+            half_open = [endpoint for endpoint in candidates if endpoint.state(now) == "half-open"]
+            if len(half_open) > 0:
+                endpoint = half_open[0]
+                endpoint.probing = True
+                return endpoint
+            return min(candidates, key=lambda endpoint: endpoint.cost())
+
+    def record(self, endpoint: LlmEndpoint, ok: Optional[bool], seconds: float) -> None:
+        # ok is None if the call failed for reasons unrelated to the endpoint
+        alpha = self.config["llm_ewma_alpha"]
+        with self.lock:
+            endpoint.probing = False
+            if ok is None:
+                return
+            endpoint.calls += 1
+            endpoint.success = (1 - alpha) * endpoint.success + alpha * (1.0 if ok else 0.0)
+            if ok:
+                endpoint.latency = seconds if endpoint.latency is None else \
+                    (1 - alpha) * endpoint.latency + alpha * seconds
+                endpoint.consecutive_failures = 0
+                endpoint.open_until = 0.0
+            else:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.open_until != 0.0 or \
+                        endpoint.consecutive_failures >= self.config["llm_breaker_failures"]:
+                    endpoint.open_until = time.time() + self.config["llm_breaker_open_sec"]
+
+    def chat(self, messages: List[Dict[str, str]], **options) -> Dict[str, any]:
+        # returns the parsed response, with the name of the endpoint that answered in
+        # "endpoint"; raises LlmError if no endpoint could answer
+        tried = []
+        status = None
+        error = "no endpoint available"
+        for attempt in range(0, 1 + self.config["llm_retries"]):
+            if attempt > 0:
+                delay = self.config["llm_retry_backoff_sec"] * (2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1.5))
+            endpoint = self.pick(tried)
+            if endpoint is None:
+                continue
+            tried.append(endpoint)
+            headers = {"Content-Type": "application/json", "Authorization": "Bearer " + endpoint.api_key}
+            data = dict(options, model=endpoint.model, messages=messages)
+            t0 = time.time()
+            try:
+                response = self.session(endpoint).post(endpoint.url, headers=headers, json=data,
+                                                       timeout=endpoint.timeout)
+            except requests.RequestException as e:
+                self.record(endpoint, False, time.time() - t0)
+                status = None
+                error = "%s: %s" % (endpoint.name, e.__class__.__name__)
+                print("WARNING: LlmRouter.chat(): %s" % error)
+                continue
+            status = response.status_code
+            if 400 <= status < 500 and status not in [408, 429]:
+                # a client error (e.g. the context is too long), not the endpoint's fault
+                self.record(endpoint, None, time.time() - t0)
+                raise LlmError("%s: HTTP %d" % (endpoint.name, status), status, retryable=False)
+            try:
+                result = response.json()
+                result["choices"][0]["message"]["content"]
+                ok = status < 400
+            except (ValueError, KeyError, IndexError, TypeError):
+                ok = False
+            if not ok:
+                self.record(endpoint, False, time.time() - t0)
+                error = "%s: HTTP %d" % (endpoint.name, status)
+                print("WARNING: LlmRouter.chat(): %s" % error)
+                continue
+            self.record(endpoint, True, time.time() - t0)
+            result["endpoint"] = endpoint.name
+            return result
+        raise LlmError(error, status)
+
+    def status(self) -> List[Dict[str, any]]:
+        now = time.time()
+        with self.lock:
+            return [{"name": endpoint.name, "state": endpoint.state(now), "latency_sec": endpoint.latency,
+                     "success_rate": endpoint.success, "calls": endpoint.calls, "failures": endpoint.failures}
+                    for endpoint in self.endpoints]
+
+
+def get_llm_router(config: Dict[str, any], file_name: str = "secrets_llm_endpoint.json") -> LlmRouter:
+    try:
+        file = open(file_name, "r")
+        endpoints = json.load(file)
+        file.close()
+    except FileNotFoundError:
+        print("ERROR: cannot open file: %s." % file_name)
+        sys.exit(1)
+    if isinstance(endpoints, dict):
+        endpoints = [endpoints]
+    return LlmRouter(endpoints, config)
@@ -0,0 +1,145 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# ONNX Runtime backend for the embedding model, selected with "embedding_backend": "onnx"
+# in 'config_rag.json' (see get_embedding_model() in 'librag.py').
+#
+# On first use, the model is exported from PyTorch to ONNX into "onnx_model_dir"
+# (and, with "onnx_quantize", dynamically quantized to int8 weights). At the same time
+# reference vectors are computed with the PyTorch model for a few fixed sentences
+# and saved next to the model. Each time the ONNX model is loaded, its vectors for
+# these sentences are compared to the reference vectors: if the cosine similarity
+# of any of them is below "onnx_min_cosine", we refuse to run.
+#
+# Needs the packages from 'requirements-onnx.txt'. See 'bench_embedding.py' for a
+# latency/throughput comparison with PyTorch.
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+from typing import List, Union
+
+import numpy as np
+
+
+validation_sentences = [
+    "What does gulp do?",
+    "Wie heisst der blaue Elefant? Wem hat er geholfen?",
+    "Che nome ha il robot che deve proteggere la colonia spaziale?",
+    "The Open Data Hub offers a REST API to query mobility and tourism data. "
+    "Filters are given in the URL, for example with where=a.eq.5.",
+    "Ticket created: the station in Bolzano does not send any data since yesterday at 10:00, "
+    "could you please check the connector?"
+]
+
+
+def export_onnx_model(model_dir: str, model_name: str, revision: str, quantize: bool) -> None:
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+    from sentence_transformers import SentenceTransformer
+
+    print("INFO: export_onnx_model(): exporting '%s' to '%s', this takes a while..." % (model_name, model_dir))
+    os.makedirs(model_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, revision=revision)
+    model = AutoModel.from_pretrained(model_name, revision=revision)
+    model.eval()
+    tokenizer.save_pretrained(model_dir)
+
+    inputs = tokenizer(validation_sentences[:2], padding=True, return_tensors="pt")
+    with torch.no_grad():
+        # models larger than 2 GiB are automatically saved with external data files
+        torch.onnx.export(model,
+                          (inputs["input_ids"], inputs["attention_mask"]),
+                          "%s/model.onnx" % model_dir,
+                          input_names=["input_ids", "attention_mask"],
+                          output_names=["last_hidden_state"],
+                          dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                        "attention_mask": {0: "batch", 1: "sequence"},
+                                        "last_hidden_state": {0: "batch", 1: "sequence"}},
+                          opset_version=17)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic("%s/model.onnx" % model_dir, "%s/model-int8.onnx" % model_dir,
+                         weight_type=QuantType.QInt8, use_external_data_format=True)
+
+    reference = SentenceTransformer(model_name, revision=revision).encode(validation_sentences)
+    np.save("%s/reference.npy" % model_dir, reference)
+
+    file = open("%s/export.json" % model_dir, "w")
+    json.dump({"model_name": model_name, "revision": revision, "quantize": quantize}, file)
+    file.close()
+
+
+class OnnxEmbeddingModel:
+
+    # same interface as SentenceTransformer.encode() for the parts we use: a single
+    # string gives a vector, a list of strings gives a matrix (one row per string)
+
+    def __init__(self, model_dir: str, model_name: str, revision: str, quantize: bool,
+                 min_cosine: float, max_seq_length: int = 8192):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        exported = None
+        try:
+            file = open("%s/export.json" % model_dir, "r")
+            exported = json.load(file)
+            file.close()
+        except FileNotFoundError:
+            pass
+        if exported is None or exported["model_name"] != model_name or exported["revision"] != revision or \
+                (quantize and not exported["quantize"]):
+            export_onnx_model(model_dir, model_name, revision, quantize)
+
+        if quantize:
+            model_file = "%s/model-int8.onnx" % model_dir
+        else:
+            model_file = "%s/model.onnx" % model_dir
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = max_seq_length
+
+        reference = np.load("%s/reference.npy" % model_dir)
+        cosine = cosine_similarities(self.encode(validation_sentences), reference)
+        if cosine.min() < min_cosine:
+            print("ERROR: OnnxEmbeddingModel(): vectors differ from the reference (min. cosine %.5f < %.5f)." %
+                  (cosine.min(), min_cosine))
+            sys.exit(1)
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        # batch sentences of similar length together to minimize padding
+        order = np.argsort([-len(sentence) for sentence in sentences])
+        vectors = np.zeros((len(sentences), 0), dtype=np.float32)
+        for i in range(0, len(sentences), batch_size):
+            batch = [sentences[j] for j in order[i:i + batch_size]]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, max_length=self.max_seq_length,
+                                    return_tensors="np")
+            hidden = self.session.run(["last_hidden_state"],
+                                      {"input_ids": inputs["input_ids"].astype(np.int64),
+                                       "attention_mask": inputs["attention_mask"].astype(np.int64)})[0]
+            # bge-m3 dense vectors: CLS token, normalized
+            cls = hidden[:, 0, :]
+            cls = cls / np.maximum(np.linalg.norm(cls, axis=1, keepdims=True), 1e-12)
+            if vectors.shape[1] == 0:
+                vectors = np.zeros((len(sentences), cls.shape[1]), dtype=np.float32)
+            vectors[order[i:i + batch_size]] = cls
+        if single:
+            return vectors[0]
+        return vectors
+
+
+def cosine_similarities(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # row-wise cosine similarity of two matrices of the same shape
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return (a * b).sum(axis=1)
@@ -0,0 +1,88 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Prompt templates and message layout for the LLM (used by 'query.py' and
+# 'backend_query.py').
+#
+# LLM servers (llama.cpp, vLLM, Ollama) and most providers keep the KV cache of
+# the prompt prefix of earlier calls and only need to compute the tokens after the
+# longest prefix that is byte-identical to one they have seen. So the messages are
+# laid out from the most stable to the most volatile part:
+#
+#   1. the system prompt, with all the instructions: the same for every call of
+#      every session, so its cache is shared by all sessions
+#   2. the conversation so far, exactly as sent in the previous call plus the
+#      answer: the previous call of the session cached all of it
+#   3. the new question with the context retrieved for it, the only part that
+#      must be computed
+#
+# Nothing in 1. and 2. may change between calls (no timestamps, no re-rendering of
+# earlier messages, no fields other than role and content).
+#
+# The number of prompt tokens served from the cache is taken from the "usage" of
+# the response ("prompt_tokens_details.cached_tokens", as reported by OpenAI-style
+# servers and vLLM) or from "timings" ("cache_n", llama.cpp).
+# ------------------------------------------------------------------------------
+
+from typing import List, Dict, Optional
+
+
+prompt_system = (
+    "You are an assistant who answers questions about a collection of documents.\n"
+    "Each question comes with context retrieved from these documents. Answer the question "
+    "using only the context and the conversation so far. Respond in the same language as the question.\n"
+    "If the answer cannot be fully derived from the context, simply say \"I don't know\".\n"
+    "For a follow-up question, the context is additional: if it is not relevant, ignore it. "
+    "Otherwise, use it to refine your answer."
+)
+
+
+def prompt_question(question: str, context: str) -> str:
+    return "Question:\n%s\n\n---\nContext:\n%s\n" % (question, context)
+
+
+def prompt_messages(conversation_llm: List[Dict[str, str]], question: str, context: str) -> List[Dict[str, str]]:
+    # the messages for the next call: the conversation so far (left untouched, it is
+    # the cached prefix) or the system prompt for the first question, followed by the
+    # new question and its context
+    if len(conversation_llm) == 0:
+        messages = [{"role": "system", "content": prompt_system}]
+    else:
+        messages = list(conversation_llm)
+    messages.append({"role": "user", "content": prompt_question(question, context)})
+    return messages
+
+
+def prompt_answer(message: Dict[str, any]) -> Dict[str, str]:
+    # the answer as it is kept in the conversation: only role and content, so that the
+    # next call renders it exactly as the server generated it
+    return prompt_answer_content(message.get("content"))
+
+
+def prompt_answer_content(content: str) -> Dict[str, str]:
+    # the same for an answer that is only a text (e.g. the error shown instead of an answer)
+    return {"role": "assistant", "content": content}
+
+
+def prompt_cached_tokens(result: Dict[str, any]) -> Optional[int]:
+    # prompt tokens served from the KV cache, None if the server doesn't tell
+    usage = result.get("usage") or {}
+    details = usage.get("prompt_tokens_details") or {}
+    if details.get("cached_tokens") is not None:
+        return int(details["cached_tokens"])
+    timings = result.get("timings") or {}
+    if timings.get("cache_n") is not None:
+        return int(timings["cache_n"])
+    return None
+
+
+def prompt_usage(result: Dict[str, any]) -> str:
+    # e.g. "prompt 2345 tokens (2101 cached), completion 187 tokens"
+    usage = result.get("usage") or {}
+    if usage.get("prompt_tokens") is None:
+        return "no usage reported"
+    cached = prompt_cached_tokens(result)
+    return "prompt %d tokens (%s cached), completion %d tokens" % \
+        (usage["prompt_tokens"], "?" if cached is None else "%d" % cached, usage.get("completion_tokens") or 0)
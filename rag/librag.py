@@ -5,10 +5,58 @@
 import os
 import time
 import gc
+import json
+import threading
 
 from libpg import *
+from libstore import *
+from libbatch import *
 
-from sentence_transformers import SentenceTransformer
+
+# defaults for the settings read from 'config_rag.json' (see get_rag_config())
+rag_config_defaults = {
+    "search_top_max": 20,
+    "context_token_budget": 4000,
+    "vector_store": "postgres",
+    "local_store_dir": "../store_local",
+    "local_store_dtype": "float16",
+    "quantization": "none",
+    "rerank_candidates": 100,
+    "search_tags": [],
+    "tag_penalties": {"rt": 0.1},
+    "embedding_model": default_embedding_model,
+    "embedding_model_revision": default_embedding_model_revision,
+    "embedding_backend": "torch",
+    "onnx_model_dir": "../models/bge-m3-onnx",
+    "onnx_quantize": True,
+    "onnx_min_cosine": 0.99,
+    "query_batch_max": 8,
+    "query_batch_wait_ms": 5.0,
+    "ingest_debounce_sec": 2.0,
+    "ingest_max_delay_sec": 30.0,
+    "ingest_status_port": 8011,
+    "llm_connect_timeout_sec": 5.0,
+    "llm_read_timeout_sec": 180.0,
+    "llm_retries": 2,
+    "llm_retry_backoff_sec": 1.0,
+    "llm_breaker_failures": 3,
+    "llm_breaker_open_sec": 30.0,
+    "llm_ewma_alpha": 0.3
+}
+
+
+def get_rag_config() -> Dict[str, any]:
+    config = dict(rag_config_defaults)
+    try:
+        file = open("config_rag.json", "r")
+        config.update(json.load(file))
+        file.close()
+    except FileNotFoundError:
+        pass
+    except json.decoder.JSONDecodeError as e:
+        print("ERROR: get_rag_config(): cannot parse 'config_rag.json':\n%s" % str(e))
+        sys.exit(1)
+    return config
 
 
 def find_sentence_boundary(body: str, pos: int, direction: int) -> int:
@@ -94,30 +142,211 @@ def chunk_text(body: str, chunk_len: int, overlap_len: int, hard_limit: int) ->
     return chunks
 
 
-def get_embedding_model() -> SentenceTransformer:
-    # https://huggingface.co/BAAI/bge-m3 (license: MIT)
+# the embedding model is loaded only once per process (and again for a generation embedded
+# with another model), see get_embedding_model()
+embedding_model = None
+# name and revision of the loaded model
+embedding_model_id = None
+
+
+def get_embedding_model(model_name: Optional[str] = None, revision: Optional[str] = None) -> any:
+    # by default https://huggingface.co/BAAI/bge-m3 (license: MIT)
     # we use revision 5a212480c9a75bb651bcb894978ed409e4c47b82 (downloaded 2024-03-21)
     # when called for the first time, this downloads and caches the model (2.1 GiB) into
     # ~/.cache/huggingface/hub/models--BAAI--bge-m3/
-    return SentenceTransformer("BAAI/bge-m3", revision="5a212480c9a75bb651bcb894978ed409e4c47b82")
+    # without a name, the model loaded before is returned, or the one of "embedding_model"
+    # and "embedding_model_revision" in 'config_rag.json' (the model of the generations
+    # created from now on, see 'generation.py'); a process has one model at a time, asking
+    # for another one replaces it (see search())
+    # with "embedding_backend": "onnx" in 'config_rag.json' the model is run by ONNX Runtime
+    # instead (see 'libonnx.py'), the returned object has the same encode() method
+    # the heavy imports (torch, sentence-transformers) are done here, on first use,
+    # so scripts can do other things (such as sending heartbeats) while they run
+    global embedding_model, embedding_model_id, query_encoder
+    config = get_rag_config()
+    if model_name is None:
+        if embedding_model is not None:
+            return embedding_model
+        model_name, revision = config["embedding_model"], config["embedding_model_revision"]
+    if embedding_model_id == (model_name, revision):
+        return embedding_model
+    # free the memory of the old model before the new one is loaded
+    embedding_model = embedding_model_id = None
+    gc.collect()
+    if config["embedding_backend"] == "onnx":
+        from libonnx import OnnxEmbeddingModel
+        embedding_model = OnnxEmbeddingModel(config["onnx_model_dir"], model_name, revision,
+                                             config["onnx_quantize"], config["onnx_min_cosine"])
+    elif config["embedding_backend"] == "torch":
+        from sentence_transformers import SentenceTransformer
+        embedding_model = SentenceTransformer(model_name, revision=revision)
+    else:
+        print("ERROR: get_embedding_model(): unknown embedding backend '%s'." % config["embedding_backend"])
+        sys.exit(1)
+    embedding_model_id = (model_name, revision)
+    # the query encoder keeps its batching thread
+    if isinstance(query_encoder, EmbeddingBatcher):
+        query_encoder.model = embedding_model
+    elif query_encoder is not None:
+        query_encoder = embedding_model
+    return embedding_model
 
 
-def rag_dir(dirname: str, tag: str,
-            chunk_len: int, overlap_len: int, hard_limit: int) -> None:
+def load_active_embedding_model(config: Dict[str, any]) -> any:
+    # the model of the active generation, loaded at startup so that the first question
+    # (or load) does not wait for it
+    store = open_store(config)
+    model = get_embedding_model(store.embedding_model, store.embedding_model_revision)
+    store.close()
+    return model
+
+
+def warm_up_embedding_model(capacity: int = 1) -> None:
+    # the first encode() calls initialize kernels and allocate buffers and are much
+    # slower than the following ones: do them before the first user has to wait for them;
+    # capacity is the number of jobs that search at the same time (see get_query_encoder())
+    model = get_embedding_model()
+    model.encode("What does gulp do?")
+    model.encode(["Stuart warms up. " * 200, "Stuart is ready."], batch_size=2)
+    get_query_encoder(capacity)
+
+
+# the encoder of the queries is created only once per process, see get_query_encoder()
+query_encoder = None
+
+
+def get_query_encoder(capacity: int = 1) -> any:
+    # the micro-batcher of the query embeddings (see 'libbatch.py') if up to capacity
+    # (> 1) jobs search at the same time, or the model itself with capacity 1 or
+    # "query_batch_max": 1 in 'config_rag.json'; both have an encode() method; the
+    # capacity of the first call counts
+    global query_encoder
+    if query_encoder is not None:
+        return query_encoder
+    config = get_rag_config()
+    model = get_embedding_model()
+    max_batch = min(config["query_batch_max"], capacity)
+    if max_batch > 1:
+        query_encoder = EmbeddingBatcher(model, max_batch, config["query_batch_wait_ms"] / 1000.0)
+    else:
+        query_encoder = model
+    return query_encoder
+
+
+def join_query_batch() -> None:
+    # a job will search soon: the micro-batcher waits for its query (see 'libbatch.py')
+    encoder = get_query_encoder()
+    if isinstance(encoder, EmbeddingBatcher):
+        encoder.join()
+
+
+def leave_query_batch() -> None:
+    # the job has searched (or will not search)
+    encoder = get_query_encoder()
+    if isinstance(encoder, EmbeddingBatcher):
+        encoder.leave()
+
+
+journal_file_name = "../journal/changes.jsonl"
+
+
+def journal_size() -> int:
+    try:
+        return os.path.getsize(journal_file_name)
+    except FileNotFoundError:
+        return 0
+
 
+def read_journal(dirname: str, offset: int) -> (Dict[str, str], int):
+    # the changes to the files in dirname appended to the change journal (see
+    # 'scrapers/libjournal.py') after offset, as file name -> last change, and the
+    # offset after the last complete line
     try:
-        files = os.listdir(dirname)
-        files.sort()
+        file = open(journal_file_name, "rb")
     except FileNotFoundError:
-        print("ERROR: rag_dir(): cannot open directory '%s'." % dirname)
+        return {}, offset
+    file.seek(offset)
+    data = file.read()
+    file.close()
+    data = data[:data.rfind(b"\n") + 1]
+    # journal file names are relative to the top directory
+    top_dir = os.path.abspath("..")
+    directory = os.path.relpath(os.path.abspath(dirname), top_dir)
+    changes = {}
+    for line in data.splitlines():
+        try:
+            entry = json.loads(line)
+        except json.decoder.JSONDecodeError:
+            print("WARNING: read_journal(): skipping invalid line '%s'." % line[:100])
+            continue
+        if os.path.dirname(entry["file"]) == directory:
+            changes[os.path.basename(entry["file"])] = entry["change"]
+    return changes, offset + len(data)
+
+
+def rag_dir(dirname: str, tag: str,
+            chunk_len: int, overlap_len: int, hard_limit: int, journal: bool = False,
+            reload: bool = False, generation: int = None,
+            changed_files: Optional[Dict[str, str]] = None) -> Dict[str, any]:
+
+    # With journal=True, the directory is only listed the first time. The position in
+    # the change journal is then kept as checkpoint in the store, and the next runs only
+    # look at the files in the journal after it: new and modified files are (re)loaded,
+    # deleted files are removed from the store.
+    #
+    # With reload=True, all files of the directory are loaded again and replace all
+    # chunks of the tag at once at the end (in Postgres, by swapping the partition of
+    # the tag, see begin_reload() in 'libstore.py'); searches see the old chunks until
+    # then. With journal=True, the journal is then followed from the start of the reload.
+    #
+    # Without the journal, changed_files (file name -> "added", "modified" or "deleted",
+    # e.g. from the inotify events of 'ingest_daemon.py') limits the run to these files,
+    # which are handled like the changes in the journal; None lists the directory.
+    #
+    # The chunks go into the given generation of the store (see 'generation.py'), into
+    # the active one if None, embedded with the model of the generation. Chunks with a
+    # text already in the generation (see content_hash() in 'libstore.py') get the
+    # embedding stored with it, only the others are embedded. The first load of a
+    # generation records chunk_len and overlap_len, the next ones must use the same.
+    #
+    # Returns the counts printed at the end, and the journal position with journal=True.
+
+    store = open_store(get_rag_config(), generation)
+    if store.chunk_len is None:
+        store.set_chunking(chunk_len, overlap_len)
+    elif (store.chunk_len, store.overlap_len) != (chunk_len, overlap_len):
+        print("ERROR: rag_dir(): generation %d is chunked with chunk_len %d and overlap_len %d, not %d and %d "
+              "(create a new generation for other chunk lengths, see 'generation.py')." %
+              (store.generation, store.chunk_len, store.overlap_len, chunk_len, overlap_len))
         sys.exit(1)
-    known_extensions = [".txt", ".md"]
+    checkpoint_name = "journal:%s" % tag
+    changes = None
+    if journal:
+        offset = None if reload else store.get_checkpoint(checkpoint_name)
+        if offset is not None:
+            changes, journal_end = read_journal(dirname, offset)
+        else:
+            # changes journaled while we list the directory are looked at next time
+            journal_end = journal_size()
+    elif changed_files is not None and not reload:
+        changes = changed_files
+    if reload:
+        store.begin_reload(tag)
 
-    cursor = open_cursor()
+    if changes is not None:
+        files = sorted(changes)
+    else:
+        try:
+            files = os.listdir(dirname)
+            files.sort()
+        except FileNotFoundError:
+            print("ERROR: rag_dir(): cannot open directory '%s'." % dirname)
+            sys.exit(1)
+    known_extensions = [".txt", ".md"]
 
-    model = get_embedding_model()
+    model = get_embedding_model(store.embedding_model, store.embedding_model_revision)
 
-    num_files_old = num_files_new = num_chunks = 0
+    num_files_old = num_files_new = num_files_deleted = num_chunks = num_chunks_reused = 0
     t1_chunk = t1_embed = t1_store = 0.0
 
     for file_name in files:
@@ -127,25 +356,40 @@ def rag_dir(dirname: str, tag: str,
             print("INFO: rag_dir(): skipping '%s' with unknown extension." % file_name)
             continue
 
+        modified = False
+        if changes is not None and store.has_file(tag, file_name):
+            if changes[file_name] == "deleted" or not os.path.exists("%s/%s" % (dirname, file_name)):
+                store.delete_file(tag, file_name)
+                store.commit()
+                num_files_deleted += 1
+                continue
+            # added again or modified: the old chunks go in any case, after the embeddings
+            # of the chunks that did not change were looked up, in the same commit as the
+            # new ones
+            modified = True
+        elif changes is not None and not os.path.exists("%s/%s" % (dirname, file_name)):
+            continue
+
         file = open("%s/%s" % (dirname, file_name), "r")
         try:
             body = file.read()
         except UnicodeDecodeError:
             print("INFO: rag_dir(): skipping '%s' with invalid unicode." % file_name)
             file.close()
+            if modified:
+                store.delete_file(tag, file_name)
+            store.commit()
             continue
         file.close()
 
         if len(body) < 5:
             print("INFO: rag_dir(): skipping (almost) empty file '%s'." % file_name)
+            if modified:
+                store.delete_file(tag, file_name)
+            store.commit()
             continue
 
-        res = select_one(cursor,
-                         """
-                         select count(1) as cnt from ragdata where tag = %s and file_name = %s
-                         """,
-                         [tag, file_name])
-        if int(res["cnt"]) > 0:
+        if changes is None and store.has_file(tag, file_name):
             num_files_old += 1
             continue
 
@@ -159,38 +403,173 @@ def rag_dir(dirname: str, tag: str,
         t1_chunk += time.time() - t0
 
         t0 = time.time()
-        embeddings = model.encode(strings, batch_size=1)
+        hashes = [content_hash(string) for string in strings]
+        known = store.get_embeddings(sorted(set(hashes)))
+        num_chunks_reused += len([chunk_hash for chunk_hash in hashes if chunk_hash in known])
+        # each new text is embedded once, even if it is in several chunks of the file
+        new_hashes = sorted(set(hashes) - set(known))
+        if len(new_hashes) > 0:
+            new_strings = [strings[hashes.index(new_hash)] for new_hash in new_hashes]
+            known.update(zip(new_hashes, model.encode(new_strings, batch_size=1)))
         t1_embed += time.time() - t0
         t0 = time.time()
-        for i in range(0, len(embeddings)):
-            execute(cursor,
-                    """
-                    insert into ragdata (tag, file_name, start_pos, end_pos, file_body, embedding)
-                    values(%s, %s, %s, %s, %s, %s)
-                    """,
-                    [tag, file_name, chunks[i]["start"], chunks[i]["end"], strings[i], embeddings[i].tolist()])
+        if modified:
+            store.delete_file(tag, file_name)
+        store.add_file(tag, file_name, body)
+        for i in range(0, len(chunks)):
+            store.add_chunk(tag, file_name, chunks[i]["start"], chunks[i]["end"], known[hashes[i]])
             num_chunks += 1
-        cursor.connection.commit()
+        store.commit()
         t1_store += time.time() - t0
 
         num_files_new += 1
         gc.collect()
 
-    close_cursor(cursor)
-    print("%d/%d new files, %d new chunks, chunked in %.3fs, embedded in %.3fs, stored in %.3fs" %
-          (num_files_new, (num_files_old + num_files_new), num_chunks, t1_chunk, t1_embed, t1_store))
+    if reload:
+        # committed together with the checkpoint
+        store.finish_reload()
+    if journal:
+        store.set_checkpoint(checkpoint_name, journal_end)
+    if reload or journal:
+        store.commit()
+    store.close()
+    stats = {"files_new": num_files_new, "files_old": num_files_old, "files_deleted": num_files_deleted,
+             "chunks": num_chunks, "chunks_reused": num_chunks_reused,
+             "chunk_seconds": t1_chunk, "embed_seconds": t1_embed, "store_seconds": t1_store,
+             "journal_position": journal_end if journal else None}
+    if reload:
+        print("reloaded tag '%s': %d files, %d chunks (%d with a known embedding), chunked in %.3fs, "
+              "embedded in %.3fs, stored in %.3fs" %
+              (tag, num_files_new, num_chunks, num_chunks_reused, t1_chunk, t1_embed, t1_store))
+    elif changes is not None:
+        print("%d changed files%s: %d new or modified files, %d deleted, %d new chunks "
+              "(%d with a known embedding), chunked in %.3fs, embedded in %.3fs, stored in %.3fs" %
+              (len(files), " in the journal" if journal else "", num_files_new, num_files_deleted, num_chunks,
+               num_chunks_reused, t1_chunk, t1_embed, t1_store))
+    else:
+        print("%d/%d new files, %d new chunks (%d with a known embedding), chunked in %.3fs, embedded in %.3fs, "
+              "stored in %.3fs" %
+              (num_files_new, (num_files_old + num_files_new), num_chunks, num_chunks_reused,
+               t1_chunk, t1_embed, t1_store))
+    return stats
 
 
-def search(cursor: psycopg2.extras.DictCursor, top: int, query_str: str) -> List[Dict[str, any]]:
-    model = get_embedding_model()
-    embedding = model.encode(query_str)
-    # when searching, note that we add a small penalty for chunks with tag 'rt'
-    res = select_all(cursor,
-                     """
-                     select tag, file_name, start_pos, file_body,
-                            (embedding <=> %s::vector) + case when tag = 'rt' then 0.1 else 0.0 end as distance
-                     from ragdata
-                     order by distance asc limit %s
-                     """,
-                     [embedding.tolist(), top])
-    return res
+def keep_store(store: Optional[VectorStore], config: Dict[str, any]) -> VectorStore:
+    # the store for the searches of a process (or a job thread), kept open from one
+    # question to the next: opening it connects to Postgres or parses the local store,
+    # while search() only picks up what was committed since; it is opened again when
+    # another generation became active (see 'generation.py')
+    if store is not None:
+        if store.is_active():
+            return store
+        store.close()
+    return open_store(config)
+
+
+# the searches embedding their query with the loaded model, which is only replaced (for
+# a generation embedded with another model) when there are none
+model_condition = threading.Condition()
+model_users = 0
+
+
+def search(store: VectorStore, top: int, query_str: str, tags: List[str] = None) -> List[Dict[str, any]]:
+    # the query is embedded with the model of the generation of the store: after a switch
+    # to a generation embedded with another model, the first search loads that model once
+    # the searches with the old one are done (a search of a job that still has a store of
+    # the old generation then loads the old one again)
+    global model_users
+    with model_condition:
+        while embedding_model_id != (store.embedding_model, store.embedding_model_revision) and model_users > 0:
+            model_condition.wait()
+        get_embedding_model(store.embedding_model, store.embedding_model_revision)
+        model_users += 1
+    try:
+        # queries of concurrent jobs are embedded together (see get_query_encoder())
+        embedding = get_query_encoder().encode(query_str)
+    finally:
+        with model_condition:
+            model_users -= 1
+            model_condition.notify_all()
+    # only the chunks with the given tags are searched (by default "search_tags" in
+    # 'config_rag.json', all if empty), and the store adds "tag_penalties" to the
+    # distances (e.g. a small penalty for chunks with tag 'rt')
+    return store.search(embedding, top, tags)
+
+
+def estimate_tokens(text: str) -> int:
+    # we don't know the tokenizer of the LLM behind the endpoint, so just use the
+    # common rule of thumb of about 4 characters per token
+    return (len(text) + 3) // 4
+
+
+def merge_spans(a: Dict[str, any], b: Dict[str, any]) -> Dict[str, any]:
+    # merge two overlapping or adjacent chunks of the same file into one,
+    # the text shared by both chunks is only kept once
+    if a["start_pos"] > b["start_pos"]:
+        a, b = b, a
+    merged = dict(a)
+    if b["end_pos"] > a["end_pos"]:
+        merged["end_pos"] = b["end_pos"]
+        merged["file_body"] = a["file_body"] + b["file_body"][a["end_pos"] - b["start_pos"]:]
+    merged["distance"] = min(a["distance"], b["distance"])
+    merged["hits"] = a["hits"] + b["hits"]
+    return merged
+
+
+def build_context(res: List[Dict[str, any]], token_budget: int) -> List[Dict[str, any]]:
+    # Pack the search results (ordered by distance) into context segments.
+    # Chunks of the same file that overlap or touch are merged into a single segment,
+    # chunks with a text identical to one already packed are skipped, and chunks are
+    # added in order of distance as long as the estimated size fits the token budget
+    # (so with short chunks we get many of them, with long chunks just a few).
+    # Each returned segment has the usual search result keys plus 'hits', the indexes
+    # into res of the chunks that ended up in the segment.
+    segments = []
+    used = 0
+    seen_bodies = set()
+    for i in range(0, len(res)):
+        if res[i]["file_body"] in seen_bodies:
+            continue
+        candidate = {"tag": res[i]["tag"],
+                     "file_name": res[i]["file_name"],
+                     "start_pos": int(res[i]["start_pos"]),
+                     "end_pos": int(res[i]["end_pos"]),
+                     "file_body": res[i]["file_body"],
+                     "distance": float(res[i]["distance"]),
+                     "hits": [i]}
+        # merge with all the segments of the same file the candidate overlaps (merging
+        # can make the candidate grow, so repeat until nothing changes)
+        absorbed = []
+        merged = True
+        while merged:
+            merged = False
+            for seg in segments:
+                if any(seg is a for a in absorbed):
+                    continue
+                if seg["tag"] != candidate["tag"] or seg["file_name"] != candidate["file_name"]:
+                    continue
+                if seg["start_pos"] <= candidate["end_pos"] and candidate["start_pos"] <= seg["end_pos"]:
+                    candidate = merge_spans(seg, candidate)
+                    absorbed.append(seg)
+                    merged = True
+        cost = estimate_tokens(candidate["file_body"]) - sum([estimate_tokens(seg["file_body"]) for seg in absorbed])
+        if used + cost > token_budget:
+            continue
+        used += cost
+        seen_bodies.add(res[i]["file_body"])
+        if len(absorbed) > 0:
+            # keep the merged segment at the position of the best ranked segment it absorbed
+            positions = [j for j in range(0, len(segments)) if any(segments[j] is a for a in absorbed)]
+            segments[positions[0]] = candidate
+            segments = [segments[j] for j in range(0, len(segments)) if j not in positions[1:]]
+        else:
+            segments.append(candidate)
+    return segments
+
+
+def format_context(segments: List[Dict[str, any]]) -> str:
+    parts = []
+    for seg in segments:
+        parts.append("--- document %s (tag: %s) at offset %d chars:\n%s" %
+                     (seg["file_name"], seg["tag"], seg["start_pos"], seg["file_body"]))
+    return "\n\n".join(parts)
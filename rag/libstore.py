@@ -0,0 +1,1105 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Vector stores: where the chunks and their embedding vectors are kept and searched.
+#
+# rag_dir() and search() in 'librag.py' only talk to the VectorStore interface,
+# open_store() picks the implementation configured in 'config_rag.json':
+#
+#   - "postgres" (default): the ragdata and ragfile tables in Postgres with pgvector,
+#     see 'libpg.py' and the global README.md
+#
+#   - "local": an in-process store kept in the directory "local_store_dir",
+#     meant for small deployments and for experimenting without Postgres
+#
+# Local store layout (all files are append-only):
+#
+#   store.json      dimension and data type ("float16" or "float32") of the vectors
+#   embeddings.bin  the normalized embedding matrix, row by row, memory-mapped for search
+#   bits.bin        the binary quantized embeddings (one sign bit per dimension), used for
+#                   the coarse search stage when "quantization" is "binary"
+#   texts.bin       the UTF-8 file texts, concatenated, each file once
+#   chunks.jsonl    one line per chunk with tag, file name, positions, content hash and
+#                   the location of its span (and of its file) in texts.bin
+#   deleted.jsonl   one line per deleted file with tag, file name and the number of rows
+#                   at the time of deletion: rows of the file before that are dead, they
+#                   are skipped by search() but stay in the other files
+#   checkpoints.json  the checkpoints set with set_checkpoint(), rewritten on commit
+#
+# chunks.jsonl is written last on commit (only followed by checkpoints.json), so it is
+# the commit record: rows beyond its last complete line are left-overs from an interrupted
+# load and get truncated on the next commit. To get rid of dead rows, remove the directory
+# and load again.
+#
+# Quantization ("quantization" in 'config_rag.json'):
+#
+#   - "none" (default): exact search on the full vectors
+#
+#   - "halfvec" (Postgres only): coarse search on the vectors cast to half precision,
+#     then exact rerank of the best "rerank_candidates" chunks; create the matching index
+#     with 'postgres/quantization.sql' (the local store has "local_store_dtype" instead)
+#
+#   - "binary": coarse search by Hamming distance on the sign bits of the vectors (128
+#     bytes instead of 4 KiB per chunk), then exact rerank of the best "rerank_candidates"
+#     chunks; with Postgres, create the matching index with 'postgres/quantization.sql'
+#
+#   - in Postgres, the compact copies are only in the index: the full vectors stay in
+#     ragdata (for the rerank), so the table does not get smaller, only the index the
+#     coarse stage scans is; and the HNSW index returns at most 1000 candidates
+#     (hnsw.ef_search, set to "rerank_candidates" for each search)
+#
+# Tags:
+#
+#   - in Postgres, ragdata is list-partitioned by tag (within each generation, see
+#     below, 'postgres/init.sql' and 'postgres/partition.sql' to migrate a flat table),
+#     the partition of a new tag is created with its first file; the indexes of ragdata
+#     are created on each partition
+#
+#   - search() can be restricted to some tags ("search_tags" in 'config_rag.json', all
+#     tags if empty), Postgres then only scans the partitions of these tags
+#
+#   - "tag_penalties" in 'config_rag.json' is added to the distance of the chunks of a
+#     tag, to rank a source lower (e.g. {"rt": 0.1})
+#
+#   - between begin_reload(tag) and finish_reload(), the chunks of the tag go into a new
+#     partition (Postgres) or are kept pending (local store), searches still see the
+#     old chunks; the commit after finish_reload() replaces all chunks of the tag at once;
+#     the pending chunks of the local store are in memory: the texts of the files of the
+#     tag and about 4 KiB per chunk for the embeddings (load a new generation instead for
+#     a large tag, it is written to disk with each commit)
+#
+# Files and chunks:
+#
+#   - the text of each file is kept once, the chunks are spans of it (start_pos and
+#     end_pos, in characters): the overlap of the chunks is not stored twice, and the
+#     text of a chunk is only read for the results of search()
+#
+#   - in Postgres, the file texts are in the ragfile table, partitioned like ragdata,
+#     and each row of ragdata refers to its file with file_id; search() orders the rows
+#     of ragdata (without any text) by distance, then cuts the spans of the top ones
+#     out of ragfile (see 'postgres/ragfile.sql' to migrate a ragdata table with the
+#     chunk texts in file_body)
+#
+#   - each chunk has the SHA-256 of its text (content_hash()): rag_dir() in 'librag.py'
+#     gets the embeddings of the chunks already in the generation with get_embeddings()
+#     and only embeds the others, so reloads, files saved again and boilerplate repeated
+#     over many files (e.g. in RT tickets) are not embedded again
+#
+# Generations (see 'generation.py'):
+#
+#   - the chunks belong to a generation of the corpus (e.g. loaded with other chunk
+#     lengths or another embedding model), one of them is active; a store opened without
+#     a generation reads and writes the active one, so a new generation can be loaded
+#     while the workers search the active one, and switching to it (or back) only
+#     changes the active pointer
+#
+#   - each generation records the embedding model (name and revision) it is embedded
+#     with, given to create_generation(), and the chunk_len and overlap_len it is
+#     chunked with, recorded with set_chunking() by its first load; the store has them
+#     as attributes (embedding_model, embedding_model_revision, chunk_len, overlap_len),
+#     see rag_dir() and search() in 'librag.py' for how they are used
+#
+#   - in Postgres, ragdata is first partitioned by generation (ragdata_g<generation>),
+#     then by tag (ragdata_g<generation>_<tag>), and so is ragfile (ragfile_g<generation>,
+#     ragfile_g<generation>_<tag>); the generation is in each row and the active one is
+#     marked in the raggeneration table; the checkpoints of generation <n> > 1 are named
+#     "g<n>:<name>"
+#
+#   - the local store keeps generation 1 in "local_store_dir" and the others in its
+#     subdirectories g<generation>, the active one and the parameters of each are in
+#     generations.json and the generation is in each line of chunks.jsonl
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+from typing import List, Dict, Optional
+
+import numpy as np
+
+from libpg import *
+
+# the highest hnsw.ef_search pgvector accepts, the limit of the candidates of the
+# coarse stage with an HNSW index
+hnsw_ef_search_max = 1000
+
+# the embedding model of the stores set up before the generations recorded theirs, and
+# the default of "embedding_model" in 'config_rag.json'
+default_embedding_model = "BAAI/bge-m3"
+default_embedding_model_revision = "5a212480c9a75bb651bcb894978ed409e4c47b82"
+
+# number of bits set in each byte value, to compute Hamming distances on packed bits
+popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1).astype(np.uint16)
+
+
+def binary_quantize(vectors: np.ndarray) -> np.ndarray:
+    # one bit per dimension (set for positive values), packed 8 dimensions per byte
+    return np.packbits(np.asarray(vectors) > 0, axis=-1)
+
+
+def content_hash(text: str) -> str:
+    # the key of the embedding of a chunk: the same as sha256(convert_to(text, 'UTF8'))
+    # in Postgres (see 'postgres/ragfile.sql')
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class VectorStore:
+
+    def has_file(self, tag: str, file_name: str) -> bool:
+        raise NotImplementedError
+
+    def add_file(self, tag: str, file_name: str, body: str) -> None:
+        # the text of the file, the chunks of the file added next are spans of it
+        raise NotImplementedError
+
+    def add_chunk(self, tag: str, file_name: str, start_pos: int, end_pos: int, embedding: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def get_embeddings(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        # content hash -> embedding, for the hashes of chunks already in the generation
+        raise NotImplementedError
+
+    def delete_file(self, tag: str, file_name: str) -> None:
+        # remove the text and all chunks of the file (on commit)
+        raise NotImplementedError
+
+    def get_checkpoint(self, name: str) -> any:
+        # the value last committed with set_checkpoint(), None if there is none
+        raise NotImplementedError
+
+    def set_checkpoint(self, name: str, value: int) -> None:
+        # saved with the next commit(), so it cannot get ahead of the chunks
+        raise NotImplementedError
+
+    def begin_reload(self, tag: str) -> None:
+        # the chunks of the tag added from now on replace all chunks of the tag (see
+        # finish_reload()), has_file() only knows the files added since
+        raise NotImplementedError
+
+    def finish_reload(self) -> None:
+        # the next commit() replaces the chunks of the tag
+        raise NotImplementedError
+
+    def commit(self) -> None:
+        raise NotImplementedError
+
+    def list_generations(self) -> List[Dict[str, any]]:
+        # generation, description, embedding_model, embedding_model_revision, chunk_len,
+        # overlap_len, created, activated, active and chunks of each generation
+        raise NotImplementedError
+
+    def create_generation(self, description: str, embedding_model: str, embedding_model_revision: str) -> int:
+        # a new, empty and not active generation, embedded with the given model
+        raise NotImplementedError
+
+    def set_chunking(self, chunk_len: int, overlap_len: int) -> None:
+        # record the chunk lengths of the generation of the store (with the next commit)
+        raise NotImplementedError
+
+    def switch_generation(self, generation: int) -> None:
+        # stores opened from now on without a generation use this one
+        raise NotImplementedError
+
+    def drop_generation(self, generation: int) -> None:
+        # delete all chunks and checkpoints of a generation that is not active
+        raise NotImplementedError
+
+    def is_active(self) -> bool:
+        # whether the generation of the store is still the active one: a store kept open
+        # for many searches is opened again when it is not
+        raise NotImplementedError
+
+    def search(self, embedding: np.ndarray, top: int, tags: Optional[List[str]] = None) -> List[Dict[str, any]]:
+        # return the top chunks ordered by (penalized) cosine distance, each with the
+        # keys tag, file_name, start_pos, end_pos, file_body and distance; only chunks
+        # with the given tags (None: the search_tags of the store, all if empty)
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class PgStore(VectorStore):
+
+    def __init__(self, quantization: str, rerank_candidates: int,
+                 tag_penalties: Dict[str, float] = None, search_tags: List[str] = None,
+                 generation: Optional[int] = None):
+        if quantization not in ["none", "halfvec", "binary"]:
+            print("ERROR: PgStore(): unsupported quantization '%s'." % quantization)
+            sys.exit(1)
+        self.quantization = quantization
+        self.rerank_candidates = rerank_candidates
+        self.tag_penalties = tag_penalties or {}
+        self.search_tags = search_tags or []
+        self.cursor = open_cursor()
+        self.checkpoint_table = False
+        # databases set up before the file texts were split off the chunks have the texts
+        # in ragdata.file_body (and maybe neither partitions nor generations), they must be
+        # migrated with 'postgres/partition.sql', 'postgres/generation.sql' and
+        # 'postgres/ragfile.sql', as far as needed
+        res = select_one(self.cursor,
+                         """
+                         select to_regclass('ragfile') is not null as files
+                         """,
+                         [])
+        if not res["files"]:
+            print("ERROR: PgStore(): the database has no ragfile table, run 'postgres/ragfile.sql' first.")
+            sys.exit(1)
+        # the positions of the chunks are characters, substr() in spans_sql() only counts
+        # characters in a UTF8 database (in SQL_ASCII it counts bytes)
+        res = select_one(self.cursor,
+                         """
+                         select current_setting('server_encoding') as encoding
+                         """,
+                         [])
+        if res["encoding"] != "UTF8":
+            print("ERROR: PgStore(): the database encoding is %s, not UTF8." % res["encoding"])
+            sys.exit(1)
+        self.generation = self.resolve_generation(generation)
+        res = select_one(self.cursor,
+                         """
+                         select embedding_model, embedding_model_revision, chunk_len, overlap_len
+                         from raggeneration where generation = %s
+                         """,
+                         [self.generation])
+        self.embedding_model = res["embedding_model"]
+        self.embedding_model_revision = res["embedding_model_revision"]
+        self.chunk_len = res["chunk_len"]
+        self.overlap_len = res["overlap_len"]
+        self.partitions = set()
+        self.reload_tag = None
+        # (tag, file name) -> id and text of the files added, for add_chunk()
+        self.added_files = {}
+
+    def resolve_generation(self, generation: Optional[int]) -> int:
+        # the given generation if it exists, the active one if None
+        if generation is None:
+            res = select_one(self.cursor,
+                             """
+                             select generation from raggeneration where active
+                             """,
+                             [])
+        else:
+            res = select_one(self.cursor,
+                             """
+                             select generation from raggeneration where generation = %s
+                             """,
+                             [generation])
+        if res is None:
+            print("ERROR: PgStore(): generation %s not found." % ("(active)" if generation is None else generation))
+            sys.exit(1)
+        return int(res["generation"])
+
+    def quote(self, name: str) -> str:
+        return psycopg2.extensions.quote_ident(name, self.cursor)
+
+    def parent_name(self, base: str = "ragdata") -> str:
+        # the table partitioned by tag: the partition of the generation of ragdata or ragfile
+        return self.quote("%s_g%d" % (base, self.generation))
+
+    def partition_name(self, tag: str, suffix: str = "", base: str = "ragdata") -> str:
+        # the quoted name of the partition of the tag: ragdata_g<generation>_<tag> (or
+        # ragfile_g<generation>_<tag>), as in 'postgres/generation.sql'
+        return self.quote("%s_g%d_%s%s" % (base, self.generation, tag, suffix))
+
+    def table(self, tag: str, base: str = "ragdata") -> str:
+        # where the chunks (or files) of the tag are read and written: the new partition
+        # while it is reloaded
+        if tag == self.reload_tag:
+            return self.partition_name(tag, "_reload", base)
+        return base
+
+    def generation_sql(self) -> (str, List[any]):
+        # the condition on the generation, so the planner only looks at its partitions
+        return "generation = %s", [self.generation]
+
+    def create_partition(self, tag: str) -> None:
+        if tag not in self.partitions:
+            for base in ["ragdata", "ragfile"]:
+                execute(self.cursor,
+                        """
+                        create table if not exists %s partition of %s for values in (%%s)
+                        """ % (self.partition_name(tag, "", base), self.parent_name(base)),
+                        [tag])
+            self.partitions.add(tag)
+
+    def has_file(self, tag: str, file_name: str) -> bool:
+        generation_sql, generation_args = self.generation_sql()
+        res = select_one(self.cursor,
+                         """
+                         select count(1) as cnt from %s where %s and tag = %%s and file_name = %%s
+                         """ % (self.table(tag, "ragfile"), generation_sql),
+                         generation_args + [tag, file_name])
+        return int(res["cnt"]) > 0
+
+    def add_file(self, tag: str, file_name: str, body: str) -> None:
+        self.create_partition(tag)
+        res = select_one(self.cursor,
+                         """
+                         insert into %s (tag, file_name, body, generation)
+                         values(%%s, %%s, %%s, %%s)
+                         returning id
+                         """ % self.table(tag, "ragfile"),
+                         [tag, file_name, body, self.generation])
+        self.added_files[(tag, file_name)] = (int(res["id"]), body)
+
+    def add_chunk(self, tag: str, file_name: str, start_pos: int, end_pos: int, embedding: np.ndarray) -> None:
+        file_id, body = self.added_files[(tag, file_name)]
+        execute(self.cursor,
+                """
+                insert into %s (tag, file_id, start_pos, end_pos, hash, embedding, generation)
+                values(%%s, %%s, %%s, %%s, %%s, %%s, %%s)
+                """ % self.table(tag),
+                [tag, file_id, start_pos, end_pos, bytes.fromhex(content_hash(body[start_pos:end_pos])),
+                 embedding.tolist(), self.generation])
+
+    def get_embeddings(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        if len(hashes) == 0:
+            return {}
+        # the chunks added since begin_reload() are in the new partition, not yet in ragdata
+        tables = ["ragdata"]
+        if self.reload_tag is not None:
+            tables.append(self.table(self.reload_tag))
+        generation_sql, generation_args = self.generation_sql()
+        res = select_all(self.cursor,
+                         " union all ".join(["""
+                         select distinct on (hash) hash, embedding::real[] as embedding
+                         from %s
+                         where %s and hash = any(%%s)
+                         """ % (table, generation_sql) for table in tables]),
+                         (generation_args + [[bytes.fromhex(h) for h in hashes]]) * len(tables))
+        return {bytes(row["hash"]).hex(): np.array(row["embedding"], dtype=np.float32) for row in res}
+
+    def delete_file(self, tag: str, file_name: str) -> None:
+        generation_sql, generation_args = self.generation_sql()
+        execute(self.cursor,
+                """
+                delete from %s where %s and tag = %%s and file_id in
+                    (select id from %s where %s and tag = %%s and file_name = %%s);
+                delete from %s where %s and tag = %%s and file_name = %%s
+                """ % (self.table(tag), generation_sql, self.table(tag, "ragfile"), generation_sql,
+                       self.table(tag, "ragfile"), generation_sql),
+                generation_args + [tag] + (generation_args + [tag, file_name]) * 2)
+        self.added_files.pop((tag, file_name), None)
+
+    def begin_reload(self, tag: str) -> None:
+        # the new partitions are copies of the structure of ragdata and ragfile, with their
+        # indexes (which become the partitions of the indexes of the parents when they are
+        # attached) and a check constraint, so attaching them does not need to scan them
+        self.create_partition(tag)
+        self.reload_tag = tag
+        generation_sql, generation_args = self.generation_sql()
+        for base in ["ragdata", "ragfile"]:
+            execute(self.cursor,
+                    """
+                    drop table if exists %s;
+                    create table %s (like %s including all);
+                    alter table %s add check (tag = %%s and %s)
+                    """ % (self.partition_name(tag, "_reload", base), self.partition_name(tag, "_reload", base), base,
+                           self.partition_name(tag, "_reload", base), generation_sql),
+                    [tag] + generation_args)
+        self.commit()
+
+    def finish_reload(self) -> None:
+        # swap the partitions: the parents are locked from here to the next commit()
+        tag = self.reload_tag
+        for base in ["ragdata", "ragfile"]:
+            execute(self.cursor,
+                    """
+                    alter table %s detach partition %s;
+                    drop table %s;
+                    alter table %s rename to %s;
+                    alter table %s attach partition %s for values in (%%s)
+                    """ % (self.parent_name(base), self.partition_name(tag, "", base),
+                           self.partition_name(tag, "", base),
+                           self.partition_name(tag, "_reload", base), self.partition_name(tag, "", base),
+                           self.parent_name(base), self.partition_name(tag, "", base)),
+                    [tag])
+        self.reload_tag = None
+
+    def list_generations(self) -> List[Dict[str, any]]:
+        return select_all(self.cursor,
+                          """
+                          select generation, description, embedding_model, embedding_model_revision,
+                                 chunk_len, overlap_len, created, activated, active,
+                                 (select count(1) from ragdata d where d.generation = g.generation) as chunks
+                          from raggeneration g
+                          order by generation
+                          """,
+                          [])
+
+    def create_generation(self, description: str, embedding_model: str, embedding_model_revision: str) -> int:
+        # an empty generation with its partitions (the partitions of its tags are created
+        # with their first file), not active
+        res = select_one(self.cursor,
+                         """
+                         insert into raggeneration (generation, description, embedding_model, embedding_model_revision)
+                         select coalesce(max(generation), 0) + 1, %s, %s, %s from raggeneration
+                         returning generation
+                         """,
+                         [description, embedding_model, embedding_model_revision])
+        generation = int(res["generation"])
+        for base in ["ragdata", "ragfile"]:
+            execute(self.cursor,
+                    """
+                    create table %s partition of %s for values in (%%s) partition by list (tag);
+                    create table %s partition of %s default
+                    """ % (self.quote("%s_g%d" % (base, generation)), base,
+                           self.quote("%s_g%d_default" % (base, generation)), self.quote("%s_g%d" % (base, generation))),
+                    [generation])
+        self.commit()
+        return generation
+
+    def set_chunking(self, chunk_len: int, overlap_len: int) -> None:
+        execute(self.cursor,
+                """
+                update raggeneration set chunk_len = %s, overlap_len = %s where generation = %s
+                """,
+                [chunk_len, overlap_len, self.generation])
+        self.chunk_len = chunk_len
+        self.overlap_len = overlap_len
+
+    def switch_generation(self, generation: int) -> None:
+        # from the commit on, stores opened without a generation search this one (the workers
+        # open theirs again before the next question, see keep_store() in 'librag.py')
+        generation = self.resolve_generation(generation)
+        execute(self.cursor,
+                """
+                update raggeneration set active = false where active;
+                update raggeneration set active = true, activated = now() where generation = %s
+                """,
+                [generation])
+        self.commit()
+
+    def drop_generation(self, generation: int) -> None:
+        generation = self.resolve_generation(generation)
+        if generation == self.resolve_generation(None):
+            print("ERROR: PgStore.drop_generation(): generation %d is active." % generation)
+            sys.exit(1)
+        self.create_checkpoint_table()
+        execute(self.cursor,
+                """
+                drop table if exists %s;
+                drop table if exists %s;
+                delete from raggeneration where generation = %%s;
+                delete from ragcheckpoint where name like %%s
+                """ % (self.quote("ragdata_g%d" % generation), self.quote("ragfile_g%d" % generation)),
+                [generation, "g%d:%%" % generation])
+        self.commit()
+
+    def is_active(self) -> bool:
+        active = self.resolve_generation(None)
+        # no transaction (and no locks on raggeneration) is kept open between searches
+        self.commit()
+        return active == self.generation
+
+    def checkpoint_name(self, name: str) -> str:
+        # generation 1 uses the names from before the generations
+        if self.generation == 1:
+            return name
+        return "g%d:%s" % (self.generation, name)
+
+    def create_checkpoint_table(self) -> None:
+        # databases set up before checkpoints existed don't have the table from 'init.sql'
+        if not self.checkpoint_table:
+            execute(self.cursor,
+                    """
+                    create table if not exists ragcheckpoint (name text primary key, position bigint not null)
+                    """,
+                    [])
+            self.checkpoint_table = True
+
+    def get_checkpoint(self, name: str) -> any:
+        self.create_checkpoint_table()
+        res = select_one(self.cursor,
+                         """
+                         select position from ragcheckpoint where name = %s
+                         """,
+                         [self.checkpoint_name(name)])
+        if res is None:
+            return None
+        return int(res["position"])
+
+    def set_checkpoint(self, name: str, value: int) -> None:
+        self.create_checkpoint_table()
+        execute(self.cursor,
+                """
+                insert into ragcheckpoint (name, position) values (%s, %s)
+                on conflict (name) do update set position = excluded.position
+                """,
+                [self.checkpoint_name(name), value])
+
+    def commit(self) -> None:
+        self.cursor.connection.commit()
+
+    def spans_sql(self, chunks_sql: str) -> str:
+        # the top chunks selected by chunks_sql (tag, generation, file_id, positions and
+        # distance, no text) with their file names and texts: only their spans are cut out
+        # of ragfile
+        return """
+               select c.tag, f.file_name, c.start_pos, c.end_pos,
+                      substr(f.body, c.start_pos::integer + 1, (c.end_pos - c.start_pos)::integer) as file_body,
+                      c.distance
+               from (%s) c
+               join ragfile f on f.id = c.file_id and f.generation = c.generation and f.tag = c.tag
+               order by c.distance asc
+               """ % chunks_sql
+
+    def search(self, embedding: np.ndarray, top: int, tags: Optional[List[str]] = None) -> List[Dict[str, any]]:
+        penalty_sql = "0.0"
+        penalty_args = []
+        if len(self.tag_penalties) > 0:
+            penalty_sql = "case"
+            for tag in self.tag_penalties:
+                penalty_sql += " when tag = %s then %s"
+                penalty_args += [tag, self.tag_penalties[tag]]
+            penalty_sql += " else 0.0 end"
+        # the conditions on generation and tag let the planner skip the partitions of the
+        # other generations and tags
+        if tags is None:
+            tags = self.search_tags
+        tags_sql, tags_args = self.generation_sql()
+        if len(tags) > 0:
+            tags_sql += " and tag = any(%s)"
+            tags_args = tags_args + [list(tags)]
+        if self.quantization == "none":
+            res = select_all(self.cursor,
+                             self.spans_sql("""
+                             select tag, generation, file_id, start_pos, end_pos,
+                                    (embedding <=> %%s::vector) + %s as distance
+                             from ragdata
+                             where %s
+                             order by distance asc limit %%s
+                             """ % (penalty_sql, tags_sql)),
+                             [embedding.tolist()] + penalty_args + tags_args + [top])
+            # end the transaction: a store kept open between searches must not hold the locks
+            # on the partitions, finish_reload() of a loader would wait for them
+            self.commit()
+            return res
+        # two-stage search: the coarse stage orders by the same expressions as the
+        # indexes in 'postgres/quantization.sql', so it can use them
+        if self.quantization == "halfvec":
+            coarse_sql = "embedding::halfvec(1024) <=> %s::halfvec(1024)"
+        else:
+            coarse_sql = "binary_quantize(embedding)::bit(1024) <~> binary_quantize(%s::vector)"
+        # an HNSW index scan returns at most hnsw.ef_search rows (40 by default, 1000 at
+        # most), so raise it to the number of candidates, for this transaction only
+        candidates = max(top, self.rerank_candidates)
+        execute(self.cursor,
+                """
+                set local hnsw.ef_search = %s
+                """ % min(candidates, hnsw_ef_search_max),
+                [])
+        res = select_all(self.cursor,
+                         self.spans_sql("""
+                         with candidates as (
+                             select id from ragdata
+                             where %s
+                             order by %s limit %%s
+                         )
+                         select tag, generation, file_id, start_pos, end_pos,
+                                (embedding <=> %%s::vector) + %s as distance
+                         from ragdata
+                         where id in (select id from candidates) and %s
+                         order by distance asc limit %%s
+                         """ % (tags_sql, coarse_sql, penalty_sql, tags_sql)),
+                         tags_args + [embedding.tolist(), candidates, embedding.tolist()] +
+                         penalty_args + tags_args + [top])
+        self.commit()
+        return res
+
+    def close(self) -> None:
+        close_cursor(self.cursor)
+
+
+class LocalStore(VectorStore):
+
+    def __init__(self, dirname: str, dtype: str, quantization: str, rerank_candidates: int,
+                 tag_penalties: Dict[str, float] = None, search_tags: List[str] = None,
+                 generation: Optional[int] = None):
+        if dtype not in ["float16", "float32"]:
+            print("ERROR: LocalStore(): unsupported data type '%s'." % dtype)
+            sys.exit(1)
+        if quantization not in ["none", "binary"]:
+            print("ERROR: LocalStore(): unsupported quantization '%s'." % quantization)
+            sys.exit(1)
+        self.quantization = quantization
+        self.rerank_candidates = rerank_candidates
+        self.tag_penalties = tag_penalties or {}
+        self.search_tags = search_tags or []
+        self.root = dirname
+        self.generation = self.resolve_generation(generation)
+        entry = [entry for entry in self.read_generations()["generations"] if entry["generation"] == self.generation][0]
+        self.embedding_model = entry["embedding_model"]
+        self.embedding_model_revision = entry["embedding_model_revision"]
+        self.chunk_len = entry["chunk_len"]
+        self.overlap_len = entry["overlap_len"]
+        dirname = self.generation_dir(self.generation)
+        try:
+            os.makedirs(dirname, exist_ok=True)
+        except OSError as e:
+            print("ERROR: LocalStore(): cannot create directory '%s':\n%s" % (dirname, str(e)))
+            sys.exit(1)
+        self.dirname = dirname
+        self.dim = 0
+        self.dtype = dtype
+        try:
+            file = open("%s/store.json" % dirname, "r")
+            header = json.load(file)
+            file.close()
+            self.dim = header["dim"]
+            self.dtype = header["dtype"]
+        except FileNotFoundError:
+            pass
+        self.chunks = []
+        self.chunks_bytes = 0
+        self.files = set()
+        # (tag, file name) -> rows of the file below this number are dead
+        self.deleted_before = {}
+        self.deleted_bytes = 0
+        self.alive = None
+        self.matrix = None
+        self.bits = None
+        # content hash -> a row with the embedding of that text (alive or not)
+        self.hash_rows = {}
+        self.pending = []
+        # (tag, file name) -> the file the pending chunks are spans of
+        self.pending_files = {}
+        # content hash -> embedding of the pending chunks
+        self.pending_embeddings = {}
+        self.pending_deletes = []
+        self.pending_checkpoints = {}
+        self.pending_chunking = None
+        self.reload_tag = None
+        self.reload_finished = False
+        self.refresh()
+
+    def path(self, name: str) -> str:
+        return "%s/%s" % (self.dirname, name)
+
+    def generation_dir(self, generation: int) -> str:
+        if generation == 1:
+            return self.root
+        return "%s/g%d" % (self.root, generation)
+
+    def read_generations(self) -> Dict[str, any]:
+        # stores set up before the generations have only generation 1, and those set up
+        # before the generations recorded their parameters have the default model
+        try:
+            file = open("%s/generations.json" % self.root, "r")
+            generations = json.load(file)
+            file.close()
+        except FileNotFoundError:
+            generations = {"active": 1, "generations": [{"generation": 1, "description": "", "created": None,
+                                                         "activated": None}]}
+        for entry in generations["generations"]:
+            entry.setdefault("embedding_model", default_embedding_model)
+            entry.setdefault("embedding_model_revision", default_embedding_model_revision)
+            entry.setdefault("chunk_len", None)
+            entry.setdefault("overlap_len", None)
+        return generations
+
+    def write_generations(self, generations: Dict[str, any]) -> None:
+        # replaced in one go, so a store opened at the same time sees the old or the new file
+        os.makedirs(self.root, exist_ok=True)
+        file = open("%s/generations.json.tmp" % self.root, "w")
+        json.dump(generations, file)
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        os.replace("%s/generations.json.tmp" % self.root, "%s/generations.json" % self.root)
+
+    def resolve_generation(self, generation: Optional[int]) -> int:
+        # the given generation if it exists, the active one if None
+        generations = self.read_generations()
+        if generation is None:
+            return generations["active"]
+        if generation not in [entry["generation"] for entry in generations["generations"]]:
+            print("ERROR: LocalStore(): generation %d not found." % generation)
+            sys.exit(1)
+        return generation
+
+    def read_lines(self, name: str, offset: int) -> (List[Dict[str, any]], int):
+        # the complete lines of the file after offset, and the offset after them
+        try:
+            file = open(self.path(name), "rb")
+        except FileNotFoundError:
+            return [], offset
+        file.seek(offset)
+        data = file.read()
+        file.close()
+        # ignore a trailing incomplete line
+        data = data[:data.rfind(b"\n") + 1]
+        return [json.loads(line) for line in data.splitlines()], offset + len(data)
+
+    def refresh(self) -> None:
+        # pick up chunks and deletions committed since the last refresh (possibly by another
+        # process), only the new lines of chunks.jsonl and deleted.jsonl are parsed
+        chunks, self.chunks_bytes = self.read_lines("chunks.jsonl", self.chunks_bytes)
+        # deletions are committed before the chunks, so read them after the chunks: a
+        # deletion we see refers at most to rows we know or will read with the next refresh
+        deletes, self.deleted_bytes = self.read_lines("deleted.jsonl", self.deleted_bytes)
+        if len(chunks) == 0 and len(deletes) == 0:
+            return
+        for i, chunk in enumerate(chunks):
+            # stores written before the content hashes have none
+            if "hash" in chunk:
+                self.hash_rows[chunk["hash"]] = len(self.chunks) + i
+        self.chunks += chunks
+        for delete in deletes:
+            key = (delete["tag"], delete["file_name"])
+            self.deleted_before[key] = max(self.deleted_before.get(key, 0), delete["rows"])
+        self.alive = np.array([i >= self.deleted_before.get((chunk["tag"], chunk["file_name"]), 0)
+                               for i, chunk in enumerate(self.chunks)], dtype=bool)
+        self.files = set([(chunk["tag"], chunk["file_name"]) for i, chunk in enumerate(self.chunks) if self.alive[i]])
+        if len(self.chunks) > 0 and len(chunks) > 0:
+            if self.dim == 0:
+                file = open(self.path("store.json"), "r")
+                header = json.load(file)
+                file.close()
+                self.dim = header["dim"]
+                self.dtype = header["dtype"]
+            self.matrix = np.memmap(self.path("embeddings.bin"), dtype=self.dtype, mode="r",
+                                    shape=(len(self.chunks), self.dim))
+            self.penalty = np.array([self.tag_penalties.get(chunk["tag"], 0.0) for chunk in self.chunks],
+                                    dtype=np.float32)
+            self.tags = np.array([chunk["tag"] for chunk in self.chunks])
+            # stores written before bits.bin existed get it backfilled on the next commit,
+            # until then we just search exactly
+            self.bits = None
+            bits_bytes = (self.dim + 7) // 8
+            if os.path.exists(self.path("bits.bin")) and \
+                    os.path.getsize(self.path("bits.bin")) >= len(self.chunks) * bits_bytes:
+                self.bits = np.memmap(self.path("bits.bin"), dtype=np.uint8, mode="r",
+                                      shape=(len(self.chunks), bits_bytes))
+
+    def has_file(self, tag: str, file_name: str) -> bool:
+        if tag == self.reload_tag:
+            return len([1 for chunk in self.pending if chunk["tag"] == tag and chunk["file_name"] == file_name]) > 0
+        return (tag, file_name) in self.files
+
+    def add_file(self, tag: str, file_name: str, body: str) -> None:
+        # the text is written with the first chunk of the file
+        self.pending_files[(tag, file_name)] = {"body": body, "offset": None}
+
+    def add_chunk(self, tag: str, file_name: str, start_pos: int, end_pos: int, embedding: np.ndarray) -> None:
+        file = self.pending_files[(tag, file_name)]
+        chunk_hash = content_hash(file["body"][start_pos:end_pos])
+        self.pending.append({"tag": tag, "file_name": file_name, "start_pos": int(start_pos), "end_pos": int(end_pos),
+                             "file": file, "hash": chunk_hash, "embedding": embedding})
+        self.pending_embeddings[chunk_hash] = embedding
+
+    def get_embeddings(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        self.refresh()
+        res = {}
+        for chunk_hash in hashes:
+            if chunk_hash in self.pending_embeddings:
+                res[chunk_hash] = np.asarray(self.pending_embeddings[chunk_hash], dtype=np.float32)
+            elif chunk_hash in self.hash_rows:
+                res[chunk_hash] = np.asarray(self.matrix[self.hash_rows[chunk_hash]], dtype=np.float32)
+        return res
+
+    def delete_file(self, tag: str, file_name: str) -> None:
+        # also drops the chunks of the file added (and not committed) before
+        self.pending = [chunk for chunk in self.pending if chunk["tag"] != tag or chunk["file_name"] != file_name]
+        self.pending_files.pop((tag, file_name), None)
+        if tag != self.reload_tag:
+            self.pending_deletes.append({"tag": tag, "file_name": file_name})
+
+    def get_checkpoint(self, name: str) -> any:
+        try:
+            file = open(self.path("checkpoints.json"), "r")
+            checkpoints = json.load(file)
+            file.close()
+        except FileNotFoundError:
+            return None
+        return checkpoints.get(name)
+
+    def set_checkpoint(self, name: str, value: int) -> None:
+        self.pending_checkpoints[name] = value
+
+    def begin_reload(self, tag: str) -> None:
+        # the chunks of the tag stay pending (in memory, with their embeddings and file texts)
+        # until the commit after finish_reload()
+        self.reload_tag = tag
+        self.reload_finished = False
+
+    def finish_reload(self) -> None:
+        self.reload_finished = True
+
+    def commit_deletes(self) -> None:
+        # truncate an incomplete line of an interrupted commit, then append
+        file = open(self.path("deleted.jsonl"), "ab")
+        file.truncate(self.deleted_bytes)
+        for delete in self.pending_deletes:
+            delete["rows"] = len(self.chunks)
+            file.write((json.dumps(delete) + "\n").encode("utf-8"))
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        self.pending_deletes = []
+
+    def commit_checkpoints(self) -> None:
+        checkpoints = {}
+        try:
+            file = open(self.path("checkpoints.json"), "r")
+            checkpoints = json.load(file)
+            file.close()
+        except FileNotFoundError:
+            pass
+        checkpoints.update(self.pending_checkpoints)
+        file = open(self.path("checkpoints.json.tmp"), "w")
+        json.dump(checkpoints, file)
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        os.replace(self.path("checkpoints.json.tmp"), self.path("checkpoints.json"))
+        self.pending_checkpoints = {}
+
+    def commit_chunking(self) -> None:
+        generations = self.read_generations()
+        for entry in generations["generations"]:
+            if entry["generation"] == self.generation:
+                entry["chunk_len"], entry["overlap_len"] = self.pending_chunking
+        self.write_generations(generations)
+        self.pending_chunking = None
+
+    def commit(self) -> None:
+        if self.reload_tag is not None and not self.reload_finished:
+            return
+        reload_deletes = []
+        if self.reload_finished:
+            # the files of the tag committed before the reload are deleted after the new chunks
+            # are written, so a search never finds the tag empty (but might find it twice)
+            reload_deletes = [{"tag": tag, "file_name": file_name} for tag, file_name in sorted(self.files)
+                              if tag == self.reload_tag]
+            self.reload_tag = None
+            self.reload_finished = False
+        if len(self.pending_deletes) > 0:
+            self.commit_deletes()
+        if len(self.pending) > 0:
+            self.commit_chunks()
+        if len(reload_deletes) > 0:
+            # rows committed by commit_chunks() are not in self.chunks before the refresh, so
+            # these deletions leave them alive
+            self.pending_deletes = reload_deletes
+            self.commit_deletes()
+        if len(self.pending_checkpoints) > 0:
+            self.commit_checkpoints()
+        if self.pending_chunking is not None:
+            self.commit_chunking()
+        self.refresh()
+
+    def commit_chunks(self) -> None:
+        if self.dim == 0:
+            self.dim = len(self.pending[0]["embedding"])
+            file = open(self.path("store.json"), "w")
+            json.dump({"dim": self.dim, "dtype": self.dtype}, file)
+            file.close()
+        # truncate left-overs of an interrupted commit, then append texts, vectors and,
+        # last, the chunk records
+        texts_bytes = 0
+        if len(self.chunks) > 0:
+            # the end of the text of the file of the last chunk (of the last chunk itself in
+            # stores written before the file texts were kept once)
+            last = self.chunks[-1]
+            texts_bytes = last.get("file_offset", last["offset"]) + last.get("file_length", last["length"])
+        row_bytes = self.dim * np.dtype(self.dtype).itemsize
+        texts = open(self.path("texts.bin"), "ab")
+        texts.truncate(texts_bytes)
+        embeddings = open(self.path("embeddings.bin"), "ab")
+        embeddings.truncate(len(self.chunks) * row_bytes)
+        bits_bytes = (self.dim + 7) // 8
+        bits = open(self.path("bits.bin"), "ab")
+        bits_rows = min(bits.tell() // bits_bytes, len(self.chunks))
+        bits.truncate(bits_rows * bits_bytes)
+        for i in range(bits_rows, len(self.chunks), 65536):
+            bits.write(binary_quantize(self.matrix[i:min(i + 65536, len(self.chunks))]).tobytes())
+        records = []
+        for chunk in self.pending:
+            file = chunk["file"]
+            if file["offset"] is None:
+                body = file["body"].encode("utf-8")
+                texts.write(body)
+                file["offset"] = texts_bytes
+                file["length"] = len(body)
+                texts_bytes += len(body)
+            # the span of the chunk in texts.bin, in bytes
+            offset = file["offset"] + len(file["body"][:chunk["start_pos"]].encode("utf-8"))
+            length = len(file["body"][chunk["start_pos"]:chunk["end_pos"]].encode("utf-8"))
+            vector = np.asarray(chunk["embedding"], dtype=np.float32)
+            vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+            embeddings.write(vector.astype(self.dtype).tobytes())
+            bits.write(binary_quantize(vector).tobytes())
+            records.append({"tag": chunk["tag"], "file_name": chunk["file_name"],
+                            "start_pos": chunk["start_pos"], "end_pos": chunk["end_pos"],
+                            "offset": offset, "length": length, "file_offset": file["offset"],
+                            "file_length": file["length"], "hash": chunk["hash"], "generation": self.generation})
+        for file in [texts, embeddings, bits]:
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+        file = open(self.path("chunks.jsonl"), "ab")
+        file.truncate(self.chunks_bytes)
+        for record in records:
+            file.write((json.dumps(record) + "\n").encode("utf-8"))
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        self.pending = []
+        self.pending_files = {}
+        self.pending_embeddings = {}
+
+    def read_text(self, chunk: Dict[str, any]) -> str:
+        file = open(self.path("texts.bin"), "rb")
+        file.seek(chunk["offset"])
+        data = file.read(chunk["length"])
+        file.close()
+        return data.decode("utf-8")
+
+    def search(self, embedding: np.ndarray, top: int, tags: Optional[List[str]] = None) -> List[Dict[str, any]]:
+        self.refresh()
+        if self.matrix is None or top < 1:
+            return []
+        if tags is None:
+            tags = self.search_tags
+        alive = self.alive
+        if len(tags) > 0:
+            alive = alive & np.isin(self.tags, list(tags))
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        top = min(top, len(self.chunks))
+        block = 65536
+        candidates = max(top, self.rerank_candidates)
+        if self.quantization == "binary" and self.bits is not None and candidates < len(self.chunks):
+            # coarse stage: Hamming distance on the sign bits
+            query_bits = binary_quantize(query)
+            hamming = np.empty(len(self.chunks), dtype=np.uint16)
+            for i in range(0, len(self.chunks), block):
+                hamming[i:i + block] = popcount[np.bitwise_xor(self.bits[i:i + block], query_bits)].sum(axis=1)
+            hamming[~alive] = np.iinfo(np.uint16).max
+            rows = np.sort(np.argpartition(hamming, candidates - 1)[:candidates])
+            # second stage: exact distance for the candidates only
+            distance = 1.0 - self.matrix[rows].astype(np.float32) @ query + self.penalty[rows]
+        else:
+            # cosine distance on normalized vectors, computed in blocks so a float16 matrix
+            # is never converted as a whole
+            rows = np.arange(len(self.chunks))
+            distance = np.empty(len(self.chunks), dtype=np.float32)
+            for i in range(0, len(self.chunks), block):
+                distance[i:i + block] = 1.0 - self.matrix[i:i + block].astype(np.float32) @ query
+            distance += self.penalty
+        distance[~alive[rows]] = np.inf
+        best = np.argpartition(distance, top - 1)[:top]
+        best = best[np.argsort(distance[best])]
+        res = []
+        for i in best:
+            if distance[i] == np.inf:
+                break
+            chunk = self.chunks[rows[i]]
+            res.append({"tag": chunk["tag"], "file_name": chunk["file_name"],
+                        "start_pos": chunk["start_pos"], "end_pos": chunk["end_pos"],
+                        "file_body": self.read_text(chunk), "distance": float(distance[i])})
+        return res
+
+    def list_generations(self) -> List[Dict[str, any]]:
+        generations = self.read_generations()
+        res = []
+        for entry in generations["generations"]:
+            if entry["generation"] == self.generation:
+                store = self
+            else:
+                store = LocalStore(self.root, self.dtype, "none", 0, generation=entry["generation"])
+            res.append(dict(entry, active=entry["generation"] == generations["active"],
+                            chunks=0 if store.alive is None else int(store.alive.sum())))
+        return res
+
+    def create_generation(self, description: str, embedding_model: str, embedding_model_revision: str) -> int:
+        generations = self.read_generations()
+        generation = max([entry["generation"] for entry in generations["generations"]]) + 1
+        os.makedirs(self.generation_dir(generation), exist_ok=True)
+        generations["generations"].append({"generation": generation, "description": description,
+                                           "embedding_model": embedding_model,
+                                           "embedding_model_revision": embedding_model_revision,
+                                           "chunk_len": None, "overlap_len": None,
+                                           "created": time.time(), "activated": None})
+        self.write_generations(generations)
+        return generation
+
+    def set_chunking(self, chunk_len: int, overlap_len: int) -> None:
+        # written to generations.json on commit
+        self.pending_chunking = (chunk_len, overlap_len)
+        self.chunk_len = chunk_len
+        self.overlap_len = overlap_len
+
+    def switch_generation(self, generation: int) -> None:
+        generation = self.resolve_generation(generation)
+        generations = self.read_generations()
+        for entry in generations["generations"]:
+            if entry["generation"] == generations["active"] and entry["activated"] is None:
+                # generation 1 of a store set up before the generations, active from the start
+                entry["activated"] = 0.0
+        generations["active"] = generation
+        for entry in generations["generations"]:
+            if entry["generation"] == generation:
+                entry["activated"] = time.time()
+        self.write_generations(generations)
+
+    def drop_generation(self, generation: int) -> None:
+        generation = self.resolve_generation(generation)
+        generations = self.read_generations()
+        if generation == generations["active"]:
+            print("ERROR: LocalStore.drop_generation(): generation %d is active." % generation)
+            sys.exit(1)
+        generations["generations"] = [entry for entry in generations["generations"]
+                                      if entry["generation"] != generation]
+        self.write_generations(generations)
+        if generation == 1:
+            # the files of generation 1 share the directory with the other generations
+            for name in ["store.json", "embeddings.bin", "bits.bin", "texts.bin", "chunks.jsonl", "deleted.jsonl",
+                         "checkpoints.json"]:
+                if os.path.exists("%s/%s" % (self.root, name)):
+                    os.remove("%s/%s" % (self.root, name))
+        else:
+            shutil.rmtree(self.generation_dir(generation), ignore_errors=True)
+
+    def is_active(self) -> bool:
+        return self.resolve_generation(None) == self.generation
+
+    def close(self) -> None:
+        self.pending = []
+        self.pending_files = {}
+        self.pending_embeddings = {}
+        self.pending_deletes = []
+        self.pending_checkpoints = {}
+        self.pending_chunking = None
+        self.reload_tag = None
+        self.matrix = None
+        self.bits = None
+
+
+def open_store(config: Dict[str, any], generation: Optional[int] = None) -> VectorStore:
+    # the store of the given generation, of the active one if None
+    if config["vector_store"] == "postgres":
+        return PgStore(config["quantization"], config["rerank_candidates"],
+                       config["tag_penalties"], config["search_tags"], generation)
+    if config["vector_store"] == "local":
+        return LocalStore(config["local_store_dir"], config["local_store_dtype"],
+                          config["quantization"], config["rerank_candidates"],
+                          config["tag_penalties"], config["search_tags"], generation)
+    print("ERROR: open_store(): unknown vector store '%s'." % config["vector_store"])
+    sys.exit(1)
+
+
+def previous_generation(store: VectorStore) -> Optional[int]:
+    # the generation activated most recently before the active one, None if there is none
+    # (the target of 'python generation.py rollback')
+    previous = [entry for entry in store.list_generations() if not entry["active"] and entry["activated"] is not None]
+    if len(previous) == 0:
+        return None
+    return max(previous, key=lambda entry: entry["activated"])["generation"]
@@ -20,15 +20,27 @@
 #     (see global README.md)
 #   - the script is incremental, it will skip files that are already present in
 #     the database
+#   - with journal=True, only the files the scrapers changed since the previous run
+#     are looked at (see rag_dir() in 'librag.py' and 'scrapers/libjournal.py'),
+#     modified and deleted files are replaced or removed
+#   - with reload=True, all files are loaded again and replace the chunks of the tag
+#     at once at the end (in Postgres, the partition of the tag is swapped)
+#   - the chunks go into the active generation, or into the generation given as
+#     argument ('python load.py 2'), to build a new generation while the chatbot
+#     keeps searching the active one (see 'generation.py')
 # ------------------------------------------------------------------------------
 
+import sys
+
 from librag import *
 
 
-rag_dir("../data_example", tag="example", chunk_len=5000, overlap_len=500, hard_limit=6000)
+generation = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+rag_dir("../data_example", tag="example", chunk_len=5000, overlap_len=500, hard_limit=6000, generation=generation)
 
 # used at NOI Techpark:
-# rag_dir("../data_ghissues", tag="ghissues", chunk_len=5000, overlap_len=500, hard_limit=6000)
-# rag_dir("../data_readme",   tag="readme",   chunk_len=5000, overlap_len=500, hard_limit=6000)
-# rag_dir("../data_rt",       tag="rt",       chunk_len=5000, overlap_len=500, hard_limit=6000)
-# rag_dir("../data_wiki",     tag="wiki",     chunk_len=5000, overlap_len=500, hard_limit=6000)
+# rag_dir("../data_ghissues", tag="ghissues", chunk_len=5000, overlap_len=500, hard_limit=6000, journal=True, generation=generation)
+# rag_dir("../data_readme",   tag="readme",   chunk_len=5000, overlap_len=500, hard_limit=6000, journal=True, generation=generation)
+# rag_dir("../data_rt",       tag="rt",       chunk_len=5000, overlap_len=500, hard_limit=6000, journal=True, generation=generation)
+# rag_dir("../data_wiki",     tag="wiki",     chunk_len=5000, overlap_len=500, hard_limit=6000, journal=True, generation=generation)
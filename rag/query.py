@@ -21,7 +21,8 @@
 #     ref. model: https://huggingface.co/BAAI/bge-m3
 #
 #   - for inference, whatever model you configured in `secrets_llm_endpoint.json`
-#     is used (see the global README.md for recommendations)
+#     is used (see the global README.md for recommendations and 'libllm.py' for
+#     more than one endpoint)
 #
 # If you have loaded the documents from ../data_examples, here is an example
 # question you can try:
@@ -40,26 +41,25 @@
 import time
 import sys
 import re
-import requests
 import json
 
 from librag import *
-from libpg import *
+from libstore import *
+from libllm import *
+from libprompt import *
 
 
-# --- read endpoint info ---
+# --- read configuration and endpoint info ---
 
-try:
-    file = open("secrets_llm_endpoint.json", "r")
-    endpoint = json.load(file)
-    file.close()
-except FileNotFoundError:
-    print("ERROR: cannot open file: secrets_llm_endpoint.json.")
-    sys.exit(1)
+rag_config = get_rag_config()
+
+llm_router = get_llm_router(rag_config)
 
 
 # --- main loop ---
 
+store = None
+
 while True:
 
     iteration = 0
@@ -86,31 +86,35 @@ while True:
 
         # --- search ---
 
-        # use the first top_n results out of top_max retrieved
-        # the default is top_n = 1, top_max = 5
+        # retrieve the top_max chunks, then pack as many of them as fit into the
+        # token budget into the context (see build_context() in 'librag.py')
 
-        top_n = 1
-        top_max = 5
+        top_max = rag_config["search_top_max"]
+        context_token_budget = rag_config["context_token_budget"]
 
-        cursor = open_cursor()
+        store = keep_store(store, rag_config)
         if iteration == 1:
-            res = search(cursor, top_max, question)
+            res = search(store, top_max, question)
         else:
-            res = search(cursor, top_max, last_message.get("content") + "\n" + question)
+            res = search(store, top_max, last_message.get("content") + "\n" + question)
 
         if len(res) < 1:
             print("ERROR: no results at all. Did you load some documents (load.py)?")
             sys.exit(1)
 
         top_max = min(len(res), top_max)
-        top_n = min(len(res), top_n, top_max)
+
+        segments = build_context(res, context_token_budget)
+        packed = set()
+        for seg in segments:
+            packed.update(seg["hits"])
 
         print("{meta}")
         print("{meta} embedding vector search - top %d chunks:" % top_max)
         print("{meta} distance   tag  offset  file_name")
         print("{meta} --------   ---  ------  ---------")
         for i in range(0, top_max):
-            if i < top_n:
+            if i in packed:
                 mark = " <-- will be added to context"
             else:
                 mark = ""
@@ -121,53 +125,16 @@ while True:
 
         # --- LLM input ---
 
-        context = ""
-        for i in range(0, top_n):
-            context = context + res[i]["file_body"]
-        if iteration == 1:
-
-            # first iteration
-
-            prompt = (
-f"""
-Answer the question using only the context provided below. Respond in the same language as the question.
-If the answer cannot be fully derived from the context, simply say \"I don't know\".
-
----
-Question:
-{question}
-
----
-Context:
-{context}
-""")
-
-            conversation = [
-                      {"role": "system", "content": "You are an assistant who answers questions."},
-                      {"role": "user",   "content": prompt}
-            ]
+        # the conversation so far is sent unchanged and the new question with its
+        # context goes last, so the LLM server can reuse the KV cache of the previous
+        # call (see 'libprompt.py')
 
+        context = format_context(segments)
+        if iteration == 1:
+            conversation = []
         else:
-
-            # follow-up iteration
-
-            prompt = (
-f"""
-Answer the follow-up question based on the context of this conversation. Respond in the same language as the question.
-If the answer cannot be fully derived from the context, simply say \"I don't know\".
-
----
-Question:
-{question}
-
----
-Here is additional context.
-If it is not relevant, ignore it. Otherwise, use it to refine your answer:
-{context}
-""")
-
-            conversation.append(last_message)
-            conversation.append({"role": "user", "content": prompt})
+            conversation.append(prompt_answer(last_message))
+        conversation = prompt_messages(conversation, question, context)
 
         # --- LLM output ---
 
@@ -177,22 +144,16 @@ If it is not relevant, ignore it. Otherwise, use it to refine your answer:
 
         t0 = time.time()
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + endpoint.get("api_key")
-        }
-        data = {
-            "model": endpoint.get("model"),
-            "messages": conversation
-        }
-
-        response = requests.post(endpoint.get("endpoint"), headers=headers, json=data)
-        result = response.json()
+        try:
+            result = llm_router.chat(conversation)
+        except LlmError as e:
+            print("ERROR: LLM error: %s" % e)
+            sys.exit(1)
 
         t1 = time.time()
 
         last_message = result.get("choices")[0].get("message")
 
-        print("{meta} LLM output in %6.3fs" % (t1-t0))    # token usage is in result.get("usage")
+        print("{meta} LLM output in %6.3fs (%s), %s" % (t1-t0, result["endpoint"], prompt_usage(result)))
         print("{meta}")
         print(last_message.get("content"))
@@ -0,0 +1,485 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Tests of the vector stores (see 'libstore.py'): each test runs on LocalStore and
+# on PgStore.
+#
+#   cd rag
+#   python -m pytest -q test_store.py
+#
+# The Postgres tests use the database of 'secrets_pg.json', in a schema of their own
+# (created with 'postgres/init.sql' and dropped at the end), so they don't touch the
+# tables of the chatbot. They are skipped when the database cannot be reached. The
+# tests of the migration scripts in 'postgres' start from the tables they migrate.
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import uuid
+
+import numpy as np
+import pytest
+
+from libstore import *
+
+
+rag_dir_path = os.path.dirname(os.path.abspath(__file__))
+dim = 1024
+
+
+def pg_connect() -> any:
+    # a connection to the database of 'secrets_pg.json', None if it cannot be reached
+    try:
+        file = open("%s/secrets_pg.json" % rag_dir_path, "r")
+        parameters = json.load(file)
+        file.close()
+        return psycopg2.connect(host=parameters["host"], port=parameters["port"], dbname=parameters["dbname"],
+                                user=parameters["user"], password=parameters["password"], connect_timeout=3)
+    except (FileNotFoundError, psycopg2.OperationalError):
+        return None
+
+
+def run_sql_file(conn: any, name: str) -> None:
+    # runs a script of 'postgres' statement by statement, as psql does (VACUUM cannot
+    # run in a transaction, nor in a string with other statements), and stops at the
+    # first error, as with ON_ERROR_STOP (the open transaction is rolled back)
+    file = open("%s/../postgres/%s" % (rag_dir_path, name), "r")
+    lines = file.read().split("\n")
+    file.close()
+    conn.commit()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    statement = ""
+    try:
+        for line in lines:
+            # comments and psql meta-commands
+            if line.startswith("--") or line.startswith("\\") or (statement == "" and line.strip() == ""):
+                continue
+            statement += line + "\n"
+            # the end of a statement, unless inside the $$ quotes of a DO block
+            if line.rstrip().endswith(";") and statement.count("$$") % 2 == 0:
+                cursor.execute(statement)
+                statement = ""
+    except psycopg2.Error:
+        cursor.execute("rollback")
+        raise
+    finally:
+        conn.autocommit = False
+
+
+@pytest.fixture
+def pg_conn(monkeypatch: pytest.MonkeyPatch) -> any:
+    # a connection to an empty schema, also used by the connections opened during the
+    # test (PGOPTIONS sets their search_path)
+    conn = pg_connect()
+    if conn is None:
+        pytest.skip("Postgres not reachable")
+    schema = "ragtest_%s" % uuid.uuid4().hex[:12]
+    cursor = conn.cursor()
+    cursor.execute("create extension if not exists vector")
+    cursor.execute("create schema %s" % schema)
+    conn.commit()
+    conn.close()
+    monkeypatch.setenv("PGOPTIONS", "-c search_path=%s,public" % schema)
+    conn = pg_connect()
+    yield conn
+    conn.rollback()
+    conn.cursor().execute("drop schema %s cascade" % schema)
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def pg_schema(pg_conn: any) -> None:
+    # the tables of 'postgres/init.sql'
+    run_sql_file(pg_conn, "init.sql")
+
+
+@pytest.fixture(params=["local", "postgres"])
+def open_test_store(request: pytest.FixtureRequest, tmp_path: any, monkeypatch: pytest.MonkeyPatch) -> any:
+    # a function returning a new store on the same (initially empty) storage
+    monkeypatch.chdir(rag_dir_path)
+    stores = []
+
+    if request.param == "local":
+        def open_test_store(tag_penalties: Dict[str, float] = None, generation: Optional[int] = None,
+                            quantization: str = "none", rerank_candidates: int = 0) -> VectorStore:
+            stores.append(LocalStore(str(tmp_path / "store"), "float32", quantization, rerank_candidates,
+                                     tag_penalties, [], generation))
+            return stores[-1]
+    else:
+        request.getfixturevalue("pg_schema")
+
+        def open_test_store(tag_penalties: Dict[str, float] = None, generation: Optional[int] = None,
+                            quantization: str = "none", rerank_candidates: int = 0) -> VectorStore:
+            stores.append(PgStore(quantization, rerank_candidates, tag_penalties, [], generation))
+            return stores[-1]
+    open_test_store.backend = request.param
+
+    yield open_test_store
+    for store in stores:
+        store.close()
+
+
+def vectors(n: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    v = rng.normal(size=(n, dim)).astype(np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def add_file(store: VectorStore, tag: str, file_name: str, body: str, spans: List[tuple], v: np.ndarray) -> None:
+    store.add_file(tag, file_name, body)
+    for i, (start_pos, end_pos) in enumerate(spans):
+        store.add_chunk(tag, file_name, start_pos, end_pos, v[i])
+
+
+body_a = "Eli is a blue elephant. He lives in the zoo of Bolzano. Größe: enorm. The end."
+spans_a = [(0, 24), (18, 56), (50, len(body_a))]
+body_b = "The planets of the solar system are eight."
+spans_b = [(0, len(body_b))]
+
+
+def test_add_and_search(open_test_store: any) -> None:
+    store = open_test_store()
+    v = vectors(4)
+    assert not store.has_file("example", "a.txt")
+    add_file(store, "example", "a.txt", body_a, spans_a, v)
+    add_file(store, "example", "b.txt", body_b, spans_b, v[3:])
+    store.commit()
+    assert store.has_file("example", "a.txt")
+    assert store.has_file("example", "b.txt")
+    assert not store.has_file("other", "a.txt")
+
+    res = store.search(v[1], 4)
+    assert len(res) == 4
+    assert (res[0]["file_name"], res[0]["start_pos"], res[0]["end_pos"]) == ("a.txt", 18, 56)
+    assert res[0]["tag"] == "example"
+    assert abs(res[0]["distance"]) < 1e-5
+    # the text of each chunk is its span of the file
+    bodies = {"a.txt": body_a, "b.txt": body_b}
+    for r in res:
+        assert r["file_body"] == bodies[r["file_name"]][r["start_pos"]:r["end_pos"]]
+    assert [r["distance"] for r in res] == sorted([r["distance"] for r in res])
+    assert len(store.search(v[1], 2)) == 2
+
+
+def test_search_sees_commits_of_other_stores(open_test_store: any) -> None:
+    # a store kept open for searching (see keep_store() in 'librag.py') finds what
+    # another store committed after it was opened
+    reader = open_test_store()
+    assert reader.search(vectors(1)[0], 3) == []
+    writer = open_test_store()
+    v = vectors(3)
+    add_file(writer, "example", "a.txt", body_a, spans_a, v)
+    writer.commit()
+    res = reader.search(v[2], 3)
+    assert len(res) == 3
+    assert res[0]["start_pos"] == 50
+
+
+def test_delete_file(open_test_store: any) -> None:
+    store = open_test_store()
+    v = vectors(4)
+    add_file(store, "example", "a.txt", body_a, spans_a, v)
+    add_file(store, "example", "b.txt", body_b, spans_b, v[3:])
+    store.commit()
+    store.delete_file("example", "a.txt")
+    store.commit()
+    assert not store.has_file("example", "a.txt")
+    assert store.has_file("example", "b.txt")
+    res = store.search(v[0], 4)
+    assert [r["file_name"] for r in res] == ["b.txt"]
+    # added again, with other chunks
+    add_file(store, "example", "a.txt", body_a, spans_a[:1], v[1:])
+    store.commit()
+    res = open_test_store().search(v[1], 4)
+    assert [(r["file_name"], r["start_pos"]) for r in res][0] == ("a.txt", 0)
+    assert len(res) == 2
+
+
+def test_tags(open_test_store: any) -> None:
+    store = open_test_store(tag_penalties={"rt": 0.5})
+    v = vectors(1)
+    add_file(store, "rt", "ticket.txt", body_b, spans_b, v)
+    add_file(store, "wiki", "page.txt", body_b, spans_b, v)
+    store.commit()
+    res = store.search(v[0], 2)
+    assert [r["tag"] for r in res] == ["wiki", "rt"]
+    assert abs(res[1]["distance"] - 0.5) < 1e-5
+    res = store.search(v[0], 2, ["rt"])
+    assert [r["tag"] for r in res] == ["rt"]
+
+
+def test_get_embeddings(open_test_store: any) -> None:
+    store = open_test_store()
+    v = vectors(4)
+    add_file(store, "example", "a.txt", body_a, spans_a, v)
+    store.commit()
+    known = content_hash(body_a[18:56])
+    res = open_test_store().get_embeddings([known, content_hash("not loaded")])
+    assert list(res.keys()) == [known]
+    assert np.allclose(res[known], v[1], atol=1e-5)
+    assert open_test_store().get_embeddings([]) == {}
+
+
+def test_checkpoints(open_test_store: any) -> None:
+    store = open_test_store()
+    assert store.get_checkpoint("journal:example") is None
+    v = vectors(3)
+    add_file(store, "example", "a.txt", body_a, spans_a, v)
+    store.set_checkpoint("journal:example", 1234)
+    store.commit()
+    store = open_test_store()
+    assert store.get_checkpoint("journal:example") == 1234
+    assert store.get_checkpoint("journal:other") is None
+    store.set_checkpoint("journal:example", 5678)
+    store.commit()
+    assert open_test_store().get_checkpoint("journal:example") == 5678
+
+
+@pytest.mark.parametrize("quantization", ["halfvec", "binary"])
+def test_quantization(open_test_store: any, quantization: str) -> None:
+    if quantization == "halfvec" and open_test_store.backend == "local":
+        pytest.skip("the local store has no halfvec")
+    store = open_test_store()
+    v = vectors(300)
+    for i in range(0, 300, 10):
+        body = "".join(["chunk %03d. " % j for j in range(i, i + 10)])
+        add_file(store, "example", "f%03d.txt" % i, body, [(11 * j, 11 * j + 11) for j in range(0, 10)], v[i:i + 10])
+    store.commit()
+    if open_test_store.backend == "postgres":
+        file = open("%s/../postgres/quantization.sql" % rag_dir_path, "r")
+        store.cursor.execute(file.read())
+        file.close()
+        store.commit()
+    store = open_test_store(quantization=quantization, rerank_candidates=100)
+    if open_test_store.backend == "postgres":
+        # with so few rows the planner would read the table and sort it, make it take the
+        # HNSW indexes as it does on a large table
+        store.cursor.execute("set enable_seqscan = off; set enable_bitmapscan = off; set enable_sort = off")
+    # all 100 candidates make it to the rerank (an HNSW index scan stops at hnsw.ef_search)
+    res = store.search(v[42], 100)
+    assert len(res) == 100
+    assert (res[0]["file_name"], res[0]["file_body"]) == ("f040.txt", "chunk 042. ")
+    assert [r["distance"] for r in res] == sorted([r["distance"] for r in res])
+    exact = open_test_store().search(v[42], 10)
+    assert [r["file_body"] for r in store.search(v[42], 10)][:1] == [exact[0]["file_body"]]
+
+
+def test_reload(open_test_store: any) -> None:
+    store = open_test_store()
+    v = vectors(6)
+    add_file(store, "example", "a.txt", body_a, spans_a, v)
+    add_file(store, "example", "b.txt", body_b, spans_b, v[3:])
+    add_file(store, "wiki", "page.txt", body_b, spans_b, v[4:])
+    store.commit()
+    reader = open_test_store()
+    before = sorted([(r["tag"], r["file_name"], r["file_body"]) for r in reader.search(v[5], 10)])
+    assert len(before) == 5
+    # twice, the second time on the partitions attached by the first reload
+    for body in ["A new text about Eli. Größe: enorm.", "Another text."]:
+        store.begin_reload("example")
+        assert not store.has_file("example", "a.txt")
+        add_file(store, "example", "a.txt", body, [(0, len(body))], v[5:])
+        store.commit()
+        # the loader sees the new chunks, the searches still the old ones
+        assert store.has_file("example", "a.txt")
+        assert not store.has_file("example", "b.txt")
+        assert list(store.get_embeddings([content_hash(body)]).keys()) == [content_hash(body)]
+        assert sorted([(r["tag"], r["file_name"], r["file_body"]) for r in reader.search(v[5], 10)]) == before
+        store.finish_reload()
+        store.commit()
+        after = sorted([(r["tag"], r["file_name"], r["file_body"]) for r in reader.search(v[5], 10)])
+        assert after == [("example", "a.txt", body), ("wiki", "page.txt", body_b)]
+        before = after
+    assert open_test_store().has_file("example", "a.txt")
+    assert not open_test_store().has_file("example", "b.txt")
+
+
+def test_reload_new_tag(open_test_store: any) -> None:
+    # a tag reloaded before it has any file (in Postgres: before it has a partition),
+    # with the indexes of 'postgres/quantization.sql' on the parents
+    store = open_test_store()
+    if open_test_store.backend == "postgres":
+        file = open("%s/../postgres/quantization.sql" % rag_dir_path, "r")
+        store.cursor.execute(file.read())
+        file.close()
+        store.commit()
+    v = vectors(3)
+    store.begin_reload("new")
+    add_file(store, "new", "a.txt", body_a, spans_a, v)
+    store.commit()
+    assert open_test_store().search(v[0], 3) == []
+    store.finish_reload()
+    store.commit()
+    res = open_test_store(quantization="binary", rerank_candidates=10).search(v[0], 3)
+    assert [(r["tag"], r["start_pos"]) for r in res][0] == ("new", 0)
+    assert len(res) == 3
+
+
+def test_generations(open_test_store: any) -> None:
+    # create, load, switch, roll back and drop, as with 'generation.py'
+    store = open_test_store()
+    v = vectors(3)
+    add_file(store, "example", "a.txt", body_a, spans_a, v)
+    store.set_checkpoint("journal:example", 10)
+    store.commit()
+    assert previous_generation(store) is None
+    generation = store.create_generation("chunk_len 3000", "intfloat/e5-large", "abc123")
+    assert generation == 2
+    # loaded while the active generation is searched
+    loader = open_test_store(generation=generation)
+    assert (loader.embedding_model, loader.embedding_model_revision) == ("intfloat/e5-large", "abc123")
+    assert (loader.chunk_len, loader.overlap_len) == (None, None)
+    assert loader.search(v[0], 3) == []
+    assert loader.get_checkpoint("journal:example") is None
+    loader.set_chunking(3000, 300)
+    add_file(loader, "example", "b.txt", body_b, spans_b, v)
+    add_file(loader, "wiki", "page.txt", body_b, spans_b, v[1:])
+    loader.set_checkpoint("journal:example", 20)
+    loader.commit()
+    # the parameters of each generation, generation 1 has the model from before the generations
+    assert [(g["generation"], g["embedding_model"], g["embedding_model_revision"], g["chunk_len"], g["overlap_len"])
+            for g in store.list_generations()] == \
+        [(1, default_embedding_model, default_embedding_model_revision, None, None),
+         (2, "intfloat/e5-large", "abc123", 3000, 300)]
+    reader = open_test_store()
+    assert [r["file_name"] for r in reader.search(v[0], 5)] == ["a.txt"] * 3
+    assert reader.is_active()
+
+    store.switch_generation(generation)
+    assert not reader.is_active()
+    assert (open_test_store().embedding_model, open_test_store().chunk_len) == ("intfloat/e5-large", 3000)
+    res = open_test_store().search(v[0], 5)
+    assert sorted([(r["tag"], r["file_name"]) for r in res]) == [("example", "b.txt"), ("wiki", "page.txt")]
+    assert open_test_store().get_checkpoint("journal:example") == 20
+    assert open_test_store(generation=1).get_checkpoint("journal:example") == 10
+    assert [(g["generation"], g["active"], g["chunks"]) for g in store.list_generations()] == \
+        [(1, False, 3), (2, True, 2)]
+
+    # rollback
+    assert previous_generation(store) == 1
+    store.switch_generation(1)
+    assert reader.is_active()
+    assert [r["file_name"] for r in open_test_store().search(v[0], 5)] == ["a.txt"] * 3
+    assert previous_generation(store) == 2
+
+    with pytest.raises(SystemExit):
+        store.drop_generation(1)
+    store.drop_generation(generation)
+    assert [(g["generation"], g["active"]) for g in store.list_generations()] == [(1, True)]
+    with pytest.raises(SystemExit):
+        open_test_store(generation=generation)
+    # the number is used again, empty
+    assert store.create_generation("again", default_embedding_model, default_embedding_model_revision) == generation
+    assert open_test_store(generation=generation).search(v[0], 5) == []
+    assert open_test_store(generation=generation).get_checkpoint("journal:example") is None
+
+
+# the ragdata table before 'postgres/partition.sql', with the chunk texts in file_body
+flat_ragdata_sql = """
+create table ragdata (
+    id          bigserial,
+    tag         text not null,
+    file_name   text not null,
+    start_pos   bigint,
+    end_pos     bigint,
+    ts          timestamp with time zone default now() not null,
+    file_body   text not null,
+    embedding   vector(1024) not null,
+    primary key(id),
+    unique(tag, file_name, start_pos, end_pos)
+);
+create table ragcheckpoint (
+    name        text not null,
+    position    bigint not null,
+    primary key(name)
+)
+"""
+
+
+def load_flat(conn: any) -> np.ndarray:
+    # a flat ragdata with the chunks of a.txt and b.txt (tag "example") and page.txt
+    # (tag "wiki"), returns their embeddings
+    v = vectors(5)
+    cursor = conn.cursor()
+    cursor.execute(flat_ragdata_sql)
+    rows = [("example", "a.txt", body_a, span) for span in spans_a] + [("example", "b.txt", body_b, spans_b[0]),
+                                                                       ("wiki", "page.txt", body_b, spans_b[0])]
+    for i, (tag, file_name, body, (start_pos, end_pos)) in enumerate(rows):
+        cursor.execute("insert into ragdata (tag, file_name, start_pos, end_pos, file_body, embedding) "
+                       "values (%s, %s, %s, %s, %s, %s)",
+                       [tag, file_name, start_pos, end_pos, body[start_pos:end_pos], v[i].tolist()])
+    conn.commit()
+    return v
+
+
+def test_partition_sql(pg_conn: any) -> None:
+    load_flat(pg_conn)
+    run_sql_file(pg_conn, "partition.sql")
+    cursor = pg_conn.cursor()
+    cursor.execute("select tableoid::regclass::text, count(1), max(id) from ragdata group by 1 order by 1")
+    assert cursor.fetchall() == [("ragdata_example", 4, 4), ("ragdata_wiki", 1, 5)]
+    # new rows get new ids, and a new tag goes to the default partition
+    cursor.execute("insert into ragdata (tag, file_name, start_pos, end_pos, file_body, embedding) "
+                   "select 'other', file_name, start_pos, end_pos, file_body, embedding from ragdata "
+                   "where tag = 'wiki' returning id, tableoid::regclass::text")
+    assert cursor.fetchall() == [(6, "ragdata_default")]
+    pg_conn.commit()
+
+
+def test_generation_sql(pg_conn: any) -> None:
+    load_flat(pg_conn)
+    run_sql_file(pg_conn, "partition.sql")
+    run_sql_file(pg_conn, "generation.sql")
+    cursor = pg_conn.cursor()
+    cursor.execute("select tableoid::regclass::text, generation, count(1) from ragdata group by 1, 2 order by 1")
+    assert cursor.fetchall() == [("ragdata_g1_example", 1, 4), ("ragdata_g1_wiki", 1, 1)]
+    cursor.execute("select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid "
+                   "where i.inhparent = 'ragdata_g1'::regclass order by 1")
+    assert [row[0] for row in cursor.fetchall()] == ["ragdata_g1_default", "ragdata_g1_example", "ragdata_g1_wiki"]
+    cursor.execute("select generation, active from raggeneration")
+    assert cursor.fetchall() == [(1, True)]
+    # the ids go on, a second generation can be attached
+    cursor.execute("create table ragdata_g2 partition of ragdata for values in (2)")
+    cursor.execute("insert into ragdata (tag, file_name, start_pos, end_pos, file_body, embedding, generation) "
+                   "select tag, file_name, start_pos, end_pos, file_body, embedding, 2 from ragdata "
+                   "where tag = 'wiki' returning id, tableoid::regclass::text")
+    assert cursor.fetchall() == [(6, "ragdata_g2")]
+    pg_conn.commit()
+
+
+def test_ragfile_sql(pg_conn: any) -> None:
+    v = load_flat(pg_conn)
+    for name in ["partition.sql", "generation.sql", "ragfile.sql"]:
+        run_sql_file(pg_conn, name)
+    cursor = pg_conn.cursor()
+    cursor.execute("select file_name, body from ragfile order by tag, file_name")
+    assert cursor.fetchall() == [("a.txt", body_a), ("b.txt", body_b), ("page.txt", body_b)]
+    pg_conn.commit()
+    # the store works on the migrated tables
+    store = PgStore("none", 0)
+    res = store.search(v[1], 5)
+    assert (res[0]["file_name"], res[0]["start_pos"], res[0]["file_body"]) == ("a.txt", 18, body_a[18:56])
+    assert sorted([r["file_body"] for r in res]) == sorted([body_a[s:e] for (s, e) in spans_a] + [body_b] * 2)
+    known = content_hash(body_a[50:])
+    assert list(store.get_embeddings([known]).keys()) == [known]
+    store.close()
+
+
+def test_ragfile_sql_mismatch(pg_conn: any) -> None:
+    # the overlap of two chunks of a.txt differs (a file saved again between the loads of
+    # its chunks): ragfile.sql stops before it drops the chunk texts
+    load_flat(pg_conn)
+    for name in ["partition.sql", "generation.sql"]:
+        run_sql_file(pg_conn, name)
+    cursor = pg_conn.cursor()
+    cursor.execute("update ragdata set file_body = 'X' || substr(file_body, 2) where start_pos = 18")
+    pg_conn.commit()
+    with pytest.raises(psycopg2.Error, match="1 chunks are not the span of their file text"):
+        run_sql_file(pg_conn, "ragfile.sql")
+    cursor.execute("select to_regclass('ragfile') is null, count(file_body) from ragdata")
+    assert cursor.fetchall() == [(True, 5)]
+    pg_conn.commit()
@@ -0,0 +1,216 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# --------------------------------------------------------------------------------------------------
+# Benchmark 'scrape_ghissues.py' against a local mock of the GitHub REST API.
+#
+# The mock serves an organization with 'num_repos' repositories of 'num_issues' issues
+# each (with 'num_comments' comments), answers each request after 'latency_sec' seconds,
+# supports pagination, ETags/If-None-Match and the since filter of the issue list, and
+# sends rate limit headers.
+#
+# The scraper runs in a temporary directory, once for each concurrency: a full scrape
+# and then an incremental one after a few issues have been updated. The output files
+# of all concurrencies must be identical.
+#
+# Usage:
+#
+#   python bench_ghissues.py
+# --------------------------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+num_repos = 40
+num_issues = 60
+num_comments = 3
+latency_sec = 0.05
+concurrencies = [1, 4, 8, 16]
+port = 8767
+
+scraper_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+class MockGitHub:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.issues = {}
+        for r in range(0, num_repos):
+            for i in range(1, num_issues + 1):
+                self.issues[("repo-%02d" % r, i)] = {
+                    "url": "https://api.github.com/repos/org/repo-%02d/issues/%d" % (r, i),
+                    "number": i,
+                    "title": "Issue %d of repo %d" % (i, r),
+                    "state": "open",
+                    "body": "Something does not work in repo %d, see issue %d." % (r, i),
+                    "comments": num_comments,
+                    "created_at": "2024-01-01T00:00:00Z",
+                    "updated_at": "2024-01-%02dT%02d:00:00Z" % (1 + i % 28, r % 24),
+                    "user": {"login": "user-%d" % (i % 7)},
+                    "labels": [],
+                    "assignees": []
+                }
+        self.requests = 0
+        self.not_modified = 0
+
+    def touch(self, count):
+        # a new comment on the first issues of the first repositories (the update time
+        # is fixed to keep the output files comparable)
+        with self.lock:
+            for r in range(0, count):
+                issue = self.issues[("repo-%02d" % r, 1)]
+                issue["comments"] += 1
+                issue["updated_at"] = "2099-01-01T00:00:00Z"
+
+
+mock = MockGitHub()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, link=None):
+        body = json.dumps(data).encode("utf-8")
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        time.sleep(latency_sec)
+        with mock.lock:
+            mock.requests += 1
+        if self.headers.get("If-None-Match") == etag:
+            with mock.lock:
+                mock.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", "4999")
+        self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+        if link:
+            self.send_header("Link", link)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self, items, path, query):
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["30"])[0])
+        link = None
+        if page * per_page < len(items):
+            query["page"] = [str(page + 1)]
+            link = '<http://127.0.0.1:%d%s?%s>; rel="next"' % (port, path, urllib.parse.urlencode(query, doseq=True))
+        self.send_json(items[(page - 1) * per_page:page * per_page], link)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "orgs":
+            self.send_page([{"name": "repo-%02d" % r} for r in range(0, num_repos)], url.path, query)
+        elif len(parts) == 4 and parts[3] == "issues":
+            with mock.lock:
+                items = [dict(issue) for (repo, i), issue in mock.issues.items()
+                         if repo == parts[2] and issue["updated_at"] >= query.get("since", [""])[0]]
+            items.sort(key=lambda issue: issue["updated_at"], reverse=True)
+            self.send_page(items, url.path, query)
+        elif len(parts) == 6 and parts[5] == "comments":
+            with mock.lock:
+                count = mock.issues[(parts[2], int(parts[4]))]["comments"]
+            comments = [{"body": "Comment %d" % c, "user": {"login": "user-%d" % c},
+                         "created_at": "2024-02-01T00:00:00Z"} for c in range(0, count)]
+            self.send_page(comments, url.path, query)
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+
+def run_scraper(workdir: str) -> float:
+    t0 = time.time()
+    result = subprocess.run([sys.executable, "%s/scrape_ghissues.py" % scraper_dir], cwd="%s/scrapers" % workdir,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        print("ERROR: scrape_ghissues.py failed in '%s'." % workdir)
+        sys.exit(1)
+    return time.time() - t0
+
+
+def read_output(workdir: str) -> dict:
+    # the issue files and the issues in the state store
+    output = {}
+    for file_name in sorted(os.listdir("%s/data_ghissues" % workdir)):
+        file = open("%s/data_ghissues/%s" % (workdir, file_name), "r")
+        output[file_name] = file.read()
+        file.close()
+    db = sqlite3.connect("%s/log_ghissues/00_state_ghissues.db" % workdir)
+    output["issues"] = db.execute("SELECT repo, issue, updated_at, comment_count, content_hash, file_name "
+                                  "FROM issues ORDER BY repo, issue").fetchall()
+    db.close()
+    return output
+
+
+def make_workdir(tmp: str, concurrency: int) -> str:
+    workdir = "%s/c%d" % (tmp, concurrency)
+    for dirname in ["scrapers", "data_ghissues", "log_ghissues"]:
+        os.makedirs("%s/%s" % (workdir, dirname))
+    for file_name in ["config_ghissues.txt", "config_ghissues_comments.txt"]:
+        shutil.copy("%s/%s" % (scraper_dir, file_name), "%s/scrapers" % workdir)
+    file = open("%s/scrapers/secrets_gh.json" % workdir, "w")
+    json.dump({"github_token": "", "project_owner": "org", "base_url": "http://127.0.0.1:%d" % port,
+               "concurrency": concurrency, "requests_per_sec": 1000}, file)
+    file.close()
+    return workdir
+
+
+def main() -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("%d repositories x %d issues, %.0f ms latency per request" %
+          (num_repos, num_issues, 1000 * latency_sec))
+    print("%-12s %12s %10s %12s %10s" % ("concurrency", "full s", "requests", "incr. s", "requests"))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        reference = None
+        for concurrency in concurrencies:
+            workdir = make_workdir(tmp, concurrency)
+            mock.__init__()
+            full = run_scraper(workdir)
+            full_requests = mock.requests
+            mock.touch(5)
+            mock.requests = 0
+            incremental = run_scraper(workdir)
+            print("%-12d %12.2f %10d %12.2f %10d" %
+                  (concurrency, full, full_requests, incremental, mock.requests))
+            output = read_output(workdir)
+            if reference is None:
+                reference = output
+            elif output != reference:
+                print("ERROR: the output with concurrency %d differs from concurrency %d." %
+                      (concurrency, concurrencies[0]))
+                sys.exit(1)
+    finally:
+        shutil.rmtree(tmp)
+        server.shutdown()
+
+
+main()
@@ -0,0 +1,229 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# --------------------------------------------------------------------------------------------------
+# Benchmark and test 'scrape_rt.py' against a local mock of the Request Tracker REST 1.0 API.
+#
+# The mock serves a queue of 'num_tickets' tickets with 'num_transactions' transactions each
+# (one in three of a type the scraper ignores) and answers each request after 'latency_sec'
+# seconds. The first request for every 'fail_every'-th transaction body fails with a 500,
+# like a server that is briefly overloaded.
+#
+# The scraper runs in a temporary directory, once for each concurrency: a full scrape (some
+# bodies fail) and then an incremental one after a few tickets got a new transaction (the
+# failed bodies are fetched again). The old/new/nil counts of each run, the output files and
+# the state file of all concurrencies must be identical, and after the incremental run every
+# body must be on disk.
+#
+# Usage:
+#
+#   python bench_rt.py
+# --------------------------------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+num_tickets = 100
+num_transactions = 6
+fail_every = 17
+latency_sec = 0.02
+concurrencies = [1, 4, 8, 16]
+port = 8768
+
+scraper_dir = os.path.dirname(os.path.abspath(__file__))
+transaction_types = ["Ticket created", "Correspondence added", "Status changed from 'new' to 'open'",
+                     "Comments added", "Correspondence added", "Priority changed from 0 to 10"]
+relevant_types = ["Ticket created", "Correspondence added", "Comments added"]
+
+
+class MockRT:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tickets = {}
+        self.transactions = {}
+        self.next_tx_id = 1000
+        for t in range(1, num_tickets + 1):
+            self.tickets[t] = {"last_updated": "2024-06-%02d %02d:%02d:00" % (1 + t % 28, t % 24, t % 60),
+                               "transactions": []}
+            for k in range(0, num_transactions):
+                self.add_transaction(t, transaction_types[k % len(transaction_types)])
+        self.failed = set()
+        self.requests = 0
+
+    def add_transaction(self, ticket_id, tx_type):
+        tx_id = self.next_tx_id
+        self.next_tx_id += 1
+        self.tickets[ticket_id]["transactions"].append((tx_id, tx_type))
+        self.transactions[tx_id] = ticket_id
+
+    def touch(self, count):
+        # new correspondence on the first tickets (the update time is fixed to keep the
+        # output files comparable)
+        with self.lock:
+            for t in range(1, count + 1):
+                self.add_transaction(t, "Correspondence added")
+                self.tickets[t]["last_updated"] = "2099-01-01 00:00:00"
+
+    def expected_files(self):
+        # the bodies of all relevant transactions
+        with self.lock:
+            return sorted(["ticket-%d-%d.txt" % (t, tx_id) for t in self.tickets
+                           for (tx_id, tx_type) in self.tickets[t]["transactions"] if tx_type in relevant_types])
+
+
+mock = MockRT()
+
+
+def rt_date(text):
+    # '2024-06-06 11:15:12' -> 'Thu Jun 06 11:15:12 2024', as shown by RT
+    return time.strftime("%a %b %d %H:%M:%S %Y", time.strptime(text, "%Y-%m-%d %H:%M:%S"))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_text(self, status, text):
+        body = ("RT/4.4.4 %d %s\n\n%s\n" % (status, "Ok" if status == 200 else "Error", text)).encode("utf-8")
+        time.sleep(latency_sec)
+        with mock.lock:
+            mock.requests += 1
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = url.path.strip("/").split("/")[2:]
+        if parts == ["search", "ticket"]:
+            match = re.search(r"LastUpdated >= '([^']+)'", query.get("query", [""])[0])
+            since = match.group(1) if match else ""
+            with mock.lock:
+                records = ["id: ticket/%d\nLastUpdated: %s" % (t, rt_date(ticket["last_updated"]))
+                           for t, ticket in mock.tickets.items() if ticket["last_updated"] >= since]
+            self.send_text(200, "\n\n--\n\n".join(records))
+        elif len(parts) == 3 and parts[0] == "ticket" and parts[2] == "history":
+            with mock.lock:
+                transactions = list(mock.tickets[int(parts[1])]["transactions"])
+            self.send_text(200, "# %d/%d (/total)\n\n%s" % (
+                len(transactions), len(transactions),
+                "\n".join(["%d: %s by user" % (tx_id, tx_type) for (tx_id, tx_type) in transactions])))
+        elif len(parts) == 5 and parts[0] == "ticket" and parts[2] == "history" and parts[3] == "id":
+            tx_id = int(parts[4])
+            with mock.lock:
+                fail = tx_id % fail_every == 0 and tx_id not in mock.failed
+                if fail:
+                    mock.failed.add(tx_id)
+            if fail:
+                self.send_text(500, "Internal Server Error")
+                return
+            self.send_text(200, "# 1/1 (id/%d/total)\n\nid: %d\nTicket: %s\nContent: Message %d of ticket %s.\n"
+                                "> the quoted previous message\n" % (tx_id, tx_id, parts[1], tx_id, parts[1]))
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+
+def run_scraper(workdir: str) -> tuple:
+    # the time and the (old, new, nil) counts of a run
+    t0 = time.time()
+    result = subprocess.run([sys.executable, "%s/scrape_rt.py" % scraper_dir], cwd="%s/scrapers" % workdir,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        print("ERROR: scrape_rt.py failed in '%s'." % workdir)
+        sys.exit(1)
+    match = re.search(r"\((\d+) old, (\d+) new, (\d+) nil\)", result.stdout.decode("utf-8"))
+    if match is None:
+        print("ERROR: no counts in the output of scrape_rt.py in '%s'." % workdir)
+        sys.exit(1)
+    return time.time() - t0, tuple([int(count) for count in match.groups()])
+
+
+def read_output(workdir: str) -> dict:
+    # the body files and the state file
+    output = {}
+    for file_name in sorted(os.listdir("%s/data_rt" % workdir)):
+        file = open("%s/data_rt/%s" % (workdir, file_name), "r")
+        output[file_name] = file.read()
+        file.close()
+    file = open("%s/log_rt/00_state_rt.json" % workdir, "r")
+    output["state"] = json.load(file)
+    file.close()
+    return output
+
+
+def make_workdir(tmp: str, concurrency: int) -> str:
+    workdir = "%s/c%d" % (tmp, concurrency)
+    for dirname in ["scrapers", "data_rt", "log_rt"]:
+        os.makedirs("%s/%s" % (workdir, dirname))
+    file = open("%s/scrapers/secrets_rt.json" % workdir, "w")
+    json.dump({"base_url": "http://127.0.0.1:%d/REST/1.0" % port, "auth_parameters": "user=bench&pass=bench",
+               "queue_name": "bench", "concurrency": concurrency, "requests_per_sec": 1000}, file)
+    file.close()
+    return workdir
+
+
+def main() -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("%d tickets x %d transactions, %.0f ms latency per request" %
+          (num_tickets, num_transactions, 1000 * latency_sec))
+    print("%-12s %10s %10s %18s %10s %10s %18s" %
+          ("concurrency", "full s", "requests", "old/new/nil", "incr. s", "requests", "old/new/nil"))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        reference = None
+        reference_counts = None
+        for concurrency in concurrencies:
+            workdir = make_workdir(tmp, concurrency)
+            mock.__init__()
+            (full, full_counts) = run_scraper(workdir)
+            full_requests = mock.requests
+            mock.touch(5)
+            mock.requests = 0
+            (incremental, incremental_counts) = run_scraper(workdir)
+            print("%-12d %10.2f %10d %18s %10.2f %10d %18s" %
+                  (concurrency, full, full_requests, "%d/%d/%d" % full_counts,
+                   incremental, mock.requests, "%d/%d/%d" % incremental_counts))
+            output = read_output(workdir)
+            missing = set(mock.expected_files()) - set(output.keys())
+            if len(missing) > 0:
+                print("ERROR: %d bodies missing with concurrency %d, e.g. '%s'." %
+                      (len(missing), concurrency, sorted(missing)[0]))
+                sys.exit(1)
+            if reference is None:
+                reference = output
+                reference_counts = (full_counts, incremental_counts)
+            elif output != reference:
+                print("ERROR: the output with concurrency %d differs from concurrency %d." %
+                      (concurrency, concurrencies[0]))
+                sys.exit(1)
+            elif (full_counts, incremental_counts) != reference_counts:
+                print("ERROR: the counts with concurrency %d differ from concurrency %d." %
+                      (concurrency, concurrencies[0]))
+                sys.exit(1)
+    finally:
+        shutil.rmtree(tmp)
+        server.shutdown()
+
+
+main()
@@ -0,0 +1,72 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# The change journal: every scraper appends the files it added, modified or
+# deleted in the data_* directories to '../journal/changes.jsonl', so that
+# rag_dir() (see 'librag.py') only has to look at the files that changed.
+#
+# One line per file:
+#
+#   {"time": "2024-06-06T11:15:12Z", "change": "added" | "modified" | "deleted",
+#    "file": "data_wiki/Home.md", "hash": "<sha256 of the content>" | null}
+#
+# The file names are relative to the top directory of the project (the parent
+# of the working directory of the scrapers and of the rag scripts). The journal
+# is append-only; the lines of a call to append_changes() are written with a
+# single write under an exclusive lock, so scrapers can run at the same time.
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+
+
+journal_file_name = "../journal/changes.jsonl"
+
+
+def file_hash(file_name):
+    try:
+        file = open(file_name, "rb")
+        content = file.read()
+        file.close()
+    except FileNotFoundError:
+        return None
+    return hashlib.sha256(content).hexdigest()
+
+
+def journal_path(file_name):
+    # file name relative to the top directory, e.g. '../data_wiki/Home.md' -> 'data_wiki/Home.md'
+    return os.path.relpath(os.path.abspath(file_name), os.path.abspath(".."))
+
+
+def append_changes(changes):
+    # changes is a list of (change, file name) with change "added", "modified" or "deleted"
+    if len(changes) == 0:
+        return
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    data = ""
+    for change, file_name in changes:
+        content_hash = None if change == "deleted" else file_hash(file_name)
+        data += json.dumps({"time": now, "change": change, "file": journal_path(file_name), "hash": content_hash}) + "\n"
+    os.makedirs(os.path.dirname(journal_file_name), exist_ok=True)
+    file = open(journal_file_name, "ab")
+    fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    try:
+        # an interrupted write can leave an incomplete line at the end, which the readers
+        # ignore: start on a new line, so that our lines stay valid
+        if file.tell() > 0:
+            tail = open(journal_file_name, "rb")
+            tail.seek(-1, os.SEEK_END)
+            if tail.read(1) != b"\n":
+                data = "\n" + data
+            tail.close()
+        file.write(data.encode("utf-8"))
+        file.flush()
+        os.fsync(file.fileno())
+    finally:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        file.close()
@@ -8,28 +8,60 @@
 # Note:
 #   - github issue layer:
 #     1. all project repositories
-#     2. all repository issues
-#     3. specific issue
-#     4. all issue comments
+#     2. all repository issues (most recently updated first)
+#     3. all issue comments
 #   - github token can be added in 'secrets_gh.json', 
 #     to make more api requests per hour, otherwise leave blank and request as public user.
+#   - repositories and issues are processed concurrently, with at most 'concurrency'
+#     requests at a time (optional in 'secrets_gh.json', default 8).
+#   - all threads take their requests from a global token bucket: at most 'requests_per_sec'
+#     (optional in 'secrets_gh.json', default 10, below GitHub's secondary rate limit of
+#     900 points per minute). When less than 10% of the primary rate limit is left, the
+#     remaining requests are spread evenly until the rate limit is reset (according to the
+#     X-RateLimit-Remaining/Reset response headers). A rejected request (403/429 with
+#     Retry-After or exhausted rate limit) pauses all threads.
+#   - 'base_url' in 'secrets_gh.json' (optional, default https://api.github.com) allows
+#     to scrape from GitHub Enterprise or from a mock server (see 'bench_ghissues.py').
+#   - the ETags of the repository list and of the first page of the issues of each repository
+#     are kept in the state store (see below) and sent as If-None-Match: an unchanged
+#     page is answered with 304 Not Modified, which does not count against the rate limit.
+#     A 304 for the first issue page means that no issue of the repository has been updated.
+#   - the issue list is filtered by GitHub with since=<time of the previous run>, so only the
+#     issues updated since then are listed, and only those whose update time or comment count
+#     changed are fetched again. As before, only open issues are scraped (without state=all):
+#     an issue that gets closed keeps the file of its last open state.
+#     The ETag of the first issue page is kept under the url without since, which changes with
+#     every run: an empty page (nothing updated) is then answered with 304.
 #   - attributes to extract from issues are configured in 'config_ghissues.txt'.
 #   - attributes to extract from comments are configured in 'config_ghissues_comments.txt'.
 #   - scraped texts are stored in '../data_ghissues/X-issue-Y.txt',
 #     where X is the repository and Y is the issue ID
-#   - summary file '../log_ghissues/00_summary_scraped_repo_and_issues.txt' contains stats of scraped issues,
-#     also used to compare if issue is updated
+#   - the state store '../log_ghissues/00_state_ghissues.db' (SQLite) contains, for each scraped issue,
+#     the update time (UTC), the comment count, the hash of the text and the file name, used to compare
+#     if the issue is updated. Each issue is committed as soon as its file is written, so an interrupted
+#     run resumes where it stopped. The time of the last complete run and the ETags are stored at the end.
+#   - written issue files are appended to the change journal (see 'libjournal.py') before the
+#     issue is committed to the state store.
+#   - the summary file '../log_ghissues/00_summary_scraped_repo_and_issues.txt' of older versions
+#     is imported into the state store on the first run (and renamed to '*.imported').
 # --------------------------------------------------------------------------------------------------
 
 
 import urllib.request
+import urllib.error
 import json
 import time
 import sys
 import os
 import re
+import hashlib
+import sqlite3
 import textwrap
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from libjournal import *
 
 # --- logging ---
 
@@ -51,9 +83,10 @@ except FileNotFoundError:
 
 token = gh_param.get("github_token")
 project_owner = gh_param.get("project_owner")
-rate_limit_delay_sec = gh_param.get("rate_limit_delay_sec")
+concurrency = gh_param.get("concurrency", 8)
+requests_per_sec = gh_param.get("requests_per_sec", 10.0)
 
-base_url = "https://api.github.com"
+base_url = gh_param.get("base_url", "https://api.github.com")
 query_params = "?per_page=100" # per_page for number of entries
 dev = False # param for development to break while loop
 
@@ -62,8 +95,57 @@ config_ghissues_comments = "config_ghissues_comments.txt"
 format_attributes = ["Body"]
 out_dir = "../data_ghissues"
 log_dir = "../log_ghissues"
+state_file_name = f"{log_dir}/00_state_ghissues.db"
 summary_file_name = f"{log_dir}/00_summary_scraped_repo_and_issues.txt"
 request_count = 0
+not_modified_count = 0
+count_lock = threading.Lock()
+max_retry_delay_sec = 300
+rate_limit_reserve = 0.1
+
+# url -> {"etag": ..., "link": ..., "names": [...]}, see make_github_request()
+etags = {}
+
+
+class TokenBucket:
+
+    # shared by all threads: on average at most 'rate' requests per second, in bursts
+    # of at most 'capacity' requests; pause() stops all threads for some seconds
+
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = max(min(rate, self.max_rate), 0.01)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.tokens = 0
+            self.last = max(self.last, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.last:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                    self.last = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.last - now
+            time.sleep(wait)
+
+
+token_bucket = TokenBucket(requests_per_sec, concurrency)
 
 # --- functions ---
 
@@ -71,37 +153,156 @@ def load_config(config_file):
     with open(config_file, 'r') as file:
         return [line.strip() for line in file]
     
-def make_github_request(url, function_name):
-    global request_count
-
-    success = False
-
-    while not success:
+def make_github_request(url, function_name, conditional=False, etag_url=None):
+    # With conditional=True, the ETag of the previous response for this url (or for
+    # etag_url, if given) is sent as If-None-Match. If the content did not change, GitHub
+    # answers 304 and we return None as json_data (and the Link header of the previous
+    # response).
+    global request_count, not_modified_count
+
+    retry_delay_sec = 5
+
+    while True:
+        token_bucket.acquire()
+        req = urllib.request.Request(url)
+        if token:
+            req.add_header('Authorization', f'Bearer {token}')
+        cached = etags.get(etag_url or url) if conditional else None
+        if cached:
+            req.add_header('If-None-Match', cached["etag"])
         try:
-            req = urllib.request.Request(url)
-            if token:
-                req.add_header('Authorization', f'Bearer {token}')
             with urllib.request.urlopen(req) as response:
                 if response.getcode() != 200:
                     raise Exception("unexpected status code: %d" % response.getcode())
                 data = response.read()
                 header_link = response.headers.get("Link")
-                request_count += 1
-                if request_count % 1 == 0:
-                    logger.debug("Executing: %s", url)
+                etag = response.headers.get("ETag")
+                with count_lock:
+                    request_count += 1
+                logger.debug("Executing: %s", url)
+                pace_requests(response.headers)
             json_data = json.loads(data.decode('utf-8'))
-            success = True
+            if conditional and etag:
+                etags[etag_url or url] = {"etag": etag, "link": header_link}
+            return json_data, header_link
+        except urllib.error.HTTPError as ex:
+            if ex.code == 304 and cached:
+                with count_lock:
+                    not_modified_count += 1
+                logger.debug("Not modified: %s", url)
+                return None, cached["link"]
+            delay = rate_limit_delay(ex.headers)
+            if (ex.code == 403 or ex.code == 429) and delay is not None:
+                logger.warning("%s: rate limit exceeded, will retry in %d seconds", function_name, delay)
+                token_bucket.pause(delay)
+                continue
+            logger.warning("%s: got exception: %s", function_name, ex)
         except Exception as ex:
-            print("Got exception:")
-            print(ex)
-            print("Will retry in 5 minutes...")
-            time.sleep(300)
-   
-    # need to sleep some time due to rate limits:
+            logger.warning("%s: got exception: %s", function_name, ex)
+        logger.warning("%s: will retry in %d seconds", function_name, retry_delay_sec)
+        time.sleep(retry_delay_sec)
+        retry_delay_sec = min(2 * retry_delay_sec, max_retry_delay_sec)
+
+def pace_requests(headers):
+    # full speed while more than rate_limit_reserve of the rate limit is left, then
+    # spread the remaining requests evenly over the time until the rate limit is reset:
     # https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api
-    time.sleep(rate_limit_delay_sec)
-
-    return json_data, header_link
+    limit = headers.get("X-RateLimit-Limit")
+    remaining = headers.get("X-RateLimit-Remaining")
+    reset = headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None:
+        return
+    until_reset = int(reset) - time.time()
+    if until_reset <= 0:
+        return
+    if int(remaining) == 0:
+        logger.info("rate limit used up, waiting %d seconds for the reset", until_reset)
+        token_bucket.pause(until_reset + 1)
+    elif limit is not None and int(remaining) > rate_limit_reserve * int(limit):
+        token_bucket.set_rate(requests_per_sec)
+    else:
+        token_bucket.set_rate(int(remaining) / until_reset)
+
+def rate_limit_delay(headers):
+    # seconds to wait before retrying a request rejected by the (primary or secondary)
+    # rate limit, None if the rejection was not due to a rate limit
+    if headers is None:
+        return None
+    if headers.get("Retry-After"):
+        return int(headers.get("Retry-After"))
+    if headers.get("X-RateLimit-Remaining") == "0" and headers.get("X-RateLimit-Reset"):
+        return max(int(headers.get("X-RateLimit-Reset")) - int(time.time()), 0) + 1
+    return None
+
+def open_state():
+    db = sqlite3.connect(state_file_name)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS issues (repo TEXT, issue INT, updated_at TEXT, comment_count INT, "
+               "content_hash TEXT, file_name TEXT, PRIMARY KEY (repo, issue))")
+    db.execute("CREATE TABLE IF NOT EXISTS etags (url TEXT PRIMARY KEY, etag TEXT, link TEXT, names TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, value TEXT)")
+    db.commit()
+    import_summary(db)
+    return db
+
+def import_summary(db):
+    # the issues of the summary file of older versions are taken as updated at the
+    # time of the run that wrote it
+    if get_last_update(db) is not None:
+        return
+    try:
+        summary_file = open(summary_file_name, 'r')
+        content = summary_file.read()
+        summary_file.close()
+    except FileNotFoundError:
+        return
+    if not content:
+        return
+    records, last_update = read_previous_content(content)
+    for record in records:
+        repo = record["Repository"]
+        issue_number = record["Issue number"]
+        db.execute("INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, NULL, ?)",
+                   (repo, issue_number, last_update, record["Comment count"], issue_file_name(repo, issue_number)))
+    db.execute("INSERT OR REPLACE INTO runs VALUES ('last_update', ?)", (last_update,))
+    db.commit()
+    os.replace(summary_file_name, f"{summary_file_name}.imported")
+    logger.info("imported %d issues from the previous summary file", len(records))
+
+def get_last_update(db):
+    row = db.execute("SELECT value FROM runs WHERE key = 'last_update'").fetchone()
+    return row[0] if row else None
+
+def get_issue_state(db, repo, issue_number):
+    return db.execute("SELECT updated_at, comment_count, content_hash FROM issues WHERE repo = ? AND issue = ?",
+                      (repo, issue_number)).fetchone()
+
+def save_issue_state(db, repo, json_issues, comment_count, content_hash):
+    issue_number = json_issues["number"]
+    db.execute("INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?, ?)",
+               (repo, issue_number, json_issues["updated_at"], comment_count, content_hash,
+                issue_file_name(repo, issue_number)))
+    db.commit()
+
+def load_etags(db):
+    global etags
+    etags = {}
+    for url, etag, link, names in db.execute("SELECT url, etag, link, names FROM etags"):
+        etags[url] = {"etag": etag, "link": link}
+        if names is not None:
+            etags[url]["names"] = json.loads(names)
+    logger.info("ETags of %d pages found and read", len(etags))
+
+def save_run(db, used_urls, last_update):
+    # only keep the ETags of the pages requested in this run
+    db.execute("DELETE FROM etags")
+    for url in sorted(used_urls):
+        if url in etags:
+            names = etags[url].get("names")
+            db.execute("INSERT OR REPLACE INTO etags VALUES (?, ?, ?, ?)",
+                       (url, etags[url]["etag"], etags[url]["link"], json.dumps(names) if names is not None else None))
+    db.execute("INSERT OR REPLACE INTO runs VALUES ('last_update', ?)", (last_update,))
+    db.commit()
 
 def extract_next_link(header):
     links = header.split(',')
@@ -112,36 +313,50 @@ def extract_next_link(header):
             break
     return link
 
-def get_repositories(): 
-    json_data, header = make_github_request(f"{base_url}/orgs/{project_owner}/repos{query_params}", "get_repositories()")
-    list_repos = [item['name'] for item in json_data]
-    while header and "next" in header:
-        link = extract_next_link(header)
-        json_data, header = make_github_request(link, "get_repositories()")
-        list_repos.extend([item['name'] for item in json_data])
+def get_repositories(used_urls):
+    # the list pages are conditional requests, the repository names of a page that was
+    # not modified are taken from the state store
+    list_repos = []
+    link = f"{base_url}/orgs/{project_owner}/repos{query_params}"
+    while link:
+        json_data, header = make_github_request(link, "get_repositories()", conditional=True)
+        if json_data is None:
+            names = etags[link]["names"]
+        else:
+            names = [item['name'] for item in json_data]
+            if link in etags:
+                etags[link]["names"] = names
+        used_urls.append(link)
+        list_repos.extend(names)
+        link = extract_next_link(header) if header and 'rel="next"' in header else None
         if dev: break
     return list_repos
 
-def get_repo_issues(repo):
-    json_data, header  = make_github_request(f"{base_url}/repos/{project_owner}/{repo}/issues{query_params}", "get_repo_issues()")
-    list_issue_numbers = [item['number'] for item in json_data]
-    while header and "next" in header:
+def get_repo_issues(repo, last_update, used_urls):
+    # Returns the open issues of the repository updated since last_update (all of them
+    # in the first run), most recently updated first (issues not returned are unchanged).
+    # Returns None if the first page was not modified: then no issue of the repository
+    # has been updated since the previous run.
+    etag_url = f"{base_url}/repos/{project_owner}/{repo}/issues{query_params}&sort=updated&direction=desc"
+    link = f"{etag_url}&since={last_update}" if last_update else etag_url
+    used_urls.append(etag_url)
+    json_data, header = make_github_request(link, "get_repo_issues()", conditional=True, etag_url=etag_url)
+    if json_data is None:
+        return None
+    list_issues = json_data
+    while header and 'rel="next"' in header:
         link = extract_next_link(header)
         json_data, header = make_github_request(link, "get_repo_issues()")
-        list_issue_numbers.extend([item['number'] for item in json_data])
+        list_issues.extend(json_data)
         if dev: break
-    return list_issue_numbers
-
-def get_issue(repo, issue_number):
-    json_data, header  = make_github_request(f"{base_url}/repos/{project_owner}/{repo}/issues/{issue_number}", "get_issue()")
-    return json_data
+    return list_issues
 
 def get_comments(repo, issue_number):
     json_data, header  = make_github_request(f"{base_url}/repos/{project_owner}/{repo}/issues/{issue_number}/comments{query_params}", "get_comments()")
     while header and "next" in header:
         link = extract_next_link(header)
         more_json_data, header = make_github_request(link, "get_comments()")
-        json_data.append(more_json_data)
+        json_data.extend(more_json_data)
         if dev: break
     return json_data
 
@@ -185,15 +400,39 @@ def to_sentence_case(key):
         return words[0].capitalize()
     return words[0].capitalize() + ' ' + ' '.join(word.lower() for word in words[1:])
 
-def check_updated(records, repo, json_issues, last_update):
+def issue_file_name(repo, issue_number):
+    return "%s/%s-issue-%d.txt" % (out_dir, repo, int(issue_number))
+
+def scrape_issue(repo, json_issues, issue_attributes, comment_attributes, previous_hash):
+    # fetches the comments and writes the issue file (unless the text did not change),
+    # returns the comment count, the hash of the text and the change (None if not written)
     issue_number = json_issues["number"]
-    comment_count = json_issues["comments"]
-    updated_at = json_issues["updated_at"]
-    for record in records:
-        if record["Repository"] == repo and record["Issue number"] == issue_number:
-            if record["Comment count"] == comment_count and last_update > updated_at :
-                return True
-    return False
+    text = extract_and_format(issue_attributes, {}, json_issues)
+
+    json_comments = get_comments(repo, issue_number)
+    extracted_data = {}
+    comment_count = 0
+    for comment in json_comments:
+        comment_count += 1
+        extracted_data["comment"] = comment_count
+        text += extract_and_format(comment_attributes, extracted_data, comment)
+
+    content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    file_name = issue_file_name(repo, issue_number)
+    change = None
+    if content_hash != previous_hash or not os.path.exists(file_name):
+        change = "modified" if os.path.exists(file_name) else "added"
+        file = open(file_name, 'w')
+        file.write(text)
+        file.close()
+    return comment_count, content_hash, change
+
+def check_updated(state, json_issues):
+    # True if the issue did not change since it was scraped
+    if state is None:
+        return False
+    updated_at, comment_count, content_hash = state
+    return comment_count == json_issues["comments"] and json_issues["updated_at"] <= updated_at
     
 def read_previous_content(content):
     if not content:
@@ -218,64 +457,56 @@ def main():
     comment_attributes = load_config(config_ghissues_comments)
 
     updated_issues = 0
-    total_issues = 0
-    
-    try:
-        summary_file = open(summary_file_name, 'r')
-        previous_content = summary_file.read()
-        summary_file.close()
-        logger.info("previous summary file found and read")
-    except FileNotFoundError:
-        logger.info("previous summary file not found")
-        previous_content = ""
-    records, last_update = read_previous_content(previous_content)
-    temp_file_name = f"{log_dir}/01_temp_summary_file.txt"
-    temp_summary_file = open(temp_file_name, 'w')
-    temp_summary_file.write(f"Repository, Issue number, Comment count\n")
-
-    list_repos = get_repositories()
-
-    for repo in list_repos:
-        list_issue_numbers = get_repo_issues(repo)
-        
-        for issue_number in list_issue_numbers:
-            json_issues = get_issue(repo, issue_number)
-            updated = check_updated(records, repo, json_issues, last_update)
-            
-            comment_count = json_issues["comments"]
-            
-            if not records or not updated: 
-                text = extract_and_format(issue_attributes, {}, json_issues)
-
-                json_comments = get_comments(repo, issue_number)
-                comment_count = len(json_comments)
-                extracted_data = {}
-                comment_count = 0
-                for comment in json_comments:
-                    comment_count += 1
-                    extracted_data["comment"] = comment_count
-                    text += extract_and_format(comment_attributes, extracted_data, comment)
-                    
-                file_name = "%s/%s-issue-%d.txt" % (out_dir, repo, int(issue_number))
-                file = open(file_name, 'w')
-                file.write(text)
-                file.close()
-                updated_issues += 1
-            
-            total_issues += 1                
-            temp_summary_file.write(f"{repo}, {issue_number}, {comment_count}\n")
-            temp_summary_file.flush()
-            
+
+    db = open_state()
+    last_update = get_last_update(db)
+    # issues updated while we run must be fetched again in the next run
+    formatted_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    load_etags(db)
+    used_urls = []
+
+    list_repos = get_repositories(used_urls)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        repo_jobs = {executor.submit(get_repo_issues, repo, last_update, used_urls): repo for repo in list_repos}
+        issue_jobs = {}
+        for job in as_completed(repo_jobs):
+            repo = repo_jobs[job]
+            list_issues = job.result()
+            if list_issues is None:
+                list_issues = []
+
+            seen = set()
+            for json_issues in list_issues:
+                issue_number = json_issues["number"]
+                if issue_number in seen:
+                    # an issue updated while paging may show up twice
+                    continue
+                seen.add(issue_number)
+                state = get_issue_state(db, repo, issue_number)
+                if not check_updated(state, json_issues):
+                    previous_hash = state[2] if state else None
+                    issue_job = executor.submit(scrape_issue, repo, json_issues, issue_attributes, comment_attributes,
+                                                previous_hash)
+                    issue_jobs[issue_job] = (repo, json_issues)
+
+        for job in as_completed(issue_jobs):
+            repo, json_issues = issue_jobs[job]
+            comment_count, content_hash, change = job.result()
+            if change is not None:
+                append_changes([(change, issue_file_name(repo, json_issues["number"]))])
+            save_issue_state(db, repo, json_issues, comment_count, content_hash)
+            updated_issues += 1
+
     t1 = time.time()
-    temp_summary_file.write(f"Total number of issues: {total_issues}\n")
-    local_time = time.localtime()
-    formatted_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", local_time)
-    temp_summary_file.write(f"Updated on: {formatted_time}")
-    temp_summary_file.close()
-    
-    os.replace(temp_file_name, summary_file_name)
+    # the ETags are saved last: a 304 for an issue page is only valid if the issues
+    # of the previous response have been processed
+    save_run(db, used_urls, formatted_time)
+    total_issues = db.execute("SELECT COUNT(*) FROM issues").fetchone()[0]
+    db.close()
 
     print("%d issues (%d old, %d updated) scraped in %.3f seconds" %
           (total_issues, total_issues-updated_issues, updated_issues, t1 - t0))
+    print("%d requests, %d not modified" % (request_count + not_modified_count, not_modified_count))
 
-main()
\ No newline at end of file
+main()
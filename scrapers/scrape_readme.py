@@ -0,0 +1,216 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Scrape the Open Data Hub repository Readme files.
+#
+# Note:
+#   - the URLs are hand-picked and read from 'scrape_readme_urls.txt'
+#   - it will get the file from the first branch that exists
+#     in the sequence: main, master, development
+#   - the readme of each repository is saved as '../data_readme/X.md',
+#     where X is the repository
+#   - the state file '../log_readme/00_state_readme.json' remembers, for each
+#     repository, the branch that worked and the ETag/Last-Modified of the
+#     response; the next run only asks for that branch, with If-None-Match/
+#     If-Modified-Since, and only probes the other branches if it is gone
+#   - the branches of a repository without a known branch are probed concurrently
+#   - repositories are fetched concurrently, at most 'concurrency' at a time
+#   - only readme files whose content changed are rewritten, readme files of
+#     repositories no longer in the list or without readme on any branch are
+#     removed; the changes are appended to the change journal (see 'libjournal.py')
+# ------------------------------------------------------------------------------
+
+
+import requests
+import threading
+import json
+import time
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from libjournal import *
+
+
+# --- configuration ---
+
+urls_file_name = "scrape_readme_urls.txt"
+branches = ["main", "master", "development"]
+concurrency = 8
+out_dir = "../data_readme"
+state_file_name = "../log_readme/00_state_readme.json"
+
+
+# --- HTTP ---
+
+# one session (and so one pool of keep-alive connections) per worker thread
+thread_data = threading.local()
+
+
+def http_get(url, headers=None):
+    if not hasattr(thread_data, "session"):
+        thread_data.session = requests.Session()
+    return thread_data.session.get(url, headers=headers, timeout=60)
+
+
+# --- functions ---
+
+def load_urls():
+    try:
+        file = open(urls_file_name, "r")
+        urls = [line.strip() for line in file if line.strip()]
+        file.close()
+        return urls
+    except FileNotFoundError:
+        print("ERROR: scrape_readme: cannot read '%s'." % urls_file_name)
+        sys.exit(1)
+
+
+def repo_name(url):
+    return url.split("/")[4]
+
+
+def branch_url(url, branch):
+    return url.replace("/development/", "/%s/" % branch)
+
+
+def probe(url, branch, cached):
+    # returns (status, branch, response); cached is the state of the branch that
+    # worked last time, its validators make the request conditional
+    headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        response = http_get(branch_url(url, branch), headers)
+    except requests.RequestException as ex:
+        print("WARNING: probe(%s, %s): %s" % (repo_name(url), branch, ex))
+        return "error", branch, None
+    if response.status_code == 304 and cached is not None:
+        return "not modified", branch, response
+    if response.status_code == 200:
+        return "ok", branch, response
+    if response.status_code == 404:
+        return "missing", branch, response
+    print("WARNING: probe(%s, %s): got response %s." % (repo_name(url), branch, response.status_code))
+    return "error", branch, None
+
+
+def fetch_readme(url, cached, executor):
+    # returns (status, branch, response) for the first branch in the sequence that
+    # exists, status is "missing" if none does and "error" if we cannot tell
+    if cached is not None:
+        result = probe(url, cached["branch"], cached)
+        if result[0] != "missing":
+            return result
+    others = [branch for branch in branches if cached is None or branch != cached["branch"]]
+    results = list(executor.map(lambda branch: probe(url, branch, None), others))
+    for result in results:
+        if result[0] == "ok":
+            return result
+    for result in results:
+        if result[0] == "error":
+            return result
+    return "missing", None, None
+
+
+def write_if_changed(file_name, content):
+    # returns "added", "modified" or None if the file already has this content
+    try:
+        file = open(file_name, "rb")
+        old_content = file.read()
+        file.close()
+    except FileNotFoundError:
+        old_content = None
+    if old_content == content:
+        return None
+    temp_file_name = "%s.tmp" % file_name
+    file = open(temp_file_name, "wb")
+    file.write(content)
+    file.close()
+    os.replace(temp_file_name, file_name)
+    return "added" if old_content is None else "modified"
+
+
+def load_state():
+    try:
+        file = open(state_file_name, "r")
+        state = json.load(file)
+        file.close()
+        return state
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(state):
+    temp_file_name = "%s.tmp" % state_file_name
+    file = open(temp_file_name, "w")
+    json.dump(state, file, indent=1, sort_keys=True)
+    file.close()
+    os.replace(temp_file_name, state_file_name)
+
+
+# --- main program ---
+
+def main():
+    t0 = time.time()
+    urls = load_urls()
+    state = load_state()
+    new_state = {}
+    changes = []
+    counts = {"not modified": 0, "unchanged": 0, "changed": 0, "missing": 0, "error": 0}
+
+    # the branch probes of a repository run on their own pool, so that they never
+    # wait behind the repository jobs that started them
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+            ThreadPoolExecutor(max_workers=concurrency) as probe_executor:
+        jobs = {executor.submit(fetch_readme, url, state.get(repo_name(url)), probe_executor): url for url in urls}
+        for job in as_completed(jobs):
+            name = repo_name(jobs[job])
+            file_name = "%s/%s.md" % (out_dir, name)
+            status, branch, response = job.result()
+            if status == "not modified":
+                new_state[name] = state[name]
+            elif status == "ok":
+                new_state[name] = {"branch": branch, "etag": response.headers.get("ETag"),
+                                   "last_modified": response.headers.get("Last-Modified")}
+                change = write_if_changed(file_name, response.content)
+                if change is None:
+                    status = "unchanged"
+                else:
+                    status = "changed"
+                    changes.append((change, file_name))
+                    append_changes([(change, file_name)])
+            elif status == "missing":
+                print("WARNING: scrape_readme: failed to get readme for %s" % name)
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+                    changes.append(("deleted", file_name))
+                    append_changes([("deleted", file_name)])
+            elif name in state:
+                # keep the file and what we know for the next run
+                new_state[name] = state[name]
+            counts[status] += 1
+
+    names = set([repo_name(url) for url in urls])
+    for file_name in sorted(os.listdir(out_dir)):
+        if file_name.endswith(".md") and file_name[:-3] not in names:
+            os.remove("%s/%s" % (out_dir, file_name))
+            changes.append(("deleted", "%s/%s" % (out_dir, file_name)))
+            append_changes([("deleted", "%s/%s" % (out_dir, file_name))])
+
+    save_state(new_state)
+    t1 = time.time()
+
+    good = counts["not modified"] + counts["unchanged"] + counts["changed"]
+    print("%d / %d readme files scraped in %.3f seconds" % (good, len(urls), t1 - t0))
+    print("%d not modified (cache hits), %d unchanged, %d changed, %d missing, %d errors, %d files written or removed" %
+          (counts["not modified"], counts["unchanged"], counts["changed"], counts["missing"], counts["error"],
+           len(changes)))
+
+
+main()
@@ -7,22 +7,39 @@
 # from a Request Tracker ticketing system.
 #
 # Note:
-#   - location and credentials are read from 'scrape_rt.json',
-#   - works incrementally (skips previously downloaded transaction bodies),
+#   - location and credentials are read from 'secrets_rt.json',
+#   - works incrementally: the state file '../log_rt/00_state_rt.json' keeps the
+#     LastUpdated timestamp of each ticket, the last transaction ID scraped for
+#     each ticket and the highest LastUpdated seen (the high-water mark); a run
+#     only lists tickets updated since the high-water mark, only fetches the
+#     history of tickets whose LastUpdated changed, and only fetches bodies of
+#     transactions newer than the last one scraped (and not already on disk);
+#     a ticket with a body that could not be fetched keeps its old state (and
+#     holds back the high-water mark), so the next run fetches it again,
+#   - delete the state file to force a full run,
 #   - removes lines starting with '>' from the bodies,
 #   - considers only transactions of type 'Ticket created', 'Correspondence
 #     added' or 'Comments added'
 #   - bodies are stored in '../data_rt/ticket-X-Y.txt', where X is the
 #     ticket ID and Y is the transaction ID
+#   - requests run concurrently on keep-alive connections, at most 'concurrency'
+#     at a time and at most 'requests_per_sec' per host (both optional in
+#     'secrets_rt.json', defaults 8 and 10.0)
+#   - new bodies are appended to the change journal (see 'libjournal.py')
 # ------------------------------------------------------------------------------
 
 
-import urllib.request
+import requests
+import threading
+import urllib.parse
 import json
 import time
 import sys
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from libjournal import *
 
 
 # --- configuration ---
@@ -38,36 +55,95 @@ except FileNotFoundError:
 base_url = rt_parameters.get("base_url")
 auth_parameters = rt_parameters.get("auth_parameters")
 queue_name = rt_parameters.get("queue_name")
+concurrency = rt_parameters.get("concurrency", 8)
+requests_per_sec = rt_parameters.get("requests_per_sec", 10.0)
 out_dir = "../data_rt"
+state_file_name = "../log_rt/00_state_rt.json"
+
+
+# --- HTTP ---
+
+class RateLimiter:
+
+    # spaces out requests to the same host by at least 1 / requests_per_sec seconds
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# one session (and so one pool of keep-alive connections) per worker thread
+thread_data = threading.local()
+
+
+def http_get(url):
+    host = urllib.parse.urlsplit(url).netloc
+    with rate_limiters_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = RateLimiter(requests_per_sec)
+        limiter = rate_limiters[host]
+    limiter.wait()
+    if not hasattr(thread_data, "session"):
+        thread_data.session = requests.Session()
+    return thread_data.session.get(url, timeout=120)
 
 
 # --- functions ---
 
-def get_ticket_ids():
-    response = urllib.request.urlopen("%s/search/ticket?query=Queue='%s'&orderby=+Created&%s"
-                                      % (base_url, queue_name, auth_parameters))
-    if response.getcode() != 200:
-        print("WARNING: get_ticket_ids() got response %s." % response.getcode())
+def get_ticket_ids(since):
+    # return (ticket ID, LastUpdated) for all tickets in the queue updated at or after
+    # since ("YYYY-MM-DD HH:MM:SS" as shown by RT, None for all tickets)
+    query = "Queue='%s'" % queue_name
+    if since is not None:
+        query += " AND LastUpdated >= '%s'" % since
+    response = http_get("%s/search/ticket?query=%s&orderby=+Created&format=l&fields=LastUpdated&%s"
+                        % (base_url, urllib.parse.quote(query), auth_parameters))
+    if response.status_code != 200:
+        print("WARNING: get_ticket_ids() got response %s." % response.status_code)
         return []
-    data = response.read()
-    data_text = data.decode('utf-8').split("\n")
+    data_text = response.content.decode('utf-8').split("\n")
     ret = []
-    # we're interested in lines starting with a ticket ID followed by a colon
-    pattern = re.compile(r"^(\d+):")
+    # we're interested in the ticket ID and LastUpdated lines of each record
+    id_pattern = re.compile(r"^id:\s+ticket/(\d+)")
+    updated_pattern = re.compile(r"^LastUpdated:\s+(.+?)\s*$")
     for line in data_text:
-        match = pattern.match(line)
+        match = id_pattern.match(line)
         if match:
-            ret.append(match.group(1))
+            ret.append((match.group(1), None))
+            continue
+        match = updated_pattern.match(line)
+        if match and len(ret) > 0:
+            ret[-1] = (ret[-1][0], parse_rt_date(match.group(1)))
     return ret
 
 
+def parse_rt_date(text):
+    # RT shows dates like 'Thu Jun 06 11:15:12 2024', queries want '2024-06-06 11:15:12'
+    try:
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(text, "%a %b %d %H:%M:%S %Y"))
+    except ValueError:
+        return None
+
+
 def get_tx_for_ticket(ticket_id):
-    response = urllib.request.urlopen("%s/ticket/%d/history/?%s" % (base_url, int(ticket_id), auth_parameters))
-    if response.getcode() != 200:
-        print("WARNING: get_tx_for_ticket(%d): got response %s." % (int(ticket_id), response.getcode()))
-        return []
-    data = response.read()
-    text = data.decode('utf-8').split("\n")
+    # return the relevant transaction IDs, None if the history cannot be fetched
+    response = http_get("%s/ticket/%d/history/?%s" % (base_url, int(ticket_id), auth_parameters))
+    if response.status_code != 200:
+        print("WARNING: get_tx_for_ticket(%d): got response %s." % (int(ticket_id), response.status_code))
+        return None
+    text = response.content.decode('utf-8').split("\n")
     ret = []
     # we're interested in lines starting with a ticket ID followed by certain text patterns
     pattern = re.compile(r"^(\d+):\s+(Ticket created|Correspondence added|Comments added)")
@@ -78,14 +154,31 @@ def get_tx_for_ticket(ticket_id):
     return ret
 
 
+def load_state():
+    try:
+        file = open(state_file_name, "r")
+        state = json.load(file)
+        file.close()
+    except FileNotFoundError:
+        state = {"high_water_mark": None, "last_ticket_id": 0, "tickets": {}}
+    return state
+
+
+def save_state(state):
+    temp_file_name = state_file_name + ".tmp"
+    file = open(temp_file_name, "w")
+    json.dump(state, file, indent=1, sort_keys=True)
+    file.close()
+    os.replace(temp_file_name, state_file_name)
+
+
 def get_ticket(ticket_id, tx_id):
     url = "%s/ticket/%d/history/id/%d?%s" % (base_url, int(ticket_id), int(tx_id), auth_parameters)
-    response = urllib.request.urlopen(url)
-    if response.getcode() != 200:
-        print("WARNING: get_ticket(%d, %d) got response %s." % (int(ticket_id), int(tx_id), response.getcode()))
+    response = http_get(url)
+    if response.status_code != 200:
+        print("WARNING: get_ticket(%d, %d) got response %s." % (int(ticket_id), int(tx_id), response.status_code))
         return ""
-    data = response.read()
-    text = data.decode('utf-8').split("\n")
+    text = response.content.decode('utf-8').split("\n")
     ret = ["%s/ticket/%d/history/id/%d" % (base_url, int(ticket_id), int(tx_id))]
     # filter out lines starting with ">"
     pattern = re.compile(r"^\s*>")
@@ -103,23 +196,71 @@ def main():
     old_count = 0
     new_count = 0
     nil_count = 0
-    for ticket_id in get_ticket_ids():
-        for tx_id in get_tx_for_ticket(ticket_id):
-            file_name = "%s/ticket-%d-%d.txt" % (out_dir, int(ticket_id), int(tx_id))
-            if os.path.exists(file_name):
-                old_count += 1
+
+    state = load_state()
+    since = state["high_water_mark"]
+
+    tickets = get_ticket_ids(since)
+    # the query uses '>=' so updates within the same second as the high-water mark
+    # are not lost, skip the tickets we have already seen in that state
+    changed = [(ticket_id, updated) for (ticket_id, updated) in tickets
+               if updated is None or state["tickets"].get(ticket_id, {}).get("last_updated") != updated]
+    new_tickets = len([1 for (ticket_id, updated) in changed if int(ticket_id) > state["last_ticket_id"]])
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # fetch all histories concurrently, as each one completes queue the missing bodies;
+        # files and state are written by this thread only
+        history_jobs = {}
+        for (ticket_id, updated) in changed:
+            history_jobs[executor.submit(get_tx_for_ticket, ticket_id)] = (ticket_id, updated)
+        body_jobs = {}
+        complete = {}
+        fetched = 0
+        for job in as_completed(history_jobs):
+            (ticket_id, updated) = history_jobs[job]
+            tx_ids = job.result()
+            if tx_ids is None:
                 continue
-            text = get_ticket(ticket_id, tx_id)
+            fetched += 1
+            ticket_state = state["tickets"].get(ticket_id, {"last_tx": 0})
+            for tx_id in tx_ids:
+                file_name = "%s/ticket-%d-%d.txt" % (out_dir, int(ticket_id), int(tx_id))
+                if int(tx_id) <= ticket_state["last_tx"] or os.path.exists(file_name):
+                    old_count += 1
+                    continue
+                body_jobs[executor.submit(get_ticket, ticket_id, tx_id)] = (ticket_id, file_name)
+            last_tx = max([int(tx_id) for tx_id in tx_ids] + [ticket_state["last_tx"]])
+            complete[ticket_id] = {"last_tx": last_tx, "last_updated": updated}
+        for job in as_completed(body_jobs):
+            (ticket_id, file_name) = body_jobs[job]
+            text = job.result()
             if text == "":
+                # the ticket is not done: its state must not advance past this transaction,
+                # the next run lists it again and fetches the bodies not on disk
+                complete.pop(ticket_id, None)
                 nil_count += 1
                 continue
             file = open(file_name, 'w')
             file.write(text)
             file.close()
+            append_changes([("added", file_name)])
             new_count += 1
 
+    # advance the state only for the tickets whose history and bodies could all be
+    # fetched, the high-water mark only if all tickets could
+    state["tickets"].update(complete)
+    for (ticket_id, updated) in tickets:
+        state["last_ticket_id"] = max(state["last_ticket_id"], int(ticket_id))
+    if len(complete) == len(changed):
+        marks = [updated for (ticket_id, updated) in tickets if updated is not None]
+        if len(marks) > 0:
+            state["high_water_mark"] = max(marks + [since or marks[0]])
+    save_state(state)
+
     t1 = time.time()
 
+    print("%d tickets updated since %s (%d new), %d histories fetched, %d tickets complete" %
+          (len(tickets), since or "the beginning", new_tickets, fetched, len(complete)))
     print("%d ticket bodies (%d old, %d new, %d nil) scraped in %.3f seconds" %
           (old_count + new_count + nil_count, old_count, new_count, nil_count, t1 - t0))
 
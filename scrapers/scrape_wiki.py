@@ -0,0 +1,169 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Scrape the Open Data Hub wiki.
+#
+# Note:
+#   - wiki is at https://github.com/noi-techpark/odh-docs/wiki
+#   - keeps a shallow clone of the wiki in '../cache_wiki/odh-docs.wiki'; each run
+#     fetches the latest commit and diffs it against the commit of the previous
+#     run (kept in '../log_wiki/00_state_wiki.json')
+#   - only the .md files (except _Footer.md and _Sidebar.md) that were added,
+#     changed or removed are written to or removed from '../data_wiki', all other
+#     files are left untouched
+#   - the changes are appended to the change journal (see 'libjournal.py')
+#   - on the first run (or if the clone or the state file is lost), the whole
+#     clone is compared with '../data_wiki'
+# ------------------------------------------------------------------------------
+
+
+import subprocess
+import json
+import time
+import sys
+import os
+
+from libjournal import *
+
+
+# --- configuration ---
+
+wiki_url = "https://github.com/noi-techpark/odh-docs.wiki.git"
+clone_dir = "../cache_wiki/odh-docs.wiki"
+out_dir = "../data_wiki"
+state_file_name = "../log_wiki/00_state_wiki.json"
+excluded_files = ["_Footer.md", "_Sidebar.md"]
+
+
+# --- functions ---
+
+def git(*args):
+    result = subprocess.run(["git", "-C", clone_dir] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print("ERROR: git %s: %s" % (args[0], result.stderr.decode("utf-8", "replace").strip()))
+        sys.exit(1)
+    return result.stdout.decode("utf-8")
+
+
+def is_wiki_page(path):
+    return "/" not in path and path.endswith(".md") and path not in excluded_files
+
+
+def update_clone():
+    # returns True if the clone was created from scratch
+    if os.path.isdir("%s/.git" % clone_dir):
+        git("fetch", "--depth", "1", "origin", "HEAD")
+        git("reset", "--hard", "--quiet", "FETCH_HEAD")
+        return False
+    os.makedirs(os.path.dirname(clone_dir), exist_ok=True)
+    result = subprocess.run(["git", "clone", "--depth", "1", "--quiet", wiki_url, clone_dir])
+    if result.returncode != 0:
+        print("ERROR: scrape_wiki: cannot git clone.")
+        sys.exit(1)
+    return True
+
+
+def commit_exists(commit):
+    result = subprocess.run(["git", "-C", clone_dir, "cat-file", "-e", "%s^{commit}" % commit],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+
+def changed_pages(previous_commit):
+    # wiki pages that differ between the previous commit and HEAD
+    output = git("diff", "--name-status", "--no-renames", "-z", previous_commit, "HEAD")
+    fields = output.split("\0")
+    pages = []
+    for i in range(0, len(fields) - 1, 2):
+        if is_wiki_page(fields[i + 1]):
+            pages.append(fields[i + 1])
+    return pages
+
+
+def all_pages():
+    # wiki pages in the clone and in the output directory
+    pages = set([name for name in os.listdir(clone_dir) if is_wiki_page(name)])
+    pages.update([name for name in os.listdir(out_dir) if is_wiki_page(name)])
+    return sorted(pages)
+
+
+def read_bytes(file_name):
+    try:
+        file = open(file_name, "rb")
+        content = file.read()
+        file.close()
+        return content
+    except FileNotFoundError:
+        return None
+
+
+def sync_page(page):
+    # makes '../data_wiki/page' equal to the page in the clone, returns the change or None
+    new_content = read_bytes("%s/%s" % (clone_dir, page))
+    old_content = read_bytes("%s/%s" % (out_dir, page))
+    if new_content == old_content:
+        return None
+    if new_content is None:
+        os.remove("%s/%s" % (out_dir, page))
+        return "deleted"
+    temp_file_name = "%s/.%s.tmp" % (out_dir, page)
+    file = open(temp_file_name, "wb")
+    file.write(new_content)
+    file.close()
+    os.replace(temp_file_name, "%s/%s" % (out_dir, page))
+    return "added" if old_content is None else "modified"
+
+
+def load_state():
+    try:
+        file = open(state_file_name, "r")
+        state = json.load(file)
+        file.close()
+        return state
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(state):
+    temp_file_name = "%s.tmp" % state_file_name
+    file = open(temp_file_name, "w")
+    json.dump(state, file)
+    file.close()
+    os.replace(temp_file_name, state_file_name)
+
+
+# --- main program ---
+
+def main():
+    t0 = time.time()
+    state = load_state()
+    fresh = update_clone()
+    commit = git("rev-parse", "HEAD").strip()
+    previous_commit = state.get("commit")
+
+    if fresh or previous_commit is None or not commit_exists(previous_commit):
+        pages = all_pages()
+    else:
+        pages = changed_pages(previous_commit)
+
+    # each change is journaled as soon as it is written and the state is saved last:
+    # if we are interrupted, the next run diffs against the same commit and does the rest
+    changes = {"added": 0, "modified": 0, "deleted": 0}
+    for page in pages:
+        change = sync_page(page)
+        if change is not None:
+            changes[change] += 1
+            append_changes([(change, "%s/%s" % (out_dir, page))])
+
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    save_state({"commit": commit, "time": now})
+    t1 = time.time()
+
+    num = len([name for name in os.listdir(out_dir) if is_wiki_page(name)])
+    print("%d wiki files (%d added, %d modified, %d deleted) at commit %s, synced in %.3f seconds" %
+          (num, changes["added"], changes["modified"], changes["deleted"], commit[:10], t1 - t0))
+
+
+main()
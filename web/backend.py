@@ -3,21 +3,63 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import sys
+import math
 import uuid
+import threading
+import itertools
+import collections
 from flask import Flask, jsonify, request, abort
 
 from libsql import *
+from libworkers import *
+from libadmission import *
+from libsched import *
 
 import os
 
 def main():
 
     sql_init()
+    sched_load(sql_get_queued())
 
     preshared_secret = os.environ.get('PRESHARED_SECRET')
 
     app = Flask("stuart", static_folder="static", static_url_path="/")
 
+    # in-memory version of each session, bumped after every change of the session
+    # in the DB; /poll compares it with the version the client already has and
+    # answers 304 without reading the DB if nothing changed (the backend runs in a
+    # single process, see 'gunicorn.conf.py'); the boot id invalidates the versions
+    # handed out before a restart; only the SESSION_VERSIONS_MAX (default 10000) most
+    # recently used sessions are kept, a dropped session has version 0 again, which
+    # only costs its client one refresh: the versions come from a single counter, so
+    # a later change never gets a version the client already has
+    boot_id = uuid.uuid4().hex[:8]
+    session_versions = collections.OrderedDict()
+    session_versions_max = int(os.environ.get("SESSION_VERSIONS_MAX", 10000))
+    versions_counter = itertools.count(1)
+    versions_lock = threading.Lock()
+
+    def get_version(unique_id):
+        with versions_lock:
+            if unique_id not in session_versions:
+                return 0
+            session_versions.move_to_end(unique_id)
+            return session_versions[unique_id]
+
+    def bump_version(unique_id):
+        with versions_lock:
+            session_versions[unique_id] = next(versions_counter)
+            session_versions.move_to_end(unique_id)
+            while len(session_versions) > session_versions_max:
+                session_versions.popitem(last=False)
+
+    def heartbeat_status():
+        status = worker_status()
+        if status["workers"] == 0:
+            return "down"
+        return "up" if status["ready"] else "unavailable"
+
     '''
     frontend: entry point, create a new session and redirect to it
     '''
@@ -40,15 +82,32 @@ def main():
 
     '''
     frontend: receive a new question, if the session is valid and
-    in the correct state, store the question in the DB and update state
+    in the correct state, store the question in the DB and update state;
+    if the queue is too long (503) or the client sends too many questions
+    (429), reject it and tell after how many seconds to retry
     '''
     @app.route("/add_question", methods=["POST"])
     def add_question():
         unique_id = str(request.form.get("uuid"))
         question = (str(request.form.get("question"))).strip()
-        if sql_add_question(unique_id, question):
+        retry_after = admission_check_queue()
+        status = 503
+        client = admission_client(request)
+        if retry_after == 0:
+            retry_after = admission_check_rate(client)
+            status = 429
+        if retry_after > 0:
+            response = jsonify({"msg": "Error: busy", "retry_after": int(retry_after_header(retry_after))})
+            response.status_code = status
+            response.headers["Retry-After"] = retry_after_header(retry_after)
+            return response
+        length = sql_add_question(unique_id, question)
+        if length > 0:
+            sched_enqueue(unique_id, client, length == 1)
+            bump_version(unique_id)
             return jsonify({"msg": "OK"})
         else:
+            admission_refund_rate(client)
             return jsonify({"msg": "Error: invalid session"})
 
     '''
@@ -76,34 +135,95 @@ def main():
             return jsonify(res)
 
     '''
-    frontend: check heartbeat from inference server
+    frontend: poll state, heartbeat and the conversation entries from
+    index "since" on; the ETag identifies what the client already has, if
+    it is sent back with If-None-Match and nothing changed, answer 304
+    '''
+    @app.route("/poll")
+    def poll():
+        unique_id = str(request.args.get("uuid"))
+        since = request.args.get("since", default=0, type=int)
+        status = heartbeat_status()
+        wait = admission_estimate(unique_id)
+        wait_sec = None if wait is None else int(math.ceil(wait / 10.0) * 10)
+        # read the version before the DB: a change in between only costs an extra refresh
+        version = get_version(unique_id)
+        # the ETag names what the client has after the response: session version and
+        # number of conversation entries (and the estimated wait, in steps of 10 s)
+        etag = '"%s.%d.%d.%s.%s"' % (boot_id, version, since, status, wait_sec)
+        if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+            response = app.response_class(status=304)
+        else:
+            res = sql_get_state_and_conversation(unique_id)
+            if res is None:
+                return jsonify({"msg": "Error: invalid session"})
+            conversation = res["conversation"]
+            source = res["source"]
+            if since > len(conversation):
+                # the conversation is shorter than what the client has, start over
+                since = 0
+            # one source for each answer, the answers are the odd entries
+            response = jsonify({"msg": "OK", "state": res["state"], "heartbeat": status, "wait_sec": wait_sec,
+                                "offset": since, "conversation": conversation[since:],
+                                "source": source[since // 2:]})
+            etag = '"%s.%d.%d.%s.%s"' % (boot_id, version, len(conversation), status, wait_sec)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    '''
+    frontend: check heartbeat from inference servers
     '''
     @app.route("/get_heartbeat")
     def get_heartbeat():
-        age = sql_get_heartbeat()
-        return jsonify({"age": age})
+        ret = worker_status()
+        return jsonify(ret)
 
     '''
-    inference server: if preshared secret matches, set heartbeat
+    inference server: if preshared secret matches, register the
+    heartbeat of the worker (id, jobs in flight, capacity, readiness)
     '''
-    @app.route("/heartbeat")
+    @app.route("/heartbeat", methods=["GET", "POST"])
     def heartbeat():
-        secret = str(request.args.get("secret"))
+        secret = str(request.values.get("secret"))
         if secret != preshared_secret:
             abort(403)
-        sql_heartbeat()
+        worker_id = request.values.get("worker_id", default=request.remote_addr)
+        in_flight = request.values.get("in_flight", default=0, type=int)
+        capacity = request.values.get("capacity", default=1, type=int)
+        ready = request.values.get("ready")
+        if ready is not None:
+            ready = (ready == "1")
+        worker_heartbeat(worker_id, in_flight, capacity, ready)
         return jsonify({"msg": "OK"})
 
     '''
-    inference server: if preshared secret matches and a session
-    has a pending question, claim it
+    inference server: if preshared secret matches, the worker has
+    a free slot and a session has a pending question, claim the one
+    chosen by the scheduler
     '''
     @app.route("/claim_job")
     def claim_job():
         secret = str(request.args.get("secret"))
         if secret != preshared_secret:
             abort(403)
-        ret = sql_claim_job()
+        worker_id = request.args.get("worker_id", default=request.remote_addr)
+        if not worker_reserve(worker_id):
+            return jsonify({})
+        ret = {}
+        while True:
+            unique_id = sched_next()
+            if unique_id is None:
+                break
+            ret = sql_claim_job(unique_id)
+            if "uuid" in ret:
+                break
+            sched_drop(unique_id)
+        if "uuid" in ret:
+            admission_claimed(ret["uuid"])
+            bump_version(ret["uuid"])
+        else:
+            worker_release(worker_id)
         return jsonify(ret)
 
     '''
@@ -120,6 +240,10 @@ def main():
         conversation = str(request.form.get("conversation"))
         source = str(request.form.get("source"))
         sql_finish_job(unique_id, conversation_llm, conversation, source)
+        admission_finished(unique_id)
+        sched_finished(unique_id)
+        bump_version(unique_id)
+        worker_release(request.form.get("worker_id", default=request.remote_addr))
         return jsonify({"msg": "OK"})
 
     '''
@@ -146,10 +270,28 @@ def main():
         ret = sql_get_state_latest_age()
         return jsonify(ret)
 
+    '''
+    watchdog: if preshared secret matches, return the queue length,
+    the measured service time, the time to drain the queue and the
+    metrics of each scheduler queue
+    '''
+    @app.route("/get_queue_status")
+    def get_queue_status():
+        secret = str(request.args.get("secret"))
+        if secret != preshared_secret:
+            abort(403)
+        ret = admission_status()
+        ret["queues"] = sched_status()
+        return jsonify(ret)
+
     if __name__ == '__main__':
+        # development server, in production run it with gunicorn (see 'gunicorn.conf.py')
         bind_ip = os.environ.get('BIND_IP')
         bind_port = os.environ.get('BIND_PORT')
         app.run(host=bind_ip, port=bind_port)
 
+    return app
+
 
-main()
+# WSGI entry point for gunicorn ('backend:app')
+app = main()
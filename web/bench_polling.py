@@ -0,0 +1,179 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# --------------------------------------------------------------------------------------------------
+# Benchmark the web backend under polling load.
+#
+# The backend runs in a temporary directory (with an empty database), once with the
+# Flask development server ('python backend.py') and once with gunicorn (see
+# 'gunicorn.conf.py'). Each time, 'num_sessions' browser sessions poll /poll with the
+# ETag of the last answer (as 'lib.js' does; /get_state and /get_heartbeat for versions
+# without /poll) and 'num_workers' inference workers poll /claim_job, ask a question and
+# finish the job, for 'duration_sec' seconds.
+#
+# Prints the throughput and the p50/p95/p99 latency of each endpoint.
+#
+# Usage:
+#
+#   python bench_polling.py [WEB_DIR]
+#
+# WEB_DIR defaults to the directory of this script (point it to another checkout to
+# compare with an older version; gunicorn is skipped if it has no 'gunicorn.conf.py').
+# --------------------------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+import requests
+from typing import Optional
+
+num_sessions = 64
+num_workers = 2
+duration_sec = 15
+port = 9101
+secret = "bench"
+
+web_dir = os.path.dirname(os.path.abspath(__file__))
+base_url = "http://127.0.0.1:%d" % port
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def start_server(mode: str, workdir: str) -> subprocess.Popen:
+    env = dict(os.environ, PRESHARED_SECRET=secret, BIND_IP="127.0.0.1", BIND_PORT=str(port))
+    if mode == "dev":
+        command = [sys.executable, "%s/backend.py" % web_dir]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "-c", "%s/gunicorn.conf.py" % web_dir,
+                   "--pythonpath", web_dir, "backend:app"]
+    server = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for i in range(0, 100):
+        try:
+            requests.get("%s/get_heartbeat" % base_url, timeout=1)
+            return server
+        except requests.RequestException:
+            time.sleep(0.1)
+    server.kill()
+    print("ERROR: start_server(): the %s server did not start." % mode)
+    sys.exit(1)
+
+
+class Recorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = 0
+        self.not_modified = 0
+
+    def get(self, session: requests.Session, endpoint: str, **kwargs) -> Optional[requests.Response]:
+        return self.request(session, "GET", endpoint, **kwargs)
+
+    def post(self, session: requests.Session, endpoint: str, **kwargs) -> Optional[requests.Response]:
+        return self.request(session, "POST", endpoint, **kwargs)
+
+    def request(self, session: requests.Session, method: str, endpoint: str, **kwargs) -> Optional[requests.Response]:
+        t0 = time.time()
+        try:
+            response = session.request(method, base_url + endpoint, timeout=30, allow_redirects=False, **kwargs)
+        except requests.RequestException:
+            response = None
+        t1 = time.time()
+        with self.lock:
+            if response is None or response.status_code >= 400:
+                self.errors += 1
+            elif response.status_code == 304:
+                self.not_modified += 1
+            self.latencies.setdefault(endpoint, []).append(t1 - t0)
+        return response
+
+
+def browser(recorder: Recorder, stop: threading.Event, use_poll: bool) -> None:
+    session = requests.Session()
+    response = recorder.get(session, "/")
+    if response is None:
+        return
+    unique_id = urllib.parse.parse_qs(urllib.parse.urlsplit(response.headers["Location"]).query)["uuid"][0]
+    etag = None
+    since = 0
+    while not stop.is_set():
+        if not use_poll:
+            recorder.get(session, "/get_state", params={"uuid": unique_id})
+            recorder.get(session, "/get_heartbeat")
+            continue
+        headers = {"If-None-Match": etag} if etag is not None else {}
+        response = recorder.get(session, "/poll", params={"uuid": unique_id, "since": since}, headers=headers)
+        if response is not None and response.status_code == 200:
+            etag = response.headers.get("ETag")
+            data = response.json()
+            since = data["offset"] + len(data["conversation"])
+
+
+def worker(recorder: Recorder, stop: threading.Event) -> None:
+    session = requests.Session()
+    response = recorder.get(session, "/")
+    if response is None:
+        return
+    unique_id = urllib.parse.parse_qs(urllib.parse.urlsplit(response.headers["Location"]).query)["uuid"][0]
+    while not stop.is_set():
+        recorder.post(session, "/add_question", data={"uuid": unique_id, "question": "How are you?"})
+        response = recorder.get(session, "/claim_job", params={"secret": secret})
+        if response is not None and response.status_code == 200 and response.json().get("uuid"):
+            recorder.post(session, "/finish_job", data={"secret": secret, "uuid": unique_id,
+                                                        "conversation_llm": "[]", "conversation": "[]",
+                                                        "source": ""})
+
+
+def run(mode: str) -> None:
+    workdir = tempfile.mkdtemp()
+    os.makedirs("%s/db" % workdir)
+    server = start_server(mode, workdir)
+    try:
+        recorder = Recorder()
+        stop = threading.Event()
+        use_poll = requests.get("%s/poll" % base_url).status_code != 404
+        threads = [threading.Thread(target=browser, args=(recorder, stop, use_poll)) for i in range(0, num_sessions)]
+        threads += [threading.Thread(target=worker, args=(recorder, stop)) for i in range(0, num_workers)]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration_sec)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - t0
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir)
+
+    total = sum([len(values) for values in recorder.latencies.values()])
+    print("%s: %d requests in %.1f seconds, %.0f requests/s, %d errors, %d not modified" %
+          (mode, total, elapsed, total / elapsed, recorder.errors, recorder.not_modified))
+    print("  %-16s %8s %10s %10s %10s" % ("endpoint", "count", "p50 ms", "p95 ms", "p99 ms"))
+    for endpoint in sorted(recorder.latencies):
+        values = recorder.latencies[endpoint]
+        print("  %-16s %8d %10.1f %10.1f %10.1f" % (endpoint, len(values), 1000 * percentile(values, 50),
+                                                   1000 * percentile(values, 95), 1000 * percentile(values, 99)))
+
+
+def main() -> None:
+    global web_dir
+    if len(sys.argv) > 1:
+        web_dir = os.path.abspath(sys.argv[1])
+    print("%d polling sessions, %d workers, %d seconds per server" % (num_sessions, num_workers, duration_sec))
+    run("dev")
+    if os.path.exists("%s/gunicorn.conf.py" % web_dir):
+        run("gunicorn")
+
+
+main()
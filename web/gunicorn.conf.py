@@ -0,0 +1,27 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# gunicorn settings for the web backend:
+#
+#   gunicorn -c gunicorn.conf.py backend:app
+#
+# Requests are short (a few SQLite statements each) and mostly polls, so a single
+# worker process serves them from a pool of threads ("gthread"): the threads share
+# the process and each keeps its own SQLite connection (see 'libsql.py'). Keep one
+# process, as the database is written by one process at a time anyway. Raise
+# WEB_THREADS if many browser tabs poll at the same time.
+# ------------------------------------------------------------------------------
+
+import os
+
+bind = "%s:%s" % (os.environ.get("BIND_IP", "127.0.0.1"), os.environ.get("BIND_PORT", "9001"))
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "32"))
+# polling browsers and workers reuse their connections
+keepalive = 30
+timeout = 60
+accesslog = None
+errorlog = "-"
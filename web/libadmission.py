@@ -0,0 +1,146 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Admission control for new questions.
+#
+# The time each job was claimed is kept in memory. The service time of a job
+# (claim to finish) is averaged with an EWMA; with the length of the queue (see
+# 'libsched.py') and the capacity of the ready workers (see 'libworkers.py') this
+# gives:
+#
+#   - the time to drain the queue: a new question is rejected (with a Retry-After
+#     hint) if that is above "max_wait_sec" or the queue already has "max_queue"
+#     questions
+#   - the estimated wait of each queued question, shown by the frontend
+#
+# Each client (IP address, or the last entry of the CLIENT_IP_HEADER header if the
+# backend runs behind a reverse proxy) also has a token bucket: "rate_per_min"
+# questions per minute, in bursts of up to "rate_burst".
+#
+# The settings can be overridden with the environment variables ADMISSION_MAX_WAIT_SEC,
+# ADMISSION_MAX_QUEUE, ADMISSION_RATE_PER_MIN and ADMISSION_RATE_BURST.
+# ------------------------------------------------------------------------------
+
+import os
+import math
+import time
+import threading
+from typing import Optional, Dict
+
+from libworkers import *
+from libsched import *
+
+admission_settings = {
+    "max_wait_sec": float(os.environ.get("ADMISSION_MAX_WAIT_SEC", 300)),
+    "max_queue": int(os.environ.get("ADMISSION_MAX_QUEUE", 50)),
+    "rate_per_min": float(os.environ.get("ADMISSION_RATE_PER_MIN", 6)),
+    "rate_burst": float(os.environ.get("ADMISSION_RATE_BURST", 3)),
+    # service time assumed before the first job is measured
+    "service_sec_default": 30.0,
+    "service_ewma_alpha": 0.2
+}
+
+claimed = {}      # uuid -> time the job was claimed
+service = {"ewma_sec": admission_settings["service_sec_default"], "jobs": 0}
+clients = {}      # client -> {"tokens": float, "time": float}
+admission_lock = threading.Lock()
+
+
+def admission_client(request) -> str:
+    header = os.environ.get("CLIENT_IP_HEADER")
+    if header and request.headers.get(header):
+        return request.headers.get(header).split(",")[-1].strip()
+    return str(request.remote_addr)
+
+
+def admission_check_rate(client: str) -> float:
+    # takes a token of the client, returns 0 or the seconds until it has one
+    now = time.time()
+    rate = admission_settings["rate_per_min"] / 60.0
+    burst = admission_settings["rate_burst"]
+    with admission_lock:
+        if len(clients) > 10000:
+            # forget the clients whose bucket is full again
+            for key in [key for key, bucket in clients.items() if bucket["time"] + burst / rate < now]:
+                del clients[key]
+        bucket = clients.setdefault(client, {"tokens": burst, "time": now})
+        bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["time"]) * rate)
+        bucket["time"] = now
+        if bucket["tokens"] >= 1.0:
+            bucket["tokens"] -= 1.0
+            return 0.0
+        return (1.0 - bucket["tokens"]) / rate
+
+
+def admission_refund_rate(client: str) -> None:
+    # gives back the token of a question that was not queued (invalid session, or one
+    # that is not waiting for a question)
+    burst = admission_settings["rate_burst"]
+    with admission_lock:
+        if client in clients:
+            clients[client]["tokens"] = min(burst, clients[client]["tokens"] + 1.0)
+
+
+def drain_time(depth: int, capacity: int, in_flight: int) -> float:
+    # seconds until the workers have answered everything queued or in flight
+    # (call with admission_lock held)
+    return (depth + in_flight) * service["ewma_sec"] / max(capacity, 1)
+
+
+def admission_check_queue() -> float:
+    # returns 0 if a new question is admitted, otherwise the seconds after which to retry
+    status = worker_status()
+    depth = sched_depth()
+    with admission_lock:
+        per_job = service["ewma_sec"] / max(status["capacity"], 1)
+        drain = drain_time(depth, status["capacity"], status["in_flight"])
+        retry_after = 0.0
+        if drain > admission_settings["max_wait_sec"]:
+            retry_after = drain - admission_settings["max_wait_sec"]
+        if depth >= admission_settings["max_queue"]:
+            retry_after = max(retry_after, (depth - admission_settings["max_queue"] + 1) * per_job)
+    return retry_after
+
+
+def admission_claimed(unique_id: str):
+    with admission_lock:
+        claimed[unique_id] = time.time()
+
+
+def admission_finished(unique_id: str):
+    with admission_lock:
+        t0 = claimed.pop(unique_id, None)
+        if t0 is not None:
+            alpha = admission_settings["service_ewma_alpha"]
+            service["ewma_sec"] = (1 - alpha) * service["ewma_sec"] + alpha * (time.time() - t0)
+            service["jobs"] += 1
+
+
+def admission_estimate(unique_id: str) -> Optional[float]:
+    # estimated seconds until the answer to a queued question, None if it is not queued
+    status = worker_status()
+    # questions the scheduler would give to a worker before this one
+    ahead = sched_position(unique_id)
+    if ahead is None:
+        return None
+    with admission_lock:
+        return (ahead + status["in_flight"]) * service["ewma_sec"] / max(status["capacity"], 1) + service["ewma_sec"]
+
+
+def admission_status() -> Dict:
+    status = worker_status()
+    depth = sched_depth()
+    with admission_lock:
+        ret = {
+            "queued": depth,
+            "service_sec": service["ewma_sec"],
+            "jobs_measured": service["jobs"],
+            "drain_sec": drain_time(depth, status["capacity"], status["in_flight"])
+        }
+    return ret
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, int(math.ceil(seconds))))
@@ -0,0 +1,176 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# Scheduler for the questions waiting for a worker.
+#
+# The queued questions are kept in memory (loaded from the DB at startup), in
+# four queues: priority class ("internal" for clients in INTERNAL_NETWORKS, a
+# comma-separated list of networks such as "10.0.0.0/8,192.168.1.0/24", otherwise
+# "external") times kind ("first" question of a session or "follow-up").
+#
+# When a worker claims a job, it gets the question with the highest score:
+#
+#   score = weight of its queue * (1 + seconds waiting / "aging_sec")
+#           / (1 + jobs of the same client being processed)
+#
+# so follow-ups and internal users go first, a client with many sessions does not
+# crowd out the others and the score of a waiting question keeps growing (aging).
+# A question waiting more than "max_wait_sec" goes before all others (oldest first),
+# so that nothing starves.
+#
+# For each queue, the scheduler keeps the number of questions queued and claimed
+# and the percentiles of the time they waited and of the time until the answer.
+# ------------------------------------------------------------------------------
+
+import os
+import time
+import ipaddress
+import threading
+import collections
+from typing import Optional, Dict, List
+
+sched_settings = {
+    "weights": {("internal", "follow-up"): 8.0, ("internal", "first"): 4.0,
+                ("external", "follow-up"): 2.0, ("external", "first"): 1.0},
+    "aging_sec": 30.0,
+    "max_wait_sec": 600.0,
+    # claimed questions never finished (e.g. the worker died) are forgotten after this
+    "running_expiry_sec": 3600.0,
+    # number of latencies kept per queue for the percentiles
+    "metrics_window": 500
+}
+
+internal_networks = [ipaddress.ip_network(network.strip(), strict=False)
+                     for network in os.environ.get("INTERNAL_NETWORKS", "").split(",") if network.strip()]
+
+jobs = {}         # uuid -> queued question: {"queue", "client", "time"}
+running = {}      # uuid -> claimed question: {"queue", "client", "time", "claimed"}
+metrics = {queue: {"queued": 0, "claimed": 0, "finished": 0,
+                   "wait": collections.deque(maxlen=sched_settings["metrics_window"]),
+                   "latency": collections.deque(maxlen=sched_settings["metrics_window"])}
+           for queue in sched_settings["weights"]}
+sched_lock = threading.Lock()
+
+
+def sched_class(client: str) -> str:
+    try:
+        address = ipaddress.ip_address(client)
+    except ValueError:
+        return "external"
+    for network in internal_networks:
+        if address in network:
+            return "internal"
+    return "external"
+
+
+def sched_load(queued: List[tuple]):
+    # queued is the list of (uuid, modified, number of conversation entries) of the
+    # questions in the DB queue; the client is not known anymore
+    with sched_lock:
+        for unique_id, modified, length in queued:
+            queue = ("external", "first" if length <= 1 else "follow-up")
+            jobs[unique_id] = {"queue": queue, "client": None, "time": float(modified)}
+
+
+def sched_enqueue(unique_id: str, client: str, first: bool):
+    queue = (sched_class(client), "first" if first else "follow-up")
+    with sched_lock:
+        jobs[unique_id] = {"queue": queue, "client": client, "time": time.time()}
+        metrics[queue]["queued"] += 1
+
+
+def score(job: Dict, now: float, busy: Dict) -> tuple:
+    # sort key of a queued question, higher is claimed first (call with sched_lock held)
+    waiting = now - job["time"]
+    if waiting >= sched_settings["max_wait_sec"]:
+        return 1, waiting
+    value = sched_settings["weights"][job["queue"]] * (1 + waiting / sched_settings["aging_sec"])
+    return 0, value / (1 + busy.get(job["client"], 0))
+
+
+def busy_clients() -> Dict:
+    # client -> number of its questions being processed (call with sched_lock held)
+    busy = {}
+    for job in running.values():
+        if job["client"] is not None:
+            busy[job["client"]] = busy.get(job["client"], 0) + 1
+    return busy
+
+
+def sched_next() -> Optional[str]:
+    # takes the question with the highest score from the queues, None if there is none
+    now = time.time()
+    with sched_lock:
+        for unique_id in [unique_id for unique_id, job in running.items()
+                          if now - job["claimed"] >= sched_settings["running_expiry_sec"]]:
+            del running[unique_id]
+        if len(jobs) == 0:
+            return None
+        busy = busy_clients()
+        unique_id = max(jobs, key=lambda unique_id: score(jobs[unique_id], now, busy))
+        job = jobs.pop(unique_id)
+        job["claimed"] = now
+        running[unique_id] = job
+        metrics[job["queue"]]["claimed"] += 1
+        metrics[job["queue"]]["wait"].append(now - job["time"])
+    return unique_id
+
+
+def sched_drop(unique_id: str):
+    # the question is not queued anymore (e.g. it was claimed by an older worker)
+    with sched_lock:
+        jobs.pop(unique_id, None)
+        running.pop(unique_id, None)
+
+
+def sched_finished(unique_id: str):
+    with sched_lock:
+        job = running.pop(unique_id, None)
+        if job is not None:
+            metrics[job["queue"]]["finished"] += 1
+            metrics[job["queue"]]["latency"].append(time.time() - job["time"])
+
+
+def sched_depth() -> int:
+    with sched_lock:
+        return len(jobs)
+
+
+def sched_position(unique_id: str) -> Optional[int]:
+    # number of questions that would be claimed before this one, None if it is not queued
+    now = time.time()
+    with sched_lock:
+        if unique_id not in jobs:
+            return None
+        busy = busy_clients()
+        own = score(jobs[unique_id], now, busy)
+        return len([job for other, job in jobs.items() if other != unique_id and score(job, now, busy) > own])
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def sched_status() -> Dict:
+    now = time.time()
+    ret = {}
+    with sched_lock:
+        for queue, queue_metrics in metrics.items():
+            waiting = [now - job["time"] for job in jobs.values() if job["queue"] == queue]
+            ret["%s/%s" % queue] = {
+                "depth": len(waiting),
+                "oldest_sec": max(waiting, default=0.0),
+                "queued": queue_metrics["queued"],
+                "claimed": queue_metrics["claimed"],
+                "finished": queue_metrics["finished"],
+                "wait_p50_sec": percentile(list(queue_metrics["wait"]), 50),
+                "wait_p95_sec": percentile(list(queue_metrics["wait"]), 95),
+                "latency_p50_sec": percentile(list(queue_metrics["latency"]), 50),
+                "latency_p95_sec": percentile(list(queue_metrics["latency"]), 95)
+            }
+    return ret
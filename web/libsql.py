@@ -4,16 +4,39 @@
 
 import sqlite3
 import json
+import threading
 from typing import Optional, Dict
 
 sql_settings = {
-    "db_path": "./db/stuart.db"
+    "db_path": "./db/stuart.db",
+    # seconds a write waits for another thread's write to finish
+    "busy_timeout": 10
 }
 
+# one connection per thread, kept open for the lifetime of the thread: the
+# backend serves requests from a pool of threads (see 'gunicorn.conf.py'); so
+# the writes run in "with conn:", which commits, or rolls back on an exception
+# instead of leaving the transaction (and the write lock) open for the next
+# request of the thread
+thread_data = threading.local()
+
+
+def sql_connect() -> sqlite3.Connection:
+    conn = getattr(thread_data, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(sql_settings.get("db_path"), timeout=sql_settings.get("busy_timeout"))
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        thread_data.conn = conn
+    return conn
+
 
 def sql_init():
     conn = sqlite3.connect(sql_settings.get("db_path"))
     curs = conn.cursor()
+    # write-ahead log: readers don't block the writer and the writer doesn't block readers
+    curs.execute('''
+        PRAGMA journal_mode = WAL;
+    ''')
     curs.execute('''
         CREATE TABLE IF NOT EXISTS session (
           uuid TEXT,
@@ -26,58 +49,58 @@ def sql_init():
           CHECK(state IN ('wait-for-question', 'question-queued', 'processing-question'))
         );
     ''')
+    # the heartbeats of the inference servers are kept in memory now (see 'libworkers.py')
     curs.execute('''
-        CREATE TABLE IF NOT EXISTS heartbeat (
-          modified INT
-        );
+        DROP TABLE IF EXISTS heartbeat;
     ''')
-    curs.execute('''
-           INSERT INTO heartbeat (modified) VALUES (STRFTIME('%s', 'now'));
-       ''')
 
     conn.commit()
     conn.close()
 
 
 def sql_add_session(unique_id: str):
-    conn = sqlite3.connect(sql_settings.get("db_path"))
-    curs = conn.cursor()
-    curs.execute('''
-        INSERT INTO session (uuid, conversation_llm, conversation, source, state, created, modified)
-          VALUES (?, '[]', '[]', '[]', 'wait-for-question', STRFTIME('%s', 'now'), STRFTIME('%s', 'now'));
-    ''', [unique_id])
-    conn.commit()
-    conn.close()
+    conn = sql_connect()
+    with conn:
+        curs = conn.cursor()
+        curs.execute('''
+            INSERT INTO session (uuid, conversation_llm, conversation, source, state, created, modified)
+              VALUES (?, '[]', '[]', '[]', 'wait-for-question', STRFTIME('%s', 'now'), STRFTIME('%s', 'now'));
+        ''', [unique_id])
 
 
-def sql_add_question(unique_id: str, question: str) -> bool:
-    success = False
-    conn = sqlite3.connect(sql_settings.get("db_path"))
-    curs = conn.cursor()
-    curs.execute('''
-        SELECT conversation
-          FROM session
-          WHERE uuid = ? and state = 'wait-for-question';
-    ''', [unique_id])
-    res = curs.fetchone()
-    if res is not None:
-        conversation = json.loads(res[0])
-        conversation.append(question)
+def sql_add_question(unique_id: str, question: str) -> int:
+    # returns the number of entries of the conversation with the question, 0 if the
+    # session is not valid or not waiting for a question
+    length = 0
+    conn = sql_connect()
+    with conn:
+        curs = conn.cursor()
+        # take the write lock before reading, so that no other thread changes the session in between
         curs.execute('''
-            UPDATE session
-              SET conversation = ?,
-                  state = 'question-queued',
-                  modified = STRFTIME('%s', 'now')
-              WHERE uuid = ?;
-        ''', [json.dumps(conversation), unique_id])
-        success = True
-    conn.commit()
-    conn.close()
-    return success
+            BEGIN IMMEDIATE;
+        ''')
+        curs.execute('''
+            SELECT conversation
+              FROM session
+              WHERE uuid = ? and state = 'wait-for-question';
+        ''', [unique_id])
+        res = curs.fetchone()
+        if res is not None:
+            conversation = json.loads(res[0])
+            conversation.append(question)
+            curs.execute('''
+                UPDATE session
+                  SET conversation = ?,
+                      state = 'question-queued',
+                      modified = STRFTIME('%s', 'now')
+                  WHERE uuid = ?;
+            ''', [json.dumps(conversation), unique_id])
+            length = len(conversation)
+    return length
 
 
 def sql_get_state(unique_id: str) -> Optional[str]:
-    conn = sqlite3.connect(sql_settings.get("db_path"))
+    conn = sql_connect()
     curs = conn.cursor()
     curs.execute('''
         SELECT state FROM session WHERE uuid = ?;
@@ -87,12 +110,11 @@ def sql_get_state(unique_id: str) -> Optional[str]:
     if res is not None:
         ret = str(res[0])
     conn.commit()
-    conn.close()
     return ret
 
 
 def sql_get_state_and_conversation(unique_id: str) -> Optional[Dict]:
-    conn = sqlite3.connect(sql_settings.get("db_path"))
+    conn = sql_connect()
     curs = conn.cursor()
     curs.execute('''
         SELECT state, conversation, source FROM session WHERE uuid = ?;
@@ -102,40 +124,56 @@ def sql_get_state_and_conversation(unique_id: str) -> Optional[Dict]:
     if res is not None:
         ret = {"msg": "OK", "state": str(res[0]), "conversation": json.loads(str(res[1])), "source": json.loads(str(res[2]))}
     conn.commit()
-    conn.close()
     return ret
 
 
-def sql_claim_job() -> Dict:
-    conn = sqlite3.connect(sql_settings.get("db_path"))
+def sql_claim_job(unique_id: str) -> Dict:
+    # the job is chosen by the scheduler (see 'libsched.py'), returns {} if the
+    # session has no queued question (anymore)
+    conn = sql_connect()
+    with conn:
+        curs = conn.cursor()
+        # take the write lock before reading, so that a job cannot be claimed twice
+        curs.execute('''
+            BEGIN IMMEDIATE;
+        ''')
+        curs.execute('''
+            SELECT uuid, conversation_llm, conversation, source FROM session
+                WHERE uuid = ? AND state = 'question-queued';
+        ''', [unique_id])
+        res = curs.fetchone()
+        if res is not None:
+            unique_id = res[0]
+            conversation_llm = res[1]
+            conversation = res[2]
+            source = res[3]
+            ret = {"uuid": unique_id, "conversation_llm": conversation_llm, "conversation": conversation, "source": source}
+            curs.execute('''
+                UPDATE session
+                  SET state = 'processing-question',
+                      modified = STRFTIME('%s', 'now')
+                  WHERE uuid = ?;
+            ''', [unique_id])
+        else:
+            ret = {}
+    return ret
+
+
+def sql_get_queued() -> list:
+    # (uuid, modified, number of conversation entries) of the queued questions
+    conn = sql_connect()
     curs = conn.cursor()
     curs.execute('''
-        SELECT uuid, conversation_llm, conversation, source FROM session
-            WHERE state = 'question-queued'
-            ORDER BY modified DESC LIMIT 1;
+        SELECT uuid, modified, json_array_length(conversation) FROM session
+            WHERE state = 'question-queued';
     ''')
-    res = curs.fetchone()
-    if res is not None:
-        unique_id = res[0]
-        conversation_llm = res[1]
-        conversation = res[2]
-        source = res[3]
-        ret = {"uuid": unique_id, "conversation_llm": conversation_llm, "conversation": conversation, "source": source}
-        curs.execute('''
-            UPDATE session
-              SET state = 'processing-question',
-                  modified = STRFTIME('%s', 'now')
-              WHERE uuid = ?;
-        ''', [unique_id])
-    else:
-        ret = {}
+    ret = curs.fetchall()
     conn.commit()
-    conn.close()
     return ret
 
 
 def sql_get_state_count() -> Dict:
-    conn = sqlite3.connect(sql_settings.get("db_path"))
+    conn = sql_connect()
     curs = conn.cursor()
     curs.execute('''
         SELECT state, count(*) as cnt FROM session
@@ -148,12 +186,11 @@ def sql_get_state_count() -> Dict:
             break
         ret[res[0]] = res[1]
     conn.commit()
-    conn.close()
     return ret
 
 
 def sql_get_state_latest_age() -> Dict:
-    conn = sqlite3.connect(sql_settings.get("db_path"))
+    conn = sql_connect()
     curs = conn.cursor()
     curs.execute('''
          select state, STRFTIME('%s', 'now') - max(modified) as age from session
@@ -166,49 +203,20 @@ def sql_get_state_latest_age() -> Dict:
             break
         ret[res[0]] = res[1]
     conn.commit()
-    conn.close()
     return ret
 
 
 def sql_finish_job(unique_id: str, conversation_llm: str, conversation: str, source: str):
-    conn = sqlite3.connect(sql_settings.get("db_path"))
-    curs = conn.cursor()
-    curs.execute('''
-        UPDATE session
-          SET state = 'wait-for-question',
-              modified = STRFTIME('%s', 'now'),
-              conversation_llm = ?,
-              conversation = ?,
-              source = ?
-          WHERE uuid = ?;
-    ''', [conversation_llm, conversation, source, unique_id])
-    conn.commit()
-    conn.close()
+    conn = sql_connect()
+    with conn:
+        curs = conn.cursor()
+        curs.execute('''
+            UPDATE session
+              SET state = 'wait-for-question',
+                  modified = STRFTIME('%s', 'now'),
+                  conversation_llm = ?,
+                  conversation = ?,
+                  source = ?
+              WHERE uuid = ?;
+        ''', [conversation_llm, conversation, source, unique_id])
     print("success finished job for uuid = %s" % unique_id)
-
-
-def sql_heartbeat():
-    conn = sqlite3.connect(sql_settings.get("db_path"))
-    curs = conn.cursor()
-    curs.execute('''
-        UPDATE heartbeat set modified = STRFTIME('%s', 'now');
-    ''')
-    conn.commit()
-    conn.close()
-    return
-
-
-def sql_get_heartbeat():
-    conn = sqlite3.connect(sql_settings.get("db_path"))
-    curs = conn.cursor()
-    curs.execute('''
-        SELECT STRFTIME('%s', 'now') - modified FROM heartbeat;
-    ''')
-    res = curs.fetchone()
-    if res is None:
-        age = 1e9
-    else:
-        age = res[0]
-    conn.commit()
-    conn.close()
-    return age
@@ -0,0 +1,78 @@
+# SPDX-FileCopyrightText: 2024 NOI Techpark <digital@noi.bz.it>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# ------------------------------------------------------------------------------
+# In-memory registry of the inference workers ('rag/backend_query.py').
+#
+# Each worker sends a heartbeat every few seconds with its id, the number of jobs
+# it is running, how many it can run at the same time and whether its model is
+# ready. Nothing of this is written to the DB: the backend runs in a single
+# process (see 'gunicorn.conf.py') and the registry is rebuilt from the next
+# heartbeats after a restart.
+#
+# Jobs are only handed to a worker that is ready and has a free slot; workers
+# that never sent a heartbeat (older versions) are not limited.
+# ------------------------------------------------------------------------------
+
+import time
+import threading
+from typing import Optional, Dict
+
+worker_settings = {
+    # seconds without heartbeat after which a worker counts as down
+    "worker_timeout": 10,
+    # seconds without heartbeat after which a worker is forgotten
+    "worker_expiry": 300
+}
+
+workers = {}
+workers_lock = threading.Lock()
+
+
+def worker_heartbeat(worker_id: str, in_flight: int, capacity: int, ready: Optional[bool]):
+    # ready is None for heartbeats that don't report readiness
+    with workers_lock:
+        worker = workers.setdefault(worker_id, {"ready": False})
+        worker["time"] = time.time()
+        worker["in_flight"] = in_flight
+        worker["capacity"] = capacity
+        if ready is not None:
+            worker["ready"] = ready
+
+
+def worker_reserve(worker_id: str) -> bool:
+    # take a slot of the worker for a job, False if it has none free
+    with workers_lock:
+        worker = workers.get(worker_id)
+        if worker is None:
+            return True
+        if not worker["ready"] or worker["in_flight"] >= worker["capacity"]:
+            return False
+        worker["in_flight"] += 1
+        return True
+
+
+def worker_release(worker_id: str):
+    with workers_lock:
+        worker = workers.get(worker_id)
+        if worker is not None and worker["in_flight"] > 0:
+            worker["in_flight"] -= 1
+
+
+def worker_status() -> Dict:
+    now = time.time()
+    with workers_lock:
+        for worker_id in [worker_id for worker_id, worker in workers.items()
+                          if now - worker["time"] >= worker_settings["worker_expiry"]]:
+            del workers[worker_id]
+        live = [worker for worker in workers.values() if now - worker["time"] < worker_settings["worker_timeout"]]
+        ready = [worker for worker in live if worker["ready"]]
+        ret = {
+            "age": min([now - worker["time"] for worker in workers.values()], default=1e9),
+            "ready": len(ready) > 0,
+            "workers": len(live),
+            "capacity": sum([worker["capacity"] for worker in ready]),
+            "in_flight": sum([worker["in_flight"] for worker in live])
+        }
+    return ret
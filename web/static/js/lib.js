@@ -46,104 +46,152 @@
 
 
     // -------------------------------------------------------------------------
-    // Refresh according to saved state in the backend.
-
-    const refresh = () => {
-        fetch("/get_state_and_conversation?" + make_params({"uuid": unique_id}))
-            .then( res => res.json())
-            .then(data => {
-                if (data?.msg !== "OK") {
-                    fatal_exit("Stuart error: invalid session (get_state_and_conversation).");
+    // Poll the backend for state, heartbeat and conversation.
+
+    // The conversation as far as we know it; /poll only returns the entries
+    // from index "since" on (and the sources of the answers among them).
+    let conversation = [];
+    let source = [];
+    let etag = null;
+    let polling = false;
+    let poll_again = false;
+    let poll_timer = null;
+    let questions_sent = 0;
+    // estimated seconds until the answer while the question is queued (from /poll)
+    let wait_sec = null;
+    // when the backend turned down a question (busy), the time to retry at
+    let retry_at = 0;
+
+    const render_conversation = () => {
+        let is_question = true;
+        $("#conversation").innerHTML = "";
+        let source_ix = 0;
+        conversation.forEach( part => {
+            let p = document.createElement("p");
+            if (is_question) {
+                p.classList.add("conversation_question");
+            } else {
+                p.classList.add("conversation_answer");
+            }
+            p.textContent = part;
+            $("#conversation").appendChild(p);
+            if (!is_question) {
+                let s = document.createElement("p");
+                s.textContent = source[source_ix++];
+                s.classList.add("conversation_source");
+                $("#conversation").appendChild(s);
+            }
+            is_question = !is_question;
+        });
+    }
+
+    const render_heartbeat = status => {
+        switch(status) {
+            case "up":          $("#heartbeat").innerHTML = "<span class=\"good\">up</span>"; break;
+            case "unavailable": $("#heartbeat").innerHTML = "<span class=\"bad\">unavailable</span>"; break;
+            case "down":        $("#heartbeat").innerHTML = "<span class=\"bad\">down</span>"; break;
+            default:            $("#heartbeat").innerHTML = "<span class=\"bad\">unknown state</span>"; break;
+        }
+    }
+
+    // Handle transitions STATE_UNKNOWN -> any state (at load),
+    // STATE_QUESTION_SENT -> STATE_QUESTION_QUEUED,
+    // STATE_QUESTION_QUEUED -> STATE_PROCESSING_QUESTION and
+    // STATE_PROCESSING_QUESTION -> STATE_WAIT_FOR_QUESTION.
+    const update = data => {
+        let offset = Number(data?.offset) || 0;
+        if (Array.isArray(data?.conversation) && Array.isArray(data?.source)) {
+            conversation = conversation.slice(0, offset).concat(data.conversation);
+            source = source.slice(0, Math.floor(offset / 2)).concat(data.source);
+        }
+        render_heartbeat(data?.heartbeat);
+        wait_sec = (typeof data?.wait_sec === "number") ? data.wait_sec : null;
+        let this_state = String(data?.state);
+        switch(this_state) {
+            case "wait-for-question":
+                if (state !== STATE_WAIT_FOR_QUESTION) {
+                    state = STATE_WAIT_FOR_QUESTION;
+                    render_conversation();
+                    $("#user_wait_animation").innerHTML = "&nbsp;";
+                    $("#user_question").value = '';
+                    enable("user_question");
+                    $("#user_question").focus();
+                    window.scrollTo(0, document.body.scrollHeight);
                 }
-                let conversation = data?.conversation;
-                let source = data?.source
-                if (!Array.isArray(conversation)) {
-                    conversation = [];
+                break;
+            case "question-queued":
+                if (state === STATE_UNKNOWN) {
+                    render_conversation();
                 }
-                let is_question = true;
-                $("#conversation").innerHTML = "";
-                let source_ix = 0;
-                conversation.forEach( part => {
-                    let p = document.createElement("p");
-                    if (is_question) {
-                        p.classList.add("conversation_question");
-                    } else {
-                        p.classList.add("conversation_answer");
-                    }
-                    p.textContent = part;
-                    $("#conversation").appendChild(p);
-                    if (!is_question) {
-                        let s = document.createElement("p");
-                        s.textContent = source[source_ix++];
-                        s.classList.add("conversation_source");
-                        $("#conversation").appendChild(s);
+                state = STATE_QUESTION_QUEUED;
+                disable("user_question");
+                break;
+            case "processing-question":
+                if (state === STATE_UNKNOWN) {
+                    render_conversation();
+                }
+                state = STATE_PROCESSING_QUESTION;
+                disable("user_question");
+                break;
+        }
+    }
+
+    // One polling loop: every second while a question is on its way, every
+    // 5 seconds otherwise (for the heartbeat). With the ETag of the last answer,
+    // the backend answers 304 (no body) if nothing changed.
+    const poll = () => {
+        if (polling) {
+            poll_again = true;
+            return;
+        }
+        polling = true;
+        // an answer to a poll started before a question was sent is stale
+        let sent = questions_sent;
+        let headers = {};
+        if (etag !== null) {
+            headers["If-None-Match"] = etag;
+        }
+        fetch("/poll?" + make_params({"uuid": unique_id, "since": conversation.length}),
+              { cache: "no-store", headers: headers })
+            .then(res => {
+                if (res.status === 304) {
+                    return null;
+                }
+                if (!res.ok) {
+                    throw new Error(res.status);
+                }
+                return res.json().then(data => ({"data": data, "etag": res.headers.get("ETag")}));
+            })
+            .then(answer => {
+                if (answer !== null && sent === questions_sent) {
+                    if (answer.data?.msg !== "OK") {
+                        fatal_exit("Stuart error: invalid session (poll).");
                     }
-                    is_question = !is_question;
-                });
-                let this_state = String(data?.state);
-                switch(this_state) {
-                    case "wait-for-question":
-                        state = STATE_WAIT_FOR_QUESTION;
-                        $("#user_wait_animation").innerHTML = "&nbsp;";
-                        $("#user_question").value = '';
-                        enable("user_question");
-                        $("#user_question").focus();
-                        window.scrollTo(0, document.body.scrollHeight);
-                        break;
-                    case "question-queued":
-                        state = STATE_QUESTION_QUEUED;
-                        disable("user_question");
-                        break;
-                    case "processing-question":
-                        state = STATE_PROCESSING_QUESTION;
-                        disable("user_question");
-                        break;
+                    etag = answer.etag;
+                    update(answer.data);
                 }
             })
             .catch(error => {
-                    fatal_exit("Stuart backend error: communication error (get_state_and_conversation).");
+                if (state === STATE_UNKNOWN) {
+                    fatal_exit("Stuart backend error: communication error (poll).");
+                }
+                render_heartbeat(null);
+            })
+            .finally(() => {
+                polling = false;
+                let busy = [STATE_QUESTION_SENT, STATE_QUESTION_QUEUED, STATE_PROCESSING_QUESTION].includes(state);
+                clearTimeout(poll_timer);
+                poll_timer = setTimeout(poll, poll_again ? 0 : (busy ? 1000 : 5000));
+                poll_again = false;
             });
     }
 
-    refresh();
+    poll();
 
 
     // -------------------------------------------------------------------------
     // Handle state machine.
 
-    // Handle transitions STATE_QUESTION_SENT -> STATE_QUESTION_QUEUED,
-    // STATE_QUESTION_QUEUED -> STATE_PROCESSING_QUESTION and
-    // STATE_PROCESSING_QUESTION -> STATE_WAIT_FOR_QUESTION;
-    // this is triggered by state changes in the backend retrieved by polling.
-    let poll_state = () => {
-        fetch("/get_state?" + make_params({"uuid": unique_id}))
-            .then( res => res.json())
-            .then(data => {
-                let continue_polling = false;
-                if (data?.msg === "OK") {
-                    let this_state = data?.state;
-                    if (this_state === "question-queued") {
-                        state = STATE_QUESTION_QUEUED;
-                        continue_polling = true;
-                    } else if (this_state === "processing-question") {
-                        state = STATE_PROCESSING_QUESTION;
-                        continue_polling = true;
-                    } else if (this_state === "wait-for-question") {
-                        state = STATE_WAIT_FOR_QUESTION;
-                        refresh();
-                    }
-                } else {
-                    fatal_exit("Stuart error: invalid session (get_state).");
-                }
-                if (continue_polling) {
-                    setTimeout(poll_state, 1000);
-                }
-            })
-            .catch(error => {
-                    fatal_exit("Stuart backend error: communication error (get_state).");
-            });
-    }
-
     // Handle transition STATE_WAIT_FOR_QUESTION -> STATE_QUESTION_SENT;
     // this is triggered by hitting "Enter" in the #user_question textarea.
     $("#user_question").onkeydown = (event) => {
@@ -158,15 +206,28 @@
             return;
         }
         disable("user_question");
+        questions_sent++;
         fetch('/add_question', { method: "POST",
                                  headers: {'Content-Type': 'application/x-www-form-urlencoded'},
                                  body: make_params({"uuid": unique_id, "question": $("#user_question").value})
                                 })
-            .then( res => res.json())
-            .then(data => {
+            .then(res => res.json().then(data => ({"status": res.status, "data": data})))
+            .then(answer => {
+                let data = answer.data;
                 if (data?.msg === "OK") {
                     state = STATE_QUESTION_SENT;
-                    poll_state();
+                    clearTimeout(poll_timer);
+                    poll();
+                } else if (answer.status === 429 || answer.status === 503) {
+                    // too many questions queued or sent: keep the question, let the user retry later
+                    let retry_after = Number(data?.retry_after) || 10;
+                    retry_at = Date.now() + 1000 * retry_after;
+                    setTimeout(() => {
+                        if (state === STATE_WAIT_FOR_QUESTION) {
+                            enable("user_question");
+                            $("#user_question").focus();
+                        }
+                    }, 1000 * retry_after);
                 } else {
                     fatal_exit("Stuart error: invalid session (add_question).");
                 }
@@ -178,41 +239,25 @@
     };
 
 
-    // -------------------------------------------------------------------------
-    // Handle inference server status display.
-    // This is independent of the state machine.
-
-    const get_heartbeat = () => {
-        fetch('/get_heartbeat')
-            .then( res => res.json())
-            .then(data => {
-                try {
-                    let age = Number(data.age)
-                    if (age < 10) {
-                        $("#heartbeat").innerHTML = "<span class=\"good\">up</span>";
-                    } else {
-                        $("#heartbeat").innerHTML = "<span class=\"bad\">down</span>";
-                    }
-                } catch (e) {
-                    $("#heartbeat").innerHTML = "<span class=\"bad\">unknown state</span>";
-                    setTimeout(get_heartbeat, 5000);
-                }
-                setTimeout(get_heartbeat, 5000);
-            })
-            .catch(error => {
-                $("#heartbeat").innerHTML = "<span class=\"bad\">unknown state</span>";
-                setTimeout(get_heartbeat, 5000);
-            });
-    }
-    get_heartbeat();
-
-
     // -------------------------------------------------------------------------
     // Waiting animation.
 
+    const format_wait = seconds => {
+        if (seconds < 60) {
+            return seconds + " seconds";
+        }
+        let minutes = Math.round(seconds / 60);
+        return minutes + (minutes === 1 ? " minute" : " minutes");
+    };
+
     const waitani = () => {
         let message = "&nbsp;";
-        if ([STATE_QUESTION_SENT, STATE_QUESTION_QUEUED, STATE_PROCESSING_QUESTION].includes(state)) {
+        if (state === STATE_QUESTION_QUEUED && wait_sec !== null) {
+            message = "question queued, estimated wait " + format_wait(wait_sec);
+        } else if (state === STATE_WAIT_FOR_QUESTION && retry_at > Date.now()) {
+            message = "too many questions right now, please retry in " +
+                      format_wait(Math.ceil((retry_at - Date.now()) / 1000));
+        } else if ([STATE_QUESTION_SENT, STATE_QUESTION_QUEUED, STATE_PROCESSING_QUESTION].includes(state)) {
             for (let i = 0; i < 40; i++) {
                 if (i === 20) {
                     switch(state) {